@@ -239,10 +239,7 @@ class GdlArchiveTool(Tk):
         is_wadbin = False
         if is_ps2_wadbin(target_filepath):
             is_wadbin = True
-        elif is_arcade_chd(target_filepath):
-            print(f"Error: CHD must first be decompressed to a raw HDD with chdman.")
-            return
-        elif not is_arcade_hdd(target_filepath):
+        elif not(is_arcade_hdd(target_filepath) or is_arcade_chd(target_filepath)):
             print(f"Error: The file does not appear to be an arcade HDD or PS2 WAD.BIN.")
             return
 
@@ -0,0 +1,459 @@
+import binascii
+import collections
+import concurrent.futures
+import io
+import lzma
+import os
+import struct
+import sys
+import threading
+import zlib
+
+from array import array
+from . import constants as c
+
+CHD_V5_HEADER_STRUCT = struct.Struct(">8sII4IQQQII20s20s20s")
+CHD_V5_MAP_HEADER_STRUCT = struct.Struct(">I6sHBBBx")
+
+# how many hunks to get at a time when reading
+READ_HUNK_BATCH_SIZE = 64
+
+
+class _BitReader:
+    '''Reads values of any number of bits from bytes, highest bit first.'''
+    def __init__(self, data):
+        self._data = data
+        self._pos = 0
+        self._buffer = 0
+        self._bit_count = 0
+
+    def _fill(self, count):
+        # bits already read are dropped from the buffer when it's filled
+        self._buffer &= (1 << self._bit_count) - 1
+        while self._bit_count < count:
+            # reading past the end gives zeros, the same as mame
+            data = self._data[self._pos: self._pos + 8].ljust(8, b'\0')
+            self._buffer = (self._buffer << 64) | int.from_bytes(data, 'big')
+            self._bit_count += 64
+            self._pos += 8
+
+    def peek(self, count):
+        if self._bit_count < count:
+            self._fill(count)
+        return (self._buffer >> (self._bit_count - count)) & ((1 << count) - 1)
+
+    def remove(self, count):
+        self._bit_count -= count
+
+    def read(self, count):
+        if self._bit_count < count:
+            self._fill(count)
+        self._bit_count -= count
+        return (self._buffer >> self._bit_count) & ((1 << count) - 1)
+
+
+def _read_huffman_tree(bit_reader, code_count=16, max_bits=8):
+    # reads a huffman tree stored as run length encoded code lengths, and
+    # returns a table mapping every max_bits value to its code and length
+    entry_bits = 5 if max_bits >= 16 else 4 if max_bits >= 8 else 3
+    code_lengths = []
+    while len(code_lengths) < code_count:
+        length = bit_reader.read(entry_bits)
+        if length != 1:
+            code_lengths.append(length)
+            continue
+
+        # 1 is an escape code. two 1s in a row are just a 1,
+        # otherwise the length is repeated a number of times
+        length = bit_reader.read(entry_bits)
+        if length == 1:
+            code_lengths.append(length)
+        else:
+            code_lengths.extend([length] * (bit_reader.read(entry_bits) + 3))
+
+    if len(code_lengths) != code_count or max(code_lengths) > max_bits:
+        raise ValueError("Invalid huffman tree in CHD map.")
+
+    # assign canonical codes, with the longest codes numbered lowest
+    length_counts = collections.Counter(code_lengths)
+    next_codes, start = {}, 0
+    for length in range(32, 0, -1):
+        next_start = (start + length_counts[length]) >> 1
+        if length != 1 and next_start*2 != start + length_counts[length]:
+            raise ValueError("Invalid huffman tree in CHD map.")
+
+        next_codes[length] = start
+        start = next_start
+
+    lookup = [(0, 0)] * (1 << max_bits)
+    for value, length in enumerate(code_lengths):
+        if not length:
+            continue
+
+        code = next_codes[length]
+        next_codes[length] += 1
+
+        shift = max_bits - length
+        lookup[code << shift: (code + 1) << shift] = [(value, length)] * (1 << shift)
+
+    return lookup
+
+
+def _get_lzma_filter(hunk_bytes):
+    # mame compresses with level 9 lzma, with the dictionary
+    # reduced to the smallest size that can hold an entire hunk
+    dict_size = 1 << 26
+    for i in range(11, 31):
+        if hunk_bytes <= 2 << i:
+            dict_size = min(dict_size, 2 << i)
+            break
+        elif hunk_bytes <= 3 << i:
+            dict_size = min(dict_size, 3 << i)
+            break
+
+    return dict(id=lzma.FILTER_LZMA1, dict_size=dict_size, lc=3, lp=0, pb=2)
+
+
+def get_codec_name(codec):
+    return codec.to_bytes(4, 'big').decode('latin-1') if codec else "none"
+
+
+def read_chd_header(fin):
+    '''
+    Reads the header of the v5 CHD from the start of the file, and returns
+    its values in a dict. sha1 is the sha1 of the image and its metadata.
+    '''
+    data = fin.read(CHD_V5_HEADER_STRUCT.size)
+    if len(data) < 16 or data[:8] != c.CHD_SIGNATURE:
+        raise ValueError("File is not a CHD.")
+
+    version = int.from_bytes(data[12:16], 'big')
+    if version != c.CHD_V5_VERSION or len(data) < CHD_V5_HEADER_STRUCT.size:
+        raise ValueError(f"CHD version {version} is not supported. Only version 5 is.")
+
+    (_, _, _, *codecs, logical_bytes, map_offset, meta_offset, hunk_bytes,
+     unit_bytes, raw_sha1, sha1, parent_sha1) = CHD_V5_HEADER_STRUCT.unpack(data)
+    return dict(
+        codecs=tuple(codecs), logical_bytes=logical_bytes, map_offset=map_offset,
+        meta_offset=meta_offset, hunk_bytes=hunk_bytes, unit_bytes=unit_bytes,
+        raw_sha1=raw_sha1, sha1=sha1, parent_sha1=parent_sha1,
+        )
+
+
+class ChdFile(io.RawIOBase):
+    '''
+    Read-only, seekable file object for the hard drive image stored in a
+    v5 MAME CHD, so it can be read without extracting it with chdman.
+    Hunks are decompressed as they're read, and the most recently read
+    are cached, up to cache_size bytes of them. Reads that need many
+    hunks decompress them on threads. Only the zlib and lzma codecs are
+    supported, and hunks stored in a parent CHD can't be read.
+    '''
+    _file = None
+
+    def __init__(self, filepath, cache_size=c.CHD_HUNK_CACHE_SIZE, thread_count=None):
+        self.filepath = filepath
+        self.thread_count = thread_count
+
+        self._pos = 0
+        self._executor = None
+        self._file_lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+
+        self._file = open(filepath, "rb")
+        try:
+            self._read_header()
+            if self.codecs[0] == c.CHD_CODEC_NONE:
+                self._read_uncompressed_map()
+            else:
+                self._read_compressed_map()
+        except Exception:
+            self._file.close()
+            raise
+
+        self._max_cached_hunks = max(1, cache_size // self.hunk_bytes)
+
+    def _read_header(self):
+        header = read_chd_header(self._file)
+        if not(header["hunk_bytes"] and header["unit_bytes"]):
+            raise ValueError("Invalid hunk size in CHD header.")
+
+        self.codecs        = header["codecs"]
+        self.logical_bytes = header["logical_bytes"]
+        self.hunk_bytes    = header["hunk_bytes"]
+        self.unit_bytes    = header["unit_bytes"]
+        self.sha1          = header["sha1"]
+        self.hunk_count    = (self.logical_bytes + self.hunk_bytes - 1) // self.hunk_bytes
+        self.has_parent    = any(header["parent_sha1"])
+        self._map_offset   = header["map_offset"]
+
+    def _read_uncompressed_map(self):
+        # each hunk is stored uncompressed, at its offset in hunks
+        self._file.seek(self._map_offset)
+        data = self._file.read(4*self.hunk_count)
+        if len(data) < 4*self.hunk_count:
+            raise ValueError("CHD map is truncated.")
+
+        hunk_offsets = array("I", data)
+        if sys.byteorder == "little":
+            hunk_offsets.byteswap()
+
+        self._hunk_types   = bytearray([c.CHD_COMPRESSION_NONE]) * self.hunk_count
+        self._hunk_offsets = array("Q", (offset * self.hunk_bytes for offset in hunk_offsets))
+        self._hunk_lengths = None
+        self._hunk_crcs    = None
+
+    def _read_compressed_map(self):
+        self._file.seek(self._map_offset)
+        (map_bytes, first_offset, map_crc, length_bits, self_bits, parent_bits
+         ) = CHD_V5_MAP_HEADER_STRUCT.unpack(self._file.read(CHD_V5_MAP_HEADER_STRUCT.size))
+        data = self._file.read(map_bytes)
+        if len(data) < map_bytes:
+            raise ValueError("CHD map is truncated.")
+
+        bit_reader = _BitReader(data)
+        read = bit_reader.read
+        lookup = _read_huffman_tree(bit_reader)
+
+        def decode():
+            value, length = lookup[bit_reader.peek(8)]
+            bit_reader.remove(length)
+            return value
+
+        # first the huffman coded hunk types. runs of the same type are
+        # stored as the number of hunks after this one to repeat it for
+        hunk_types = bytearray(self.hunk_count)
+        last_type = repeat = 0
+        for i in range(self.hunk_count):
+            if repeat:
+                repeat -= 1
+            else:
+                hunk_type = decode()
+                if hunk_type == c.CHD_COMPRESSION_RLE_SMALL:
+                    repeat = 2 + decode()
+                elif hunk_type == c.CHD_COMPRESSION_RLE_LARGE:
+                    repeat = 2 + 16 + (decode() << 4)
+                    repeat += decode()
+                else:
+                    last_type = hunk_type
+
+            hunk_types[i] = last_type
+
+        # then where each hunk is stored, its size and its crc
+        hunk_offsets = array("Q", bytes(8*self.hunk_count))
+        hunk_lengths = array("I", bytes(4*self.hunk_count))
+        hunk_crcs    = array("H", bytes(2*self.hunk_count))
+        raw_map      = bytearray()
+        curr_offset = int.from_bytes(first_offset, 'big')
+        last_self = last_parent = 0
+        hunk_units = self.hunk_bytes // self.unit_bytes
+        for i, hunk_type in enumerate(hunk_types):
+            offset, length, crc = curr_offset, 0, 0
+            if hunk_type <= c.CHD_COMPRESSION_TYPE_3:
+                length_crc = read(length_bits + 16)
+                length, crc = length_crc >> 16, length_crc & 0xFFFF
+                curr_offset += length
+            elif hunk_type == c.CHD_COMPRESSION_NONE:
+                length = self.hunk_bytes
+                crc = read(16)
+                curr_offset += length
+            elif hunk_type == c.CHD_COMPRESSION_SELF:
+                offset = last_self = read(self_bits)
+            elif hunk_type == c.CHD_COMPRESSION_PARENT:
+                offset = last_parent = read(parent_bits)
+            elif hunk_type in (c.CHD_COMPRESSION_SELF_0, c.CHD_COMPRESSION_SELF_1):
+                if hunk_type == c.CHD_COMPRESSION_SELF_1:
+                    last_self += 1
+                hunk_type, offset = c.CHD_COMPRESSION_SELF, last_self
+            elif hunk_type == c.CHD_COMPRESSION_PARENT_SELF:
+                hunk_type = c.CHD_COMPRESSION_PARENT
+                offset = last_parent = (i * self.hunk_bytes) // self.unit_bytes
+            elif hunk_type in (c.CHD_COMPRESSION_PARENT_0, c.CHD_COMPRESSION_PARENT_1):
+                if hunk_type == c.CHD_COMPRESSION_PARENT_1:
+                    last_parent += hunk_units
+                hunk_type, offset = c.CHD_COMPRESSION_PARENT, last_parent
+            else:
+                raise ValueError(f"Invalid compression type {hunk_type} in CHD map.")
+
+            hunk_types[i]   = hunk_type
+            hunk_offsets[i] = offset
+            hunk_lengths[i] = length
+            hunk_crcs[i]    = crc
+            raw_map += (
+                (hunk_type << 88) | (length << 64) | (offset << 16) | crc
+                ).to_bytes(12, 'big')
+
+        if binascii.crc_hqx(raw_map, 0xFFFF) != map_crc:
+            raise ValueError("CHD map failed its crc check.")
+
+        self._hunk_types   = hunk_types
+        self._hunk_offsets = hunk_offsets
+        self._hunk_lengths = hunk_lengths
+        self._hunk_crcs    = hunk_crcs
+
+    def _read_at(self, offset, size):
+        if hasattr(os, "pread"):
+            # lets threads read without taking turns seeking
+            data = os.pread(self._file.fileno(), size, offset)
+        else:
+            with self._file_lock:
+                self._file.seek(offset)
+                data = self._file.read(size)
+
+        if len(data) < size:
+            raise ValueError("CHD is truncated.")
+
+        return data
+
+    def read_hunk(self, hunk_index):
+        '''Returns the decompressed data of the hunk, without caching it.'''
+        hunk_type = self._hunk_types[hunk_index]
+        offset    = self._hunk_offsets[hunk_index]
+        if hunk_type == c.CHD_COMPRESSION_SELF:
+            # the data is the same as an earlier hunk's
+            if offset >= hunk_index:
+                raise ValueError(f"CHD hunk {hunk_index} refers to a hunk after it.")
+            return self.read_hunk(offset)
+        elif hunk_type == c.CHD_COMPRESSION_PARENT or (
+                self._hunk_crcs is None and not offset and self.has_parent
+                ):
+            raise ValueError(f"CHD hunk {hunk_index} is stored in a parent CHD, "
+                             "which is not supported.")
+        elif self._hunk_crcs is None:
+            # uncompressed chd. hunks not stored anywhere are zeros
+            return self._read_at(offset, self.hunk_bytes) if offset else bytes(self.hunk_bytes)
+
+        data = self._read_at(offset, self._hunk_lengths[hunk_index])
+        if hunk_type != c.CHD_COMPRESSION_NONE:
+            codec = self.codecs[hunk_type]
+            if codec == c.CHD_CODEC_ZLIB:
+                data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(data, self.hunk_bytes)
+            elif codec == c.CHD_CODEC_LZMA:
+                data = lzma.LZMADecompressor(
+                    lzma.FORMAT_RAW, filters=[_get_lzma_filter(self.hunk_bytes)]
+                    ).decompress(data, self.hunk_bytes)
+            else:
+                raise ValueError(f"CHD codec '{get_codec_name(codec)}' is not supported.")
+
+        if (len(data) != self.hunk_bytes or
+            binascii.crc_hqx(data, 0xFFFF) != self._hunk_crcs[hunk_index]):
+            raise ValueError(f"CHD hunk {hunk_index} failed its crc check.")
+
+        return data
+
+    def _get_hunks(self, hunk_indices):
+        # returns the data of the hunks, reading the ones not cached
+        hunks, missing = {}, []
+        with self._cache_lock:
+            for i in hunk_indices:
+                hunk = self._cache.get(i)
+                if hunk is None:
+                    missing.append(i)
+                else:
+                    self._cache.move_to_end(i)
+                    hunks[i] = hunk
+
+            if (len(missing) >= c.CHD_PARALLEL_HUNK_COUNT and
+                self.thread_count != 1 and self._executor is None):
+                self._executor = concurrent.futures.ThreadPoolExecutor(self.thread_count)
+
+        if len(missing) >= c.CHD_PARALLEL_HUNK_COUNT and self.thread_count != 1:
+            # zlib and lzma release the gil, so threads decompress in parallel
+            missing_hunks = self._executor.map(self.read_hunk, missing)
+        else:
+            missing_hunks = map(self.read_hunk, missing)
+
+        for i, hunk in zip(missing, missing_hunks):
+            hunks[i] = hunk
+            with self._cache_lock:
+                self._cache[i] = hunk
+                if len(self._cache) > self._max_cached_hunks:
+                    self._cache.popitem(last=False)
+
+        return [hunks[i] for i in hunk_indices]
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self.logical_bytes
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid whence (%s)" % whence)
+
+        if pos < 0:
+            raise ValueError("Negative seek position %s" % pos)
+
+        self._pos = pos
+        return pos
+
+    def readinto_at(self, pos, view):
+        '''
+        Fills the view with data starting at pos, returning how much was
+        read. This doesn't use or change the file position, so threads
+        can read from the same ChdFile at once.
+        '''
+        hunk_bytes = self.hunk_bytes
+        end = min(self.logical_bytes, pos + len(view))
+        if end <= pos:
+            return 0
+
+        first_hunk, last_hunk = pos // hunk_bytes, (end - 1) // hunk_bytes
+        read_size = 0
+        for batch_start in range(first_hunk, last_hunk + 1, READ_HUNK_BATCH_SIZE):
+            hunk_indices = range(batch_start, min(last_hunk + 1, batch_start + READ_HUNK_BATCH_SIZE))
+            for i, hunk in zip(hunk_indices, self._get_hunks(hunk_indices)):
+                start = max(pos, i*hunk_bytes) - i*hunk_bytes
+                stop  = min(end, (i + 1)*hunk_bytes) - i*hunk_bytes
+                view[read_size: read_size + stop - start] = memoryview(hunk)[start: stop]
+                read_size += stop - start
+
+        return read_size
+
+    def readinto(self, buffer):
+        self._checkClosed()
+        with memoryview(buffer) as view:
+            read_size = self.readinto_at(self._pos, view)
+
+        self._pos += read_size
+        return read_size
+
+    def __len__(self):
+        return self.logical_bytes
+
+    def __getitem__(self, key):
+        # slicing reads without seeking, the same as an mmap, so
+        # supyr_struct can parse structures straight out of the chd
+        self._checkClosed()
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.logical_bytes)
+            data = bytearray(max(0, stop - start))
+            with memoryview(data) as view:
+                self.readinto_at(start, view)
+            return bytes(data[::step])
+
+        if key < 0:
+            key += self.logical_bytes
+        if not 0 <= key < self.logical_bytes:
+            raise IndexError("CHD index out of range")
+
+        return self[key: key + 1][0]
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+        self._cache.clear()
+        if self._file is not None:
+            self._file.close()
+        super().close()
@@ -1,4 +1,33 @@
 CHD_SIGNATURE = b'MComprHD'
+CHD_V5_VERSION     = 5
+CHD_V5_HEADER_SIZE = 124
+
+# codecs a chd's hunks can be compressed with. CHD_CODEC_NONE in
+# the first codec slot means the entire chd is uncompressed
+CHD_CODEC_NONE = 0
+CHD_CODEC_ZLIB = int.from_bytes(b'zlib', 'big')
+CHD_CODEC_LZMA = int.from_bytes(b'lzma', 'big')
+
+# how each hunk in a v5 chd is stored. types 0-3 are
+# compressed with the codec in that slot of the header
+CHD_COMPRESSION_TYPE_0      = 0
+CHD_COMPRESSION_TYPE_3      = 3
+CHD_COMPRESSION_NONE        = 4
+CHD_COMPRESSION_SELF        = 5
+CHD_COMPRESSION_PARENT      = 6
+# these types only exist in the compressed map,
+# and are converted to the types above when read
+CHD_COMPRESSION_RLE_SMALL   = 7
+CHD_COMPRESSION_RLE_LARGE   = 8
+CHD_COMPRESSION_SELF_0      = 9
+CHD_COMPRESSION_SELF_1      = 10
+CHD_COMPRESSION_PARENT_SELF = 11
+CHD_COMPRESSION_PARENT_0    = 12
+CHD_COMPRESSION_PARENT_1    = 13
+
+CHD_HUNK_CACHE_SIZE = 0x4000000  # 64MB of decompressed hunks
+# reads needing at least this many uncached hunks decompress them on threads
+CHD_PARALLEL_HUNK_COUNT = 4
 
 # root of tree is file header 2(0 is the file table, and 1 is unknown)
 FILE_TABLE_INDEX   = 0
@@ -20,3 +49,9 @@ SECTOR_SIZE          = 0x200 # 512 bytes
 # TODO: figure this out: https://tldp.org/HOWTO/Large-Disk-HOWTO-4.html
 # https://cdn.discordapp.com/attachments/1040820763617415239/1150090764735488010/image.png
 #MAX_SECTOR_COUNT     = 0xFF00000
+
+# version of the index of an hdd image's files written beside it
+HDD_INDEX_VERSION   = 1
+HDD_INDEX_EXTENSION = "index"
+# how many sectors of the file table to hash to tell if the image changed
+HDD_INDEX_SAMPLE_SECTORS = 64
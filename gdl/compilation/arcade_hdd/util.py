@@ -1,8 +1,14 @@
+import hashlib
+import json
+import mmap
 import os
+import threading
 
+from traceback import format_exc
 from supyr_struct.buffer import get_rawdata_context
 from ..util import *
 from . import constants as c
+from . import chd
 from . import hdd_def
 
 
@@ -32,6 +38,44 @@ class BlockHeader:
         self.fragments_ter = tuple(kwargs.get("fragments_ter", self.fragments_ter))
 
 
+class PositionalFile:
+    '''
+    Read-only file that is read from at a given offset, rather than by
+    seeking, so threads can read from it at once without taking turns.
+    os.preadv is used where available, which reads straight into the
+    buffer. Elsewhere(windows) reads take turns seeking the file.
+    '''
+    def __init__(self, filepath):
+        self._file = open(filepath, "rb", buffering=0)
+        self._lock = threading.Lock()
+
+    def readinto_at(self, offset, view):
+        read_size = 0
+        while read_size < len(view):
+            with view[read_size:] as remaining:
+                if hasattr(os, "preadv"):
+                    count = os.preadv(self._file.fileno(), [remaining], offset + read_size)
+                else:
+                    with self._lock:
+                        self._file.seek(offset + read_size)
+                        count = self._file.readinto(remaining)
+
+            if not count:
+                break
+            read_size += count
+
+        return read_size
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 def is_arcade_hdd(filepath):
     try:
         # check for a couple header signatures
@@ -75,6 +119,57 @@ def is_arcade_chd(filepath):
     return False
 
 
+def get_fragment_runs(fragments, data_size):
+    # returns the byte offset and size of each run of the disc to read
+    # to get the file data. fragments right after each other are merged
+    # into one run, so they can be read all at once.
+    runs = []
+    data_remaining = data_size
+    for i in range(0, len(fragments), 2):
+        read_size = min(data_remaining, fragments[i+1] * c.SECTOR_SIZE)
+        if read_size <= 0:
+            break
+
+        offset = fragments[i] * c.SECTOR_SIZE
+        if runs and runs[-1][0] + runs[-1][1] == offset:
+            runs[-1][1] += read_size
+        else:
+            runs.append([offset, read_size])
+
+        data_remaining -= read_size
+
+    return runs
+
+
+def _read_into(rawdata, offset, view):
+    # fills the view with the data at the offset, and returns how much was
+    # read. mmaps and bytes are copied directly from, and files read into
+    if isinstance(rawdata, (mmap.mmap, bytes, bytearray)):
+        with memoryview(rawdata) as src:
+            read_size = max(0, min(len(view), len(src) - offset))
+            view[:read_size] = src[offset: offset + read_size]
+        return read_size
+    elif hasattr(rawdata, "readinto_at"):
+        return rawdata.readinto_at(offset, view)
+
+    rawdata.seek(offset)
+    if not hasattr(rawdata, "readinto"):
+        data = rawdata.read(len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    read_size = 0
+    while read_size < len(view):
+        with view[read_size:] as remaining:
+            count = rawdata.readinto(remaining)
+
+        if not count:
+            break
+        read_size += count
+
+    return read_size
+
+
 def read_file_fragments(*, block_header, rawdata, disc=0, max_filesize=None):
     if not max_filesize:
         max_filesize = c.MAX_FILE_SIZE
@@ -85,28 +180,63 @@ def read_file_fragments(*, block_header, rawdata, disc=0, max_filesize=None):
         block_header.fragments_pri
         )
 
-    data_remaining = block_header.data_size
-    ft_data = b''
-
-    if data_remaining > max_filesize:
-        raise ValueError(f"File is too large to safely load({data_remaining} bytes).")
+    if block_header.data_size > max_filesize:
+        raise ValueError(f"File is too large to safely load({block_header.data_size} bytes).")
 
-    for i in range(0, len(fragments), 2):
-        # read in and concatenate all fragments of the file
-        read_size = min(data_remaining, fragments[i+1] * c.SECTOR_SIZE)
-        if read_size <= 0:
-            break
+    runs = get_fragment_runs(fragments, block_header.data_size)
 
-        rawdata.seek(fragments[i]*c.SECTOR_SIZE)
-        ft_data += rawdata.read(read_size)
-        data_remaining = max(0, data_remaining - read_size)
+    # read all the fragments straight into the buffer they're returned in
+    ft_data = bytearray(sum(size for _, size in runs))
+    data_read = 0
+    with memoryview(ft_data) as view:
+        for offset, size in runs:
+            with view[data_read: data_read + size] as run_view:
+                data_read += _read_into(rawdata, offset, run_view)
 
+    # if the image ended early, don't return what couldn't be read
+    del ft_data[data_read:]
     return ft_data
 
 
+def open_hdd_image(filepath, use_mmap=False, thread_safe=False):
+    '''
+    Opens the hdd image for reading fragments from. If use_mmap is True,
+    the image is memory mapped, so the whole image can be read from without
+    seeking, and fragments are copied straight out of the os's page cache.
+    CHDs are opened as a ChdFile, which decompresses them as they're read.
+    If thread_safe is True, the image is opened so threads can read
+    fragments from it at once(mmaps and ChdFiles already can be).
+    '''
+    if is_arcade_chd(filepath):
+        return chd.ChdFile(filepath)
+    elif thread_safe and not use_mmap:
+        return PositionalFile(filepath)
+
+    fin = open(filepath, "rb")
+    if not use_mmap:
+        return fin
+
+    try:
+        return mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # can't mmap an empty file
+        return PositionalFile(filepath) if thread_safe else open(filepath, "rb")
+    finally:
+        # the mmap stays open after the file it's made from is closed
+        fin.close()
+
+
+def get_hdd_rawdata_context(*, filepath=None, rawdata=None):
+    # same as get_rawdata_context, except CHDs are opened as a ChdFile
+    if rawdata is None and filepath and is_arcade_chd(filepath):
+        return chd.ChdFile(filepath)
+
+    return get_rawdata_context(filepath=filepath, rawdata=rawdata)
+
+
 def read_file_table(*, filepath=None, rawdata=None, disc=0):
     assert disc in (0, 1, 2)
-    with get_rawdata_context(filepath=filepath, rawdata=rawdata) as fin:
+    with get_hdd_rawdata_context(filepath=filepath, rawdata=rawdata) as fin:
         hdd_block = hdd_def.hdd_def.build(rawdata=fin)
         ft_header = (
             hdd_block.file_table_header_ter if disc == 2 else
@@ -131,7 +261,7 @@ def read_file_headers(*, file_table=None, filepath=None, rawdata=None, disc=0):
             )
 
     headers = []
-    with get_rawdata_context(filepath=filepath, rawdata=rawdata) as fin:
+    with get_hdd_rawdata_context(filepath=filepath, rawdata=rawdata) as fin:
         for record in file_table:
             header = hdd_def.block_header_def.build(
                 rawdata=fin, offset=record[disc] * c.SECTOR_SIZE
@@ -170,7 +300,7 @@ def parse_directory_tree(*, file_headers=None, filepath=None, rawdata=None, disc
     dir_blocks = {
         c.ROOT_DIR_INDEX: file_headers[c.ROOT_DIR_INDEX]
         }
-    with get_rawdata_context(filepath=filepath, rawdata=rawdata) as fin:
+    with get_hdd_rawdata_context(filepath=filepath, rawdata=rawdata) as fin:
         while dir_blocks:
             next_dir_blocks = {}
             for dir_idx, dir_block in dir_blocks.items():
@@ -246,8 +376,158 @@ def _dump_hdd(dir_tree, output_path, rawdata, disc, skip_empty):
 
 
 def dump_hdd(*, output_dir, filepath=None, rawdata=None, disc=0, skip_empty=True):
-    dir_tree = parse_directory_tree(
-        filepath=filepath, rawdata=rawdata, disc=disc
-        )
-    with get_rawdata_context(filepath=filepath, rawdata=rawdata) as fin:
+    with get_hdd_rawdata_context(filepath=filepath, rawdata=rawdata) as fin:
+        dir_tree = parse_directory_tree(rawdata=fin, disc=disc)
         _dump_hdd(dir_tree, output_dir, fin, disc, skip_empty)
+
+
+def get_hdd_signature(*, filepath=None, rawdata=None, disc=0):
+    '''
+    Returns a hash of the sectors saying where the file table is, and a
+    sample of the sectors of the file table itself, which change if files
+    are added, removed, or moved. For CHDs, the sha1 of the image in the
+    header is used instead, so the CHD's map doesn't need to be read.
+    '''
+    assert disc in (0, 1, 2)
+    if rawdata is None and is_arcade_chd(filepath):
+        with open(filepath, "rb") as f:
+            return chd.read_chd_header(f)["sha1"].hex()
+
+    md5 = hashlib.md5()
+    sector = bytearray(c.SECTOR_SIZE)
+    with get_hdd_rawdata_context(filepath=filepath, rawdata=rawdata) as fin:
+        hdd_block = hdd_def.hdd_def.build(rawdata=fin)
+        ft_header = (
+            hdd_block.file_table_header_ter if disc == 2 else
+            hdd_block.file_table_header_sec if disc == 1 else
+            hdd_block.file_table_header_pri
+            )
+        fragments = (
+            ft_header.fragments_ter if disc == 2 else
+            ft_header.fragments_sec if disc == 1 else
+            ft_header.fragments_pri
+            )
+        md5.update(repr((ft_header.data_size, tuple(fragments))).encode())
+
+        # hash the partition and mbr blocks, then sectors spread evenly
+        # over the file table, always including the first and last
+        sector_offsets = [0, c.SECTOR_SIZE]
+        table_offsets = [
+            offset + i for offset, size in get_fragment_runs(fragments, ft_header.data_size)
+            for i in range(0, size, c.SECTOR_SIZE)
+            ]
+        step = max(1, len(table_offsets) // c.HDD_INDEX_SAMPLE_SECTORS)
+        sector_offsets.extend(table_offsets[::step])
+        sector_offsets.extend(table_offsets[-1:])
+
+        with memoryview(sector) as view:
+            for offset in sector_offsets:
+                md5.update(view[: _read_into(fin, offset, view)])
+
+    return md5.hexdigest()
+
+
+def _get_hdd_index_filepath(filepath):
+    return "%s.%s" % (filepath, c.HDD_INDEX_EXTENSION)
+
+
+def _load_hdd_index_file(filepath):
+    # returns the index beside the image, as long as it was made
+    # for the image as it is now. otherwise returns an empty index
+    index_filepath = _get_hdd_index_filepath(filepath)
+    try:
+        image_stat = os.stat(filepath)
+        if os.path.isfile(index_filepath):
+            with open(index_filepath, "r") as f:
+                index = json.load(f)
+
+            if (index.get("version") == c.HDD_INDEX_VERSION and
+                index["image_size"] == image_stat.st_size and
+                index["image_mtime_ns"] == image_stat.st_mtime_ns
+                ):
+                return index
+    except Exception:
+        print(format_exc())
+        print("Warning: Could not load hdd index '%s'" % index_filepath)
+
+    return dict(discs={})
+
+
+def load_hdd_index(filepath, disc=0):
+    '''
+    Returns the file headers and directory tree of the disc saved in the
+    index beside the hdd image, or None if there isn't one. The index is
+    only used if the image's size, modification time, and signature(see
+    get_hdd_signature) are the same as when the index was saved.
+    '''
+    disc_index = _load_hdd_index_file(filepath)["discs"].get(str(disc))
+    if not disc_index or disc_index["signature"] != get_hdd_signature(
+            filepath=filepath, disc=disc
+            ):
+        return None
+
+    fragments_size = len(BlockHeader.fragments_pri)
+    file_headers = [
+        BlockHeader(
+            block_type=block_type, file_type=file_type, data_size=data_size,
+            sectors_used=sectors_used, checksum=checksum,
+            # trailing zeros aren't saved, so add them back
+            fragments_pri=frags_pri + [0] * (fragments_size - len(frags_pri)),
+            fragments_sec=frags_sec + [0] * (fragments_size - len(frags_sec)),
+            fragments_ter=frags_ter + [0] * (fragments_size - len(frags_ter)),
+            )
+        for (block_type, file_type, data_size, sectors_used, checksum,
+             frags_pri, frags_sec, frags_ter) in disc_index["file_headers"]
+        ]
+
+    def load_dir_tree(dir_index):
+        # directories are dicts, and files are indices of their header
+        return {
+            name: load_dir_tree(value) if isinstance(value, dict) else file_headers[value]
+            for name, value in dir_index.items()
+            }
+
+    return file_headers, load_dir_tree(disc_index["dir_tree"])
+
+
+def save_hdd_index(filepath, file_headers, dir_tree, disc=0):
+    '''
+    Saves the file headers and directory tree of the disc to an index
+    beside the hdd image, so they can be loaded without parsing the image.
+    '''
+    header_indices = {id(header): i for i, header in enumerate(file_headers)}
+
+    def trim_zeros(values):
+        values = list(values)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def save_dir_tree(dir_tree):
+        return {
+            name: save_dir_tree(value) if isinstance(value, dict) else header_indices[id(value)]
+            for name, value in dir_tree.items()
+            }
+
+    index = _load_hdd_index_file(filepath)
+    image_stat = os.stat(filepath)
+    index.update(
+        version=c.HDD_INDEX_VERSION,
+        image_size=image_stat.st_size, image_mtime_ns=image_stat.st_mtime_ns,
+        )
+    index["discs"][str(disc)] = dict(
+        signature=get_hdd_signature(filepath=filepath, disc=disc),
+        file_headers=[
+            [header.block_type, header.file_type, header.data_size,
+             header.sectors_used, header.checksum, trim_zeros(header.fragments_pri),
+             trim_zeros(header.fragments_sec), trim_zeros(header.fragments_ter)]
+            for header in file_headers
+            ],
+        dir_tree=save_dir_tree(dir_tree),
+        )
+
+    index_filepath = _get_hdd_index_filepath(filepath)
+    with open(index_filepath + ".temp", "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+
+    os.replace(index_filepath + ".temp", index_filepath)
@@ -1,5 +1,7 @@
+import concurrent.futures
 import os
 import tempfile
+import time
 
 from traceback import format_exc
 from .arcade_hdd import constants as c
@@ -9,7 +11,7 @@ from .arcade_hdd import util
 def _extract_files(kwargs):
     file_buffers = {}
     file_headers = kwargs["file_headers"]
-    with open(kwargs["hdd_filepath"], "rb") as fin:
+    with util.open_hdd_image(kwargs["hdd_filepath"], kwargs.get("use_mmap")) as fin:
         for filename in sorted(file_headers):
             filepath = os.path.join(kwargs["hdd_dirpath"], filename.lstrip('/'))
             if not kwargs["overwrite"] and os.path.isfile(filepath):
@@ -42,6 +44,91 @@ def _extract_files(kwargs):
     return file_buffers
 
 
+def _extract_file(kwargs, fin, filename):
+    # reads the file and writes it to disk, or returns it. returns the
+    # size extracted and the data if it wasn't written, or None if the
+    # file wasn't extracted. written files aren't returned, so their
+    # data doesn't stay in memory until the files before them are done
+    filepath = os.path.join(kwargs["hdd_dirpath"], filename.lstrip('/'))
+    if kwargs["to_disk"]:
+        print(f"Extracting file: %s" % filename)
+    else:
+        print(f"Reading file: %s" % filename)
+
+    try:
+        file_data = util.read_file_fragments(
+            block_header=kwargs["file_headers"][filename],
+            rawdata=fin, disc=kwargs.get("disc", 0)
+            )
+        if kwargs.get("skip_empty") and not file_data:
+            return None
+        elif not kwargs["to_disk"]:
+            return len(file_data), file_data
+
+        with open(filepath, "wb") as fout:
+            fout.write(file_data)
+
+        return len(file_data), None
+    except Exception:
+        print(format_exc())
+        print(f"Failed to extract '{filepath}'")
+
+
+def _extract_files_threaded(kwargs):
+    '''
+    Same as _extract_files, except files are read and written by a pool
+    of threads sharing the image, so writing files overlaps with reading
+    others. Files are read in the order they're stored in the image, so
+    the image is read nearly sequentially.
+    '''
+    file_buffers = {}
+    file_headers = kwargs["file_headers"]
+    disc = kwargs.get("disc", 0)
+
+    def get_sort_key(filename):
+        runs = util.get_fragment_runs((
+            file_headers[filename].fragments_ter if disc == 2 else
+            file_headers[filename].fragments_sec if disc == 1 else
+            file_headers[filename].fragments_pri
+            ), file_headers[filename].data_size)
+        return (runs[0][0] if runs else 0, filename)
+
+    filenames, dirpaths = [], set()
+    for filename in sorted(file_headers, key=get_sort_key):
+        filepath = os.path.join(kwargs["hdd_dirpath"], filename.lstrip('/'))
+        if kwargs["overwrite"] or not os.path.isfile(filepath):
+            filenames.append(filename)
+            dirpaths.add(os.path.dirname(filepath))
+
+    if kwargs["to_disk"]:
+        # make the folders first, rather than checking for them each file
+        for dirpath in sorted(dirpaths):
+            os.makedirs(dirpath, exist_ok=True)
+
+    start = time.time()
+    extracted_count = extracted_size = 0
+    with util.open_hdd_image(kwargs["hdd_filepath"], kwargs.get("use_mmap"), True) as fin,\
+         concurrent.futures.ThreadPoolExecutor(kwargs["thread_count"]) as executor:
+        results = executor.map(
+            lambda filename: _extract_file(kwargs, fin, filename), filenames
+            )
+        for filename, result in zip(filenames, results):
+            if result is None:
+                continue
+            elif result[1] is not None:
+                file_buffers[filename] = result[1]
+
+            extracted_count += 1
+            extracted_size += result[0]
+
+    elapsed = time.time() - start
+    print("Extracted %s files(%.1f MB) in %.2f seconds(%.1f MB/s)" % (
+        extracted_count, extracted_size/1024**2, elapsed,
+        extracted_size/1024**2/max(elapsed, 1e-6)
+        ))
+    return file_buffers
+
+
 def _compile_hdd(kwargs):
     # TODO: implement this
     pass
@@ -55,6 +142,15 @@ class ArcadeHddCompiler:
     overwrite = False
     skip_empty = True
     parallel_processing = True
+    # memory map the hdd image when extracting, rather than reading it
+    use_mmap = False
+    # save the directory listing beside the hdd image, and load it
+    # from there rather than parsing the image, if it hasn't changed
+    use_index = True
+    # when processing in parallel, read files with threads sharing the
+    # image, rather than having processes each open it and read files
+    use_threads = True
+    thread_count = None  # None means use ThreadPoolExecutor's default
 
     file_headers = ()
     dir_tree = ()
@@ -91,13 +187,37 @@ class ArcadeHddCompiler:
 
     def load_hdd(self):
         print(self.hdd_dirpath)
-        self.file_headers = util.read_file_headers(
-            filepath=self.hdd_filepath, disc=self.disc
-            )
-        self.dir_tree = util.parse_directory_tree(
-            file_headers=self.file_headers,
-            filepath=self.hdd_filepath, disc=self.disc
-            )
+        hdd_index = None
+        if self.use_index:
+            try:
+                hdd_index = util.load_hdd_index(self.hdd_filepath, self.disc)
+            except Exception:
+                print(format_exc())
+                print("Could not load hdd index. Parsing hdd image instead.")
+
+        if hdd_index:
+            self.file_headers, self.dir_tree = hdd_index
+        else:
+            # open the image once, so chds only need their map read once
+            with util.get_hdd_rawdata_context(filepath=self.hdd_filepath) as fin:
+                self.file_headers = util.read_file_headers(
+                    rawdata=fin, disc=self.disc
+                    )
+                self.dir_tree = util.parse_directory_tree(
+                    file_headers=self.file_headers,
+                    rawdata=fin, disc=self.disc
+                    )
+
+            if self.use_index:
+                try:
+                    util.save_hdd_index(
+                        self.hdd_filepath, self.file_headers,
+                        self.dir_tree, self.disc
+                        )
+                except Exception:
+                    print(format_exc())
+                    print("Could not save hdd index.")
+
         self.flat_file_map = util.flatten_directory_tree(self.dir_tree)
 
     def extract_file(self, file_header):
@@ -109,7 +229,7 @@ class ArcadeHddCompiler:
 
         return _extract_files(dict(
             file_headers=file_headers, overwrite=self.overwrite,
-            to_disk=False, skip_empty=False, disc=self.disc,
+            to_disk=False, skip_empty=False, disc=self.disc, use_mmap=self.use_mmap,
             hdd_filepath=self.hdd_filepath, hdd_dirpath=self.hdd_dirpath,
             ))
 
@@ -119,34 +239,36 @@ class ArcadeHddCompiler:
     def extract_files_to_disk(self, filenames=None, ignore_case=False):
         file_headers = self._get_file_headers_for_filenames(filenames, ignore_case)
 
+        job_count = 1
+        if self.parallel_processing and not self.use_threads:
+            job_count = os.cpu_count()
+
         all_job_args = [
             dict(
                 file_headers={}, overwrite=self.overwrite,
                 to_disk=True, skip_empty=self.skip_empty, disc=self.disc,
+                use_mmap=self.use_mmap, thread_count=self.thread_count,
                 hdd_filepath=self.hdd_filepath, hdd_dirpath=self.hdd_dirpath,
                 )
-            for i in range(os.cpu_count() if self.parallel_processing else 1)
+            for i in range(job_count)
             ]
 
-        # attempt to distribute files across jobs so each job
-        # extracts similar amounts of data and file counts
-        names_to_extract_by_size = {}
-        names_sorted_by_size = []
-
-        for name, header in file_headers.items():
-            names_to_extract_by_size.setdefault(header.data_size, []).append(name)
-
-        for size in sorted(names_to_extract_by_size):
-            names_sorted_by_size.extend(names_to_extract_by_size[size])
+        # attempt to distribute files across jobs so each job extracts
+        # similar amounts of data, by giving the largest remaining file
+        # to the job with the least data to extract
+        job_sizes = [0] * len(all_job_args)
+        for name in sorted(file_headers, key=lambda name: -file_headers[name].data_size):
+            i = job_sizes.index(min(job_sizes))
+            all_job_args[i]["file_headers"][name] = file_headers[name]
+            job_sizes[i] += max(1, file_headers[name].data_size)
 
-        for i in range(len(names_sorted_by_size)):
-            name = names_sorted_by_size[i]
-            all_job_args[i % len(all_job_args)]["file_headers"][name] = file_headers[name]
-
-        util.process_jobs(
-            _extract_files, all_job_args,
-            process_count=None if self.parallel_processing else 1
-            )
+        if self.parallel_processing and self.use_threads:
+            _extract_files_threaded(all_job_args[0])
+        else:
+            util.process_jobs(
+                _extract_files, all_job_args,
+                process_count=None if self.parallel_processing else 1
+                )
 
     def compile(self):
         # TODO
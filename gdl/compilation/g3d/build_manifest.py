@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+
+from traceback import format_exc
+from ... import telemetry
+from . import constants as c
+
+
+def hash_file(filepath, chunk_size=1024**2):
+    digester = hashlib.md5()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digester.update(chunk)
+
+    return digester.digest()
+
+
+class BuildManifest:
+    '''
+    Records what each cache file in an assets directory was compiled from:
+    the size, mtime, and md5 of the source asset, the compile options used,
+    and the size and mtime of the cache file that was output.
+
+    This lets unchanged assets be skipped using only a stat of the source
+    and cache files. The source is only hashed when its stat changes, and
+    if the hash still matches, only the recorded stat is updated.
+    '''
+    version = 1
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.filepath = os.path.join(data_dir, c.BUILD_MANIFEST_FILENAME)
+        self.records  = {}
+        self.modified = False
+        # md5s of the sources hashed so far, keyed by their path and stat,
+        # so a source compiled to several targets is only hashed once
+        self.hashed_md5s = {}
+        self.load()
+
+    def load(self):
+        self.records = {}
+        self.modified = False
+        if not os.path.isfile(self.filepath):
+            return
+
+        try:
+            with open(self.filepath, "r") as f:
+                manifest = json.load(f)
+
+            if manifest.get("version") == self.version:
+                self.records = manifest.get("records", {})
+        except Exception:
+            print(format_exc())
+            print("Warning: Could not load build manifest '%s'" % self.filepath)
+
+    def save(self):
+        if not self.modified:
+            return
+
+        os.makedirs(self.data_dir, exist_ok=True)
+        temppath = self.filepath + ".temp"
+        with open(temppath, "w") as f:
+            json.dump(
+                dict(version=self.version, records=self.records),
+                f, sort_keys=True, indent=1
+                )
+
+        os.replace(temppath, self.filepath)
+        self.modified = False
+
+    def _get_record_key(self, asset_filepath):
+        return os.path.relpath(asset_filepath, self.data_dir).replace("\\", "/")
+
+    def get_record(self, asset_type, asset_filepath):
+        return self.records.get(asset_type, {}).get(
+            self._get_record_key(asset_filepath)
+            )
+
+    def get_source_md5s(self):
+        # hex md5s of every source asset recorded, for any asset type
+        return set(
+            record["source_md5"]
+            for records in self.records.values()
+            for record in records.values()
+            )
+
+    def get_source_md5(self, asset_type, asset_filepath):
+        '''
+        Returns the md5 of the source asset. If its size and mtime match
+        the recorded ones, the recorded md5 is returned without reading it.
+        Otherwise it's hashed, unless it was already for another asset type.
+        '''
+        record = self.get_record(asset_type, asset_filepath)
+        stat   = os.stat(asset_filepath)
+        if record and (
+                record["source_size"] == stat.st_size and
+                record["source_mtime_ns"] == stat.st_mtime_ns
+                ):
+            return bytes.fromhex(record["source_md5"])
+
+        hash_key = (self._get_record_key(asset_filepath), stat.st_size, stat.st_mtime_ns)
+        if hash_key not in self.hashed_md5s:
+            with telemetry.measure("hash", input_size=stat.st_size):
+                self.hashed_md5s[hash_key] = hash_file(asset_filepath)
+
+        return self.hashed_md5s[hash_key]
+
+    def is_up_to_date(self, asset_type, asset_filepath, cache_filepath,
+                      source_md5, options):
+        record = self.get_record(asset_type, asset_filepath)
+        if not record or not os.path.isfile(cache_filepath):
+            return False
+        elif record["source_md5"] != source_md5.hex():
+            return False
+        elif record["options"] != options:
+            # compile options changed(format, mipmaps, etc). must recompile
+            return False
+
+        cache_stat = os.stat(cache_filepath)
+        if (record["output_size"] != cache_stat.st_size or
+            record["output_mtime_ns"] != cache_stat.st_mtime_ns):
+            # cache file was modified or replaced outside of a compile
+            return False
+
+        # the source may have only been touched. update the recorded
+        # stat so the next check can skip hashing it again.
+        stat = os.stat(asset_filepath)
+        if (record["source_size"] != stat.st_size or
+            record["source_mtime_ns"] != stat.st_mtime_ns):
+            record.update(
+                source_size=stat.st_size, source_mtime_ns=stat.st_mtime_ns
+                )
+            self.modified = True
+
+        return True
+
+    def record_asset(self, asset_type, asset_filepath, cache_filepath,
+                     source_md5, options):
+        stat       = os.stat(asset_filepath)
+        cache_stat = os.stat(cache_filepath)
+        self.records.setdefault(asset_type, {})[
+            self._get_record_key(asset_filepath)
+            ] = dict(
+                source_size=stat.st_size,
+                source_mtime_ns=stat.st_mtime_ns,
+                source_md5=source_md5.hex(),
+                options=dict(options),
+                output_size=cache_stat.st_size,
+                output_mtime_ns=cache_stat.st_mtime_ns,
+                )
+        self.modified = True
@@ -3,6 +3,7 @@ import os
 from math import log
 from supyr_struct.util import backup_and_rename_temp
 from traceback import format_exc
+from ... import telemetry
 from ...defs.objects import objects_ps2_def
 from ...defs.texdef import texdef_ps2_def
 from ...defs.worlds import worlds_ps2_def
@@ -15,7 +16,7 @@ def compile_cache_files(
         objects_dir,
         target_ngc=False, target_ps2=False, target_xbox=False, target_arcade=False,
         serialize_cache_files=False, use_force_index_hack=False,
-        build_anim_cache=True, build_texdef_cache=False,
+        build_anim_cache=True, build_texdef_cache=False, metadata_store=None,
         ):
     # TODO: add support for compiling worlds
     data_dir    = os.path.join(objects_dir, c.DATA_FOLDERNAME)
@@ -38,11 +39,13 @@ def compile_cache_files(
     gtx_textures = texture.import_textures(
         objects_tag, data_dir, target_ngc=target_ngc,
         target_ps2=target_ps2, target_xbox=target_xbox,
-        use_force_index_hack=use_force_index_hack
+        use_force_index_hack=use_force_index_hack,
+        metadata_store=metadata_store
         )
     model.import_models(
         objects_tag, data_dir, target_ngc=target_ngc,
         target_ps2=target_ps2, target_xbox=target_xbox,
+        metadata_store=metadata_store
         )
 
     if build_anim_cache:
@@ -52,13 +55,13 @@ def compile_cache_files(
         texdef_tag = compile_texdef_cache_from_objects(objects_tag)
 
     if serialize_cache_files:
-        objects_tag.serialize(temp=False)
+        _serialize_tag(objects_tag)
 
         if anim_tag:
-            anim_tag.serialize(temp=False)
+            _serialize_tag(anim_tag)
 
         if texdef_tag:
-            texdef_tag.serialize(temp=False)
+            _serialize_tag(texdef_tag)
 
         if gtx_textures:
             serialize_textures_cache(
@@ -150,6 +153,13 @@ def decompile_cache_files(
             )
 
 
+def _serialize_tag(tag):
+    with telemetry.asset(os.path.basename(tag.filepath), "cache"),\
+         telemetry.measure("serialize") as record:
+        tag.serialize(temp=False)
+        record["output_size"] = os.path.getsize(tag.filepath)
+
+
 def serialize_textures_cache(
         objects_tag, gtx_textures, output_filepath=None,
         target_ngc=False, target_ps2=False
@@ -164,7 +174,9 @@ def serialize_textures_cache(
 
     temppath = output_filepath + ".temp"
     # open the textures.ps2 file and serialize the texture data into it
-    with open(temppath, 'w+b') as f:
+    with open(temppath, 'w+b') as f,\
+         telemetry.asset(os.path.basename(output_filepath), "cache"),\
+         telemetry.measure("serialize") as record:
         for g3d_texture, bitmap in zip(gtx_textures, objects_tag.data.bitmaps):
             if bitmap.frame_count or bitmap.flags.external:
                 continue
@@ -177,6 +189,8 @@ def serialize_textures_cache(
                 target_ngc=target_ngc, target_ps2=target_ps2,
                 )
 
+        record["output_size"] = f.seek(0, os.SEEK_END)
+
     backup_and_rename_temp(output_filepath, temppath)
 
 
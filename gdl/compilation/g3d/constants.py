@@ -12,6 +12,8 @@ TEXTURE_CACHE_EXTENSION_PS2  = "gtp"
 TEXTURE_CACHE_EXTENSION_XBOX = "gtx"
 TEXTURE_CACHE_EXTENSION_ARC  = "gta"
 NCC_TABLE_CACHE_EXTENSION    = "ncc"
+BUILD_MANIFEST_FILENAME      = "build.manifest"
+PALETTE_CACHE_EXTENSION      = "pal"
 MODEL_CACHE_EXTENSIONS = (
     MODEL_CACHE_EXTENSION_NGC,
     MODEL_CACHE_EXTENSION_PS2,
@@ -29,6 +31,7 @@ ANIM_FOLDERNAME   = 'animations'
 MOD_FOLDERNAME    = 'models'
 COLL_FOLDERNAME   = 'collision'
 TEX_FOLDERNAME    = 'bitmaps'
+PAL_FOLDERNAME    = 'palettes'
 
 ANIMATIONS_FILENAME = 'anim'
 OBJECTS_FILENAME    = 'objects'
@@ -188,6 +191,21 @@ MONOCHROME_FORMATS = set(
 VALID_DIMS = set(1<<i for i in range(15))
 MAX_MIP_COUNT = 6
 
+# methods for reducing textures to a palette when palettizing them.
+# median cut is fast and deterministic, while kmeans can give better
+# results, but is much slower and gives different results every run.
+TEXTURE_QUANTIZER_MEDIAN_CUT = "median_cut"
+TEXTURE_QUANTIZER_KMEANS     = "kmeans"
+TEXTURE_QUANTIZERS = (
+    TEXTURE_QUANTIZER_MEDIAN_CUT,
+    TEXTURE_QUANTIZER_KMEANS,
+    )
+DEFAULT_TEXTURE_QUANTIZER = TEXTURE_QUANTIZER_MEDIAN_CUT
+
+# number of transformed verts assumed to be cached when counting how
+# many verts of each subobject's strips miss the vertex cache
+DEFAULT_VERTEX_CACHE_SIZE = 16
+
 # everything below relates to calculating PS2
 # texture buffer addresses, sizes, and formats
 PSM_CT32  = "psmct32"   # usable as palette format
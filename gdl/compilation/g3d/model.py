@@ -1,16 +1,22 @@
-import hashlib
 import os
 
 from traceback import format_exc
+from ... import telemetry
 from ..metadata import objects as objects_metadata
 from .serialization.model import G3DModel
 from .serialization.model_vif import OBJECT_HEADER_STRUCT,\
      SUBOBJ_HEADER_STRUCT
+from . import build_manifest
 from . import constants as c
 from . import util
 
 
 def _compile_model(kwargs):
+    with telemetry.asset(kwargs["name"], "model"):
+        return _compile_model_asset(kwargs)
+
+
+def _compile_model_asset(kwargs):
     name           = kwargs.pop("name")
     source_md5     = kwargs.pop("source_md5")
     optimize       = kwargs.pop("optimize_strips")
@@ -19,6 +25,8 @@ def _compile_model(kwargs):
     target_xbox    = kwargs.pop("target_xbox")
     cache_filepath = kwargs.pop("cache_filepath")
     asset_filepath = kwargs.pop("asset_filepath")
+    optimize_cache = kwargs.pop("optimize_vertex_cache")
+    cache_size     = kwargs.pop("vertex_cache_size")
 
     print("Compiling model: %s" % name)
     g3d_model = G3DModel(
@@ -26,44 +34,89 @@ def _compile_model(kwargs):
         target_ngc=target_ngc and optimize,
         target_xbox=target_xbox and optimize,
         )
-    with open(asset_filepath, "r") as f:
+    with open(asset_filepath, "r") as f, telemetry.measure(
+            "decode", input_size=os.path.getsize(asset_filepath)
+            ):
         g3d_model.import_obj(f, source_md5)
 
-    g3d_model.make_strips()
+    with telemetry.measure("stripify"):
+        if optimize_cache:
+            report = g3d_model.choose_strip_start_orders(cache_size)
+        else:
+            g3d_model.make_strips()
+
+    if optimize_cache:
+        print("Chose strip start orders of model: %s" % name)
+        for idx_key, subobj_report in report.items():
+            print(("    %s (%s start order)\n" + "        %-7s" + "%14s"*4) % (
+                "/".join(filter(None, idx_key)), subobj_report["start_order"],
+                "", "verts", "degens", "qwords", "cache misses"
+                ))
+            for when in ("before", "after"):
+                stats = subobj_report[when]
+                print(("        %-7s" + "%14s"*4) % (
+                    when, stats["vert_count"], stats["degen_count"],
+                    stats["qword_count"], stats["cache_misses"]
+                    ))
 
     os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
-    with open(cache_filepath, "wb") as f:
+    # the model is encoded as it's written, so they're measured together
+    with open(cache_filepath, "wb") as f, telemetry.measure("encode") as record:
         g3d_model.export_g3d(f)
+        record["output_size"] = f.tell()
+
+    return cache_filepath
 
 
 def _decompile_model(kwargs):
+    with telemetry.asset(kwargs["name"], "model"):
+        _decompile_model_asset(kwargs)
+
+
+def _decompile_model_asset(kwargs):
     name           = kwargs["name"]
-    texture_assets = kwargs["texture_assets"]
     subobj_headers = kwargs["subobj_headers"]
-    subobj_models  = kwargs["subobj_models"]
     asset_type     = kwargs["asset_type"]
     filepath       = kwargs["filepath"]
 
+    # the model data and textures are shared by all jobs, rather than
+    # being copied into each job. see decompile_models
+    texture_assets = util.get_shared_job_data("texture_assets")
+    model_payload  = util.get_shared_job_data("model_payload")
+    with telemetry.measure("read") as record:
+        subobj_models  = [
+            dict(model, data=util.BytesBuffer(
+                model_payload.read(model["offset"], model["size"])
+                ))
+            for model in kwargs["subobj_models"]
+            ]
+        record["input_size"] = sum(model["size"] for model in subobj_models)
+
     print("Decompiling model: %s" % name)
     if asset_type == "obj":
         g3d_model = G3DModel()
+        with telemetry.measure("decode"):
+            for j in range(len(subobj_models)):
+                g3d_model.import_g3d(
+                    subobj_models[j]["data"], headerless=True,
+                    tex_name=subobj_headers[j]["tex_name"],
+                    lm_name=subobj_headers[j]["lm_name"]
+                    )
+
         # now that all the models are imported, export the obj
-        for j in range(len(subobj_models)):
-            g3d_model.import_g3d(
-                subobj_models[j]["data"], headerless=True,
-                tex_name=subobj_headers[j]["tex_name"],
-                lm_name=subobj_headers[j]["lm_name"]
+        with telemetry.measure("write") as record:
+            g3d_model.export_obj(
+                filepath, texture_assets,
+                swap_lightmap_and_diffuse=kwargs["swap_lightmap_and_diffuse"]
                 )
-        g3d_model.export_obj(
-            filepath, texture_assets,
-            swap_lightmap_and_diffuse=kwargs["swap_lightmap_and_diffuse"]
-            )
+            if os.path.isfile(filepath):
+                record["output_size"] = os.path.getsize(filepath)
         return
     elif asset_type not in c.MODEL_CACHE_EXTENSIONS:
         return
 
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    with open(filepath, 'wb+') as out_file:
+    with open(filepath, 'wb+') as out_file, telemetry.measure("write") as record:
         # write the g3d header
         out_file.write(OBJECT_HEADER_STRUCT.pack(
             kwargs["bnd_rad"], kwargs["vert_count"], kwargs["tri_count"], len(subobj_models),
@@ -91,14 +144,20 @@ def _decompile_model(kwargs):
                 out_file.tell(), 16
                 ))
 
+        record["output_size"] = out_file.tell()
+
 
 def compile_models(
         data_dir, force_recompile=False,  parallel_processing=False,
-        target_ps2=False, target_ngc=False, target_xbox=False, optimize_strips=True
+        target_ps2=False, target_ngc=False, target_xbox=False, optimize_strips=True,
+        optimize_vertex_cache=False, vertex_cache_size=c.DEFAULT_VERTEX_CACHE_SIZE
         ):
     asset_folder    = os.path.join(data_dir, c.EXPORT_FOLDERNAME, c.MOD_FOLDERNAME)
     cache_path_base = os.path.join(data_dir, c.IMPORT_FOLDERNAME, c.MOD_FOLDERNAME)
 
+    manifest = build_manifest.BuildManifest(data_dir)
+    manifest_args = {}
+
     all_job_args = []
     all_assets = util.locate_models(os.path.join(asset_folder))
 
@@ -117,24 +176,46 @@ def compile_models(
                 os.path.splitext(rel_filepath)[0], asset_type
                 ))
 
-            source_md5 = b'\x00'*16
-            g3d_cached_md5 = b''
-            with open(asset_filepath, "rb") as f:
-                source_md5 = hashlib.md5(f.read()).digest()
+            # the options that affect the compiled model. if any
+            # of these change, the model must be recompiled.
+            compile_options = dict(optimize_strips=bool(optimize_strips))
+            if optimize_vertex_cache:
+                # only recorded when used so existing caches stay valid
+                compile_options.update(vertex_cache_size=vertex_cache_size)
 
-            if os.path.isfile(cache_filepath):
-                with open(cache_filepath, "rb") as f:
-                    data = f.read(OBJECT_HEADER_STRUCT.size)
+            with telemetry.asset(name, "model"):
+                source_md5 = manifest.get_source_md5(asset_type, asset_filepath)
 
-                if len(data) >= OBJECT_HEADER_STRUCT.size:
-                    g3d_cached_md5 = OBJECT_HEADER_STRUCT.unpack(data)[5]
+            up_to_date = manifest.is_up_to_date(
+                asset_type, asset_filepath, cache_filepath, source_md5, compile_options
+                )
+            if not(up_to_date or manifest.get_record(asset_type, asset_filepath)):
+                # nothing recorded for this asset yet. fall
+                # back to the hash stored in the cache file
+                g3d_cached_md5 = b''
+                if os.path.isfile(cache_filepath):
+                    with open(cache_filepath, "rb") as f:
+                        data = f.read(OBJECT_HEADER_STRUCT.size)
+
+                    if len(data) >= OBJECT_HEADER_STRUCT.size:
+                        g3d_cached_md5 = OBJECT_HEADER_STRUCT.unpack(data)[5]
+
+                up_to_date = (g3d_cached_md5 == source_md5)
+                if up_to_date:
+                    manifest.record_asset(
+                        asset_type, asset_filepath, cache_filepath,
+                        source_md5, compile_options
+                        )
 
-            if g3d_cached_md5 == source_md5 and not force_recompile:
+            if up_to_date and not force_recompile:
                 # original asset file; don't recompile
+                telemetry.record_skipped(name, "model")
                 continue
 
+            manifest_args[cache_filepath] = (asset_filepath, source_md5, compile_options)
             all_job_args.append(dict(
                 asset_filepath=asset_filepath, name=name, optimize_strips=optimize_strips,
+                optimize_vertex_cache=optimize_vertex_cache, vertex_cache_size=vertex_cache_size,
                 target_ps2=target_ps2, target_ngc=target_ngc, target_xbox=target_xbox,
                 cache_filepath=cache_filepath, source_md5=source_md5
                 ))
@@ -145,13 +226,29 @@ def compile_models(
     print("Compiling %s models in %s" % (
         len(all_job_args), "parallel" if parallel_processing else "series"
         ))
+
+    def record_compiled_model(job_args, cache_filepath):
+        # record what each successfully compiled model was built from
+        if cache_filepath in manifest_args:
+            asset_filepath, source_md5, compile_options = manifest_args[cache_filepath]
+            manifest.record_asset(
+                asset_type, asset_filepath, cache_filepath,
+                source_md5, compile_options
+                )
+
+    # start the largest models first, so one isn't left compiling alone
+    costs = [util.get_file_cost(job_args["asset_filepath"]) for job_args in all_job_args]
     util.process_jobs(
         _compile_model, all_job_args,
-        process_count=None if parallel_processing else 1
+        process_count=None if parallel_processing else 1,
+        costs=costs, callback=record_compiled_model, raise_errors=False
         )
 
+    manifest.save()
 
-def import_models(objects_tag, data_dir, target_ps2=False, target_ngc=False, target_xbox=False):
+
+def import_models(objects_tag, data_dir, target_ps2=False, target_ngc=False,
+                  target_xbox=False, metadata_store=None):
     _, inv_bitmap_names = objects_tag.get_cache_names(by_name=True)
     # we uppercase everything for uniformity. do it here
     inv_bitmap_names = {n.upper(): inv_bitmap_names[n] for n in inv_bitmap_names}
@@ -163,7 +260,9 @@ def import_models(objects_tag, data_dir, target_ps2=False, target_ngc=False, tar
         )
     for name in sorted(all_asset_filepaths):
         try:
-            with open(all_asset_filepaths[name], "rb") as f:
+            with telemetry.asset(name, "model"),\
+                 telemetry.measure("read") as record,\
+                 open(all_asset_filepaths[name], "rb") as f:
                 g3d_header = OBJECT_HEADER_STRUCT.unpack(
                     f.read(OBJECT_HEADER_STRUCT.size)
                     )
@@ -193,6 +292,7 @@ def import_models(objects_tag, data_dir, target_ps2=False, target_ngc=False, tar
                     model_data["datas"].append(f.read(qwc * 16 + 8))
 
                 g3d_models_by_name[name.upper()] = model_data
+                record["input_size"] = f.tell()
         except Exception:
             print(format_exc())
             print("Could not load model:\n    %s" % all_asset_filepaths[name])
@@ -203,7 +303,9 @@ def import_models(objects_tag, data_dir, target_ps2=False, target_ngc=False, tar
     del object_defs[:]
 
     # get the metadata for all models to import
-    metadata = objects_metadata.compile_objects_metadata(data_dir).get("objects", ())
+    metadata = objects_metadata.compile_objects_metadata(
+        data_dir, metadata_store=metadata_store
+        ).get("objects", ())
     objects_metadata_by_name = {
         meta["name"]: meta for meta in metadata if "name" in meta
         }
@@ -301,6 +403,8 @@ def decompile_models(
     def_name = dict(name=c.MISSING_ASSET_NAME)
 
     all_job_args = []
+    model_datas = []
+    model_datas_size = 0
 
     # loop over each object
     for i in range(len(object_assets)):
@@ -313,10 +417,17 @@ def decompile_models(
         has_colors     = bool(getattr(flags, "v_colors", True))
         default_lod_k  = getattr(obj.sub_object_0, "lod_k", c.DEFAULT_MOD_LOD_K)
         subobjs        = getattr(obj.data, "sub_objects", ())
-        subobj_models  = [
-            dict(data = model.data, qword_count = model.qword_count)
-            for model in obj.data.sub_object_models
-            ]
+        subobj_models  = []
+        # jobs read the model data from a payload shared by all of them.
+        # it's only added to it if this object ends up with any jobs
+        obj_datas_size = model_datas_size
+        for model in obj.data.sub_object_models:
+            subobj_models.append(dict(
+                offset=obj_datas_size, size=len(model.data),
+                qword_count=model.qword_count
+                ))
+            obj_datas_size += len(model.data)
+
         subobj_headers = [
             dict(
                 tex_name = bitmap_assets.get(header.tex_index, def_name)['name'],
@@ -326,6 +437,7 @@ def decompile_models(
             for header in (obj.sub_object_0, *subobjs)
             ]
 
+        job_count = len(all_job_args)
         try:
             j = None  # initialize in case exception occurs before loop starts
             for asset_type in asset_types:
@@ -341,7 +453,6 @@ def decompile_models(
                     continue
 
                 all_job_args.append(dict(
-                    texture_assets=texture_assets,
                     subobj_headers=subobj_headers, subobj_models=subobj_models,
                     name=asset['name'], asset_type=asset_type, filepath=filepath,
                     has_lmap=has_lmap, has_normals=has_normals, has_colors=has_colors,
@@ -356,10 +467,22 @@ def decompile_models(
                   (j, i, asset_type, asset.get("name"), asset.get("asset_name"))
                   )
 
+        if len(all_job_args) > job_count:
+            model_datas.extend(model.data for model in obj.data.sub_object_models)
+            model_datas_size = obj_datas_size
+
     print("Decompiling %s models in %s" % (
         len(all_job_args), "parallel" if parallel_processing else "series"
         ))
-    util.process_jobs(
-        _decompile_model, all_job_args,
-        process_count=None if parallel_processing else 1
-        )
+    # the model data is put in shared memory when processing in parallel,
+    # so it isn't pickled and copied to the worker processes for each job
+    with util.SharedPayload(model_datas, parallel_processing) as model_payload:
+        util.process_jobs(
+            _decompile_model, all_job_args,
+            process_count=None if parallel_processing else 1,
+            costs=lambda job_args: job_args["vert_count"] + job_args["tri_count"],
+            shared_job_data=dict(
+                texture_assets=texture_assets, model_payload=model_payload
+                ),
+            raise_errors=False
+            )
@@ -121,6 +121,48 @@ def swizzle_ngc_gauntlet_textures(
     return swizzled_textures
 
 
+_NGC_GAUNTLET_SWIZZLE_MAPS = {}
+
+def get_ngc_gauntlet_swizzle_map(width, height, bits_per_pixel, unswizzle=True):
+    '''
+    Returns an array that maps each byte of a swizzled(or unswizzled)
+    Gamecube Gauntlet texture to the byte it's read from in the source.
+    Maps are cached, as the same few texture sizes are used repeatedly.
+    '''
+    key = (width, height, bits_per_pixel, bool(unswizzle))
+    swizzle_map = _NGC_GAUNTLET_SWIZZLE_MAPS.get(key)
+    if swizzle_map is not None:
+        return swizzle_map
+
+    channel_count = 1 if bits_per_pixel <= 8 else bits_per_pixel // 8
+    deswizzler = swizzler.Swizzler(
+        mask_type=(
+            "NGC_GAUNTLET_4BPP"  if bits_per_pixel == 4  else
+            "NGC_GAUNTLET_8BPP"  if bits_per_pixel == 8  else
+            "NGC_GAUNTLET_16BPP" if bits_per_pixel == 16 else
+            "NGC_GAUNTLET_32BPP"
+            )
+        )
+    # swizzle the byte offsets themselves to find where each byte comes from
+    swizzle_map = deswizzler.swizzle_single_array(
+        array("I", range(width*height*channel_count)), not unswizzle,
+        channel_count, width, height, 1,
+        )
+
+    # same hack as swizzle_ngc_gauntlet_textures, but swapping offsets.
+    # an odd byte at the end has nothing to swap with, so leave it be
+    if bits_per_pixel == 4:
+        pair_swap = [i ^ 1 for i in range(len(swizzle_map) & ~1)]
+        pair_swap.extend(range(len(pair_swap), len(swizzle_map)))
+        if unswizzle:
+            swizzle_map = array("I", map(swizzle_map.__getitem__, pair_swap))
+        else:
+            swizzle_map = array("I", map(pair_swap.__getitem__, swizzle_map))
+
+    _NGC_GAUNTLET_SWIZZLE_MAPS[key] = swizzle_map
+    return swizzle_map
+
+
 # just a guess on the 32bpp one
 def _ngc_gauntlet_swizzle_32bpp_mask_set(*args, **kwargs):
     return _ngc_gauntlet_swizzle_mask_set(*args, **kwargs, ngc_mask_start="xxy")
@@ -1,18 +1,130 @@
-import hashlib
+import itertools
+import operator
 import os
+import re
 import urllib
 
 from math import sqrt
 
-from .stripify import Stripifier
+from .stripify import Stripifier, START_ORDERS, count_cache_misses
+from .model_vif import SUBOBJ_HEADER_STRUCT
 from . import model_vif
+from . import obj_writer
 from . import constants as c
+from .. import util
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# number of components in each item of the per-vertex data
+VERTEX_DATA_WIDTHS = dict(verts=3, norms=3, uvs=2, lm_uvs=2, colors=4)
+
+_OBJ_FLOAT = r"[-+]?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][-+]?[0-9]+)?"
+_OBJ_INDEX = r"-?[0-9]+"
+_OBJ_LINE_PREFIX = operator.itemgetter(slice(0, 2))
+_OBJ_FACE_TRANSLATION = str.maketrans("f/", "  ")
+
+
+def _obj_lines_regex(prefix, value, count):
+    # matches lines of exactly `count` space separated values. lines
+    # like this parse the same in bulk as they do one token at a time.
+    # NOTE: the regexes are run on the entire group of lines, so each
+    #       line is matched in a lookahead and then consumed with a
+    #       backreference. this works like an atomic group(which python
+    #       only has since 3.11), so a line that doesn't match fails
+    #       without backtracking through every line before it.
+    return re.compile(r"(?:(?=(%s *%s(?: +%s){%d}\n))\1)*" % (
+        re.escape(prefix), value, value, count - 1
+        ))
+
+
+_OBJ_LINES_REGEXES = {
+    (prefix, count): _obj_lines_regex(prefix, _OBJ_FLOAT, count)
+    for prefix, count in (("v", 3), ("vn", 3), ("vt", 2), ("#lmvt ", 2), ("#vc ", 4))
+    }
+_OBJ_LINES_REGEXES.update({
+    ("f", count): _obj_lines_regex(
+        "f", r"%s(?:/%s){%d}" % (_OBJ_INDEX, _OBJ_INDEX, count - 1), 3
+        )
+    for count in (1, 2, 3)
+    })
+
+
+def _parse_obj_floats(lines, prefix, count):
+    # parse the lines in bulk if they're all simple, or one at a time if
+    # not, so that anything unusual is parsed exactly like it always was
+    text = "\n".join(lines) + "\n"
+    if _OBJ_LINES_REGEXES[(prefix, count)].fullmatch(text):
+        # the prefix is all that isn't a number, so blank it out
+        text = text.translate(str.maketrans(prefix, " "*len(prefix)))
+        return numpy.fromstring(text, dtype=float, sep=" ").reshape((-1, count))
+
+    values = []
+    for line in lines:
+        line = [v.strip() for v in line[len(prefix): ].split(' ') if v]
+        values.append([float(line[i]) for i in range(count)])
+
+    return numpy.array(values, dtype=float).reshape((-1, count))
+
+
+def _parse_obj_faces(lines):
+    # every corner of every face must have the same number of indices
+    # to parse in bulk, so use the last corner to determine how many
+    count = (lines[0].split(' ')[-1].count("/") + 1) if lines else 0
+    regex = _OBJ_LINES_REGEXES.get(("f", count))
+    text  = "\n".join(lines) + "\n"
+    if regex is not None and regex.fullmatch(text):
+        indices = numpy.fromstring(
+            text.translate(_OBJ_FACE_TRANSLATION), dtype=numpy.int64, sep=" "
+            ).reshape((-1, 3*count)) - 1
+        # zip the columns together to build the corner and triangle tuples
+        columns = [column.tolist() for column in indices.T]
+        return list(zip(*(
+            zip(*columns[i: i + count]) for i in range(0, 3*count, count)
+            )))
+
+    tris = []
+    for line in lines:
+        line = [v.strip() for v in line[1: ].split(' ') if v]
+        tris.append((tuple(int(i)-1 for i in line[0].split('/')),
+                     tuple(int(i)-1 for i in line[1].split('/')),
+                     tuple(int(i)-1 for i in line[2].split('/'))))
+
+    return tris
+
+
+def _vertex_data_property(name):
+    # the list-based view of the per-vertex data. any data imported
+    # as arrays is converted to lists the first time this is accessed
+    def getter(self):
+        data = self._vertex_lists[name]
+        if self._vertex_arrays[name]:
+            for array_data in self._vertex_arrays[name]:
+                data.extend(array_data.tolist())
+
+            self._vertex_arrays[name] = []
+
+        return data
+
+    def setter(self, data):
+        self._vertex_lists[name] = data
+        self._vertex_arrays[name] = []
+
+    return property(getter, setter)
 
 
 class G3DModel():
 
     source_file_hash = b'\x00'*16
 
+    verts  = _vertex_data_property("verts")
+    norms  = _vertex_data_property("norms")
+    uvs    = _vertex_data_property("uvs")
+    lm_uvs = _vertex_data_property("lm_uvs")
+    colors = _vertex_data_property("colors")
+
     def __init__(self, target_ps2=False, target_ngc=False, target_xbox=False):
         self.stripifier = Stripifier()
         self.stripifier.degen_link = False
@@ -26,13 +138,40 @@ class G3DModel():
         #set up the instance variables
         self.clear()
 
+    @property
+    def tri_lists(self):
+        # the list-based view of the triangles. any triangles imported as
+        # arrays are converted to lists the first time this is accessed
+        if self._tri_arrays:
+            for idx_key, tri_arrays in self._tri_arrays.items():
+                tris = self._tri_lists.setdefault(idx_key, [])
+                for tri_array in tri_arrays:
+                    tris.extend(
+                        (v0,v0,v0, v1,v1,v1, v2,v2,v2)
+                        for v0, v1, v2 in tri_array.tolist()
+                        )
+
+            self._tri_arrays = {}
+
+        return self._tri_lists
+
+    @tri_lists.setter
+    def tri_lists(self, tri_lists):
+        self._tri_lists  = tri_lists
+        self._tri_arrays = {}
+
+    @property
+    def vert_count(self):
+        return len(self._vertex_lists["verts"]) + sum(
+            len(verts) for verts in self._vertex_arrays["verts"]
+            )
+
     def clear(self):
-        # Stores the unorganized verts, norms, and uvs
-        self.verts  = []
-        self.norms  = []
-        self.uvs    = []
-        self.lm_uvs = []
-        self.colors = []
+        # Stores the unorganized verts, norms, and uvs. data can be
+        # stored as lists, numpy arrays, or a mix of both. see the
+        # vertex data properties and get_vertex_array for details.
+        self._vertex_lists  = {name: [] for name in VERTEX_DATA_WIDTHS}
+        self._vertex_arrays = {name: [] for name in VERTEX_DATA_WIDTHS}
 
         self.lod_ks   = {c.DEFAULT_INDEX_KEY: c.DEFAULT_MOD_LOD_K}
         self.tri_lists = {c.DEFAULT_INDEX_KEY: []}
@@ -45,6 +184,61 @@ class G3DModel():
 
         self.bnd_rad = 0.0
 
+    def extend_arrays(self, idx_key, tris, **vertex_arrays):
+        '''
+        Appends numpy arrays of vertex data(verts, norms, uvs, lm_uvs, and
+        colors) and an Mx3 array of triangles to this model. The triangle
+        indices are relative to the first vertex being appended.
+        '''
+        start_v = self.vert_count
+        for name, array_data in vertex_arrays.items():
+            if len(array_data):
+                self._vertex_arrays[name].append(array_data)
+
+        if len(tris):
+            self._tri_arrays.setdefault(idx_key, []).append(tris + start_v)
+        elif not (self._tri_lists.get(idx_key) or self._tri_arrays.get(idx_key)):
+            # if nothing was imported, remove the triangles
+            self._tri_lists.pop(idx_key, None)
+
+    def get_vertex_array(self, name):
+        '''
+        Returns the named vertex data(verts, norms, uvs, lm_uvs, or
+        colors) as a contiguous numpy array with one row per item.
+        '''
+        vertex_arrays = self._vertex_arrays[name]
+        if len(vertex_arrays) > 1:
+            # merge the arrays so they don't need to be concatenated again
+            vertex_arrays[:] = [numpy.concatenate(vertex_arrays)]
+
+        arrays = list(vertex_arrays)
+        if self._vertex_lists[name]:
+            arrays.insert(0, numpy.array(self._vertex_lists[name], dtype=float))
+
+        if not arrays:
+            return numpy.empty((0, VERTEX_DATA_WIDTHS[name]), dtype=float)
+
+        return arrays[0] if len(arrays) == 1 else numpy.concatenate(arrays)
+
+    def get_tri_array(self, idx_key):
+        '''
+        Returns the triangles for the given index key as an Mx3 numpy
+        array of vertex indices. List-based triangles are converted
+        using only their position indices.
+        '''
+        tri_arrays = list(self._tri_arrays.get(idx_key, ()))
+        tris = self._tri_lists.get(idx_key)
+        if tris:
+            tri_arrays.insert(0, numpy.array([
+                [v[0] if isinstance(v, tuple) else v for v in tri[::len(tri)//3]]
+                for tri in tris
+                ], dtype=numpy.int64).reshape((-1, 3)))
+
+        if not tri_arrays:
+            return numpy.empty((0, 3), dtype=numpy.int64)
+
+        return tri_arrays[0] if len(tri_arrays) == 1 else numpy.concatenate(tri_arrays)
+
     def make_strips(self):
         # load the triangles into the stripifier, calculate
         # strips, and link them together as best as possible
@@ -117,7 +311,202 @@ class G3DModel():
                     uv_max_y + uv_shift_y
                     ))
 
+    def get_strip_stats(self, cache_size=c.DEFAULT_VERTEX_CACHE_SIZE):
+        '''
+        Returns a dict of how many verts, degenerate triangles, and
+        quadwords each subobject's strips compile to, and how many of
+        the verts miss a vertex cache of the given size, keyed by the
+        subobject's idx_key. Subobjects without strips aren't included.
+        '''
+        all_stats = {}
+        for idx_key, strips in self.stripifier.all_strips.items():
+            if not strips:
+                continue
+
+            strips = [strip for strip in strips if len(strip) >= 3]
+            all_stats[idx_key] = dict(
+                vert_count=sum(map(len, strips)),
+                degen_count=sum(map(len, self.stripifier.all_degens[idx_key])),
+                qword_count=0,
+                cache_misses=count_cache_misses(strips, cache_size),
+                )
+
+        # compile the strips to see exactly how large they are. the
+        # subobjects are written in the same order, skipping empty ones
+        buffer = util.FixedBytearrayBuffer()
+        self.export_g3d(buffer, headerless=True)
+        subobj_start = 0
+        for stats in all_stats.values():
+            # the first quadword isn't included in the header's count
+            qword_count = SUBOBJ_HEADER_STRUCT.unpack_from(buffer, subobj_start)[0] + 1
+            stats["qword_count"] = qword_count
+            subobj_start += SUBOBJ_HEADER_STRUCT.size + qword_count*16
+
+        return all_stats
+
+    def choose_strip_start_orders(self, cache_size=c.DEFAULT_VERTEX_CACHE_SIZE):
+        '''
+        Makes strips starting from triangles in each order the stripifier
+        supports, and keeps the strips of each subobject that compile to
+        the fewest quadwords, then cache misses, then degenerate triangles.
+        This only picks between the strips each start order makes; it
+        doesn't reorder the triangles within them.
+
+        Returns a dict keyed by idx_key of each subobject's stats with
+        the strips made the default way ("before"), with the strips kept
+        ("after"), and the start order the kept strips were made with.
+        '''
+        def strip_data_dicts():
+            # everything make_strips calculates for each subobject
+            return (
+                self.stripifier.all_strips, self.stripifier.all_face_dirs,
+                self.stripifier.all_degens, self.all_dont_draws, self.all_vert_maxs,
+                self.all_uv_maxs, self.all_uv_shifts, self.all_lm_uv_shifts,
+                )
+
+        default_order = self.stripifier.start_order
+        report, best_scores, best_strip_datas = {}, {}, {}
+        try:
+            # try the default order first so it's kept if nothing is better
+            for start_order in dict.fromkeys((default_order, *START_ORDERS)):
+                self.stripifier.start_order = start_order
+                self.make_strips()
+                for idx_key, stats in self.get_strip_stats(cache_size).items():
+                    score = (stats["qword_count"], stats["cache_misses"], stats["degen_count"])
+                    if idx_key not in report:
+                        report[idx_key] = dict(before=stats)
+                    elif score >= best_scores[idx_key]:
+                        continue
+
+                    report[idx_key].update(after=stats, start_order=start_order)
+                    best_scores[idx_key] = score
+                    best_strip_datas[idx_key] = [d[idx_key] for d in strip_data_dicts()]
+        finally:
+            self.stripifier.start_order = default_order
+
+        # the subobjects compile independently, so the
+        # best strips of each can be combined as they are
+        for idx_key, strip_datas in best_strip_datas.items():
+            for data_dict, strip_data in zip(strip_data_dicts(), strip_datas):
+                data_dict[idx_key] = strip_data
+
+        return report
+
     def import_obj(self, input_lines, source_file_hash=b'\x00'*16):
+        if numpy is None:
+            return self._import_obj_lines(input_lines, source_file_hash)
+
+        # when importing an obj, we have to clear the existing data 
+        self.clear()
+
+        # default tex_name to use if one isnt given
+        tex_name = c.DEFAULT_TEX_NAME
+        lm_name  = c.DEFAULT_LM_NAME
+        idx_key  = c.DEFAULT_INDEX_KEY
+
+        # sort the lines by what they contain so each kind can be
+        # converted all at once, rather than a token at a time.
+        # faces are sorted by the triangle list they're added to.
+        vert_lines, norm_lines, uv_lines, lm_uv_lines, color_lines = [], [], [], [], []
+        face_lines_by_key = {idx_key: []}
+        face_lines = face_lines_by_key[idx_key]
+
+        # lines of the same kind are almost always grouped together,
+        # so handle each run of lines with the same prefix at once
+        for prefix, lines in itertools.groupby(
+                map(str.strip, input_lines), key=_OBJ_LINE_PREFIX
+                ):
+            if not prefix or prefix[0] == 'g':
+                # dont need to worry about groups
+                continue
+            elif prefix[0] == 'f':
+                face_lines.extend(lines)
+            elif prefix == 'vt':
+                uv_lines.extend(lines)
+            elif prefix == 'vn':
+                norm_lines.extend(lines)
+            elif prefix[0] == 'v':
+                vert_lines.extend(lines)
+            elif prefix == '#l':
+                lm_uv_lines.extend(line for line in lines if line[:5] == '#lmvt')
+            elif prefix == '#v':
+                color_lines.extend(line for line in lines if line[:3] == '#vc')
+            elif prefix[0] == '#':
+                for line in lines:
+                    # this is either a comment, or an extra piece of data
+                    line = line[1:].strip()
+                    if line.startswith('$lod_k'):
+                        self.lod_ks[idx_key] = int(line[6:])
+                    elif line.startswith('$lm_name'):
+                        lm_name = urllib.parse.unquote(line[9:].strip().upper())
+                        idx_key = (tex_name, lm_name)
+                    elif line.startswith("lmvt"):
+                        lm_uv_lines.append("#lmvt " + line[5:])
+                    elif line.startswith("vc"):
+                        color_lines.append("#vc " + line[3:])
+            else:
+                for line in lines:
+                    if line[:6] != 'usemtl':
+                        continue
+
+                    tex_name = urllib.parse.unquote(line[6:].strip().upper())
+
+                    idx_key = (tex_name, lm_name)
+                    # make a new triangle block if one for
+                    # this material doesnt already exist
+                    if idx_key not in face_lines_by_key:
+                        face_lines_by_key[idx_key] = []
+                        self.lod_ks.setdefault(idx_key, c.DEFAULT_MOD_LOD_K)
+                    face_lines = face_lines_by_key[idx_key]
+
+        verts  = _parse_obj_floats(vert_lines,  "v", 3)
+        norms  = _parse_obj_floats(norm_lines,  "vn", 3)
+        uvs    = _parse_obj_floats(uv_lines,    "vt", 2)
+        lm_uvs = _parse_obj_floats(lm_uv_lines, "#lmvt ", 2)
+        colors = _parse_obj_floats(color_lines, "#vc ", 4)
+
+        # x-axis is reversed
+        verts[:, 0] = -verts[:, 0]
+        norms[:, 0] = -norms[:, 0]
+
+        # NOTE: normalized in python, as numpy's squaring can
+        #       differ from python's by a bit in the last place
+        unit_norms = []
+        for xn, yn, zn in norms.tolist():
+            mag = sqrt(xn**2 + yn**2 + zn**2)
+            if mag == 0:
+                mag = 1.0
+            unit_norms.append((xn/mag, yn/mag, zn/mag))
+
+        norms  = numpy.clip(numpy.array(unit_norms, dtype=float).reshape((-1, 3)), -1.0, 1.0)
+        uvs[:, 1]    = 1 - uvs[:, 1]
+        lm_uvs[:, 1] = 1 - lm_uvs[:, 1]
+        colors = numpy.clip(colors, 0.0, 1.0)
+
+        for name, array_data in (("verts", verts), ("norms", norms), ("uvs", uvs),
+                                 ("lm_uvs", lm_uvs), ("colors", colors)):
+            if len(array_data):
+                self._vertex_arrays[name].append(array_data)
+
+        self.tri_lists = {
+            idx_key: _parse_obj_faces(face_lines)
+            for idx_key, face_lines in face_lines_by_key.items()
+            }
+
+        # NOTE: calculated in python for the same reason as the normals
+        bnd_rad_square = 0.0
+        for x, y, z in verts.tolist():
+            bnd_rad_square = max(x**2 + y**2 + z**2, bnd_rad_square)
+
+        self.bnd_rad = sqrt(bnd_rad_square)
+        self.source_file_hash = source_file_hash
+
+        # if no untextured triangles exist, remove the entries
+        if len(self.tri_lists.get(c.DEFAULT_INDEX_KEY, [None])) == 0:
+            del self.tri_lists[c.DEFAULT_INDEX_KEY]
+
+    def _import_obj_lines(self, input_lines, source_file_hash=b'\x00'*16):
+        # parses the obj a token at a time. used when numpy isn't available
         # when importing an obj, we have to clear the existing data 
         self.clear()
 
@@ -220,36 +609,16 @@ class G3DModel():
             '#     Extracted by Moses',
             ))
 
-        obj_str = '\n'.join((
+        obj_header = '\n'.join((
             '# Gauntlet Dark Legacy 3d model',
             '#     Extracted by Moses',
             'mtllib %s' % mtl_filename
             ))
         if swap_lightmap_and_diffuse and self.lm_uvs and self.uvs:
-            obj_str += '\n#lightmap_diffuse_swapped'
+            obj_header += '\n#lightmap_diffuse_swapped'
             uv_template, lmuv_template = lmuv_template, uv_template
 
-        obj_str += '\n\n'
-        obj_str += '\n'.join((
-            'v %.7f %.7f %.7f' % (-v[0], v[1], v[2]) for v in self.verts
-            ))
-        obj_str += '\n'
-        obj_str += '\n'.join((
-            'vn %.7f %.7f %.7f' % (-n[0], n[1], n[2]) for n in self.norms
-            ))
-        obj_str += '\n'
-        obj_str += '\n'.join((
-            uv_template % (uv[0], 1 - uv[1]) for uv in self.uvs
-            ))
-        obj_str += '\n'
-        obj_str += '\n'.join((
-            lmuv_template % (lm_uv[0], 1 - lm_uv[1]) for lm_uv in self.lm_uvs
-            ))
-        obj_str += '\n'
-        obj_str += '\n'.join((
-            '#vc %.7f %.7f %.7f %.7f' % tuple(color[:4]) for color in self.colors
-            ))
-        obj_str += '\n'
+        obj_header += '\n\n'
 
         seen_bitmaps = set()
         for idx_key in sorted(self.tri_lists):
@@ -279,52 +648,60 @@ class G3DModel():
                     ))
                 seen_bitmaps.add(bitmap_name)
 
-        # collect all all tris, verts, uvw, normals, and texture indexes
-        i = 0
-        for idx_key in sorted(self.tri_lists):
-            tris = self.tri_lists[idx_key]
-            if not tris:
-                continue
-
-            tex_name, lm_name = idx_key
-            lod_k = self.lod_ks.get(idx_key, c.DEFAULT_MOD_LOD_K)
-            if swap_lightmap_and_diffuse:
-                tex_name, lm_name = lm_name, tex_name
-
-            obj_str += '\n'.join((
-                '',
-                '#$lm_name %s' % urllib.parse.quote(lm_name),
-                '#$lod_k %s' % lod_k,
-                'usemtl %s' % urllib.parse.quote(tex_name),
-                'g %s' % i
-                ))
-            obj_str += '\n'
-            i += 1
-
-            # write the triangles
-            for tri in tris:
-                tri = tuple(i+1 for i in tri)  # obj indices are ones based
-                if len(tri) == 3:
-                    obj_str += 'f %s %s %s\n' % tri
-                elif len(tri) == 6:
-                    obj_str += 'f %s/%s %s/%s %s/%s\n' % tri
-                elif len(tri) == 9:
-                    obj_str += 'f %s/%s/%s %s/%s/%s %s/%s/%s\n' % tri
-                else:
-                    raise ValueError("Expected either 3, 6, or 9 items in tri, not %s" % len(tri))
-
-        mtl_bytes = mtl_str.encode()
-        obj_bytes = obj_str.encode()
+        # check the triangles before anything is written
+        for tris in self.tri_lists.values():
+            for size in set(map(len, tris)):
+                if size not in obj_writer.FACE_TEMPLATES:
+                    raise ValueError("Expected either 3, 6, or 9 items in tri, not %s" % size)
 
         os.makedirs(os.path.dirname(mtl_filepath), exist_ok=True)
         with open(mtl_filepath, 'wb+') as out_file:
-            out_file.write(mtl_bytes)
+            out_file.write(mtl_str.encode())
 
         with open(output_filepath, 'wb+') as out_file:
-            out_file.write(obj_bytes)
+            writer = obj_writer.ObjWriter(out_file)
+            writer.write(obj_header)
+            writer.write_lines(
+                'v %.7f %.7f %.7f', ((-v[0], v[1], v[2]) for v in self.verts)
+                )
+            writer.write_lines(
+                'vn %.7f %.7f %.7f', ((-n[0], n[1], n[2]) for n in self.norms)
+                )
+            writer.write_lines(
+                uv_template, ((uv[0], 1 - uv[1]) for uv in self.uvs)
+                )
+            writer.write_lines(
+                lmuv_template, ((lm_uv[0], 1 - lm_uv[1]) for lm_uv in self.lm_uvs)
+                )
+            writer.write_lines(
+                '#vc %.7f %.7f %.7f %.7f', (color[:4] for color in self.colors)
+                )
+
+            # collect all all tris, verts, uvw, normals, and texture indexes
+            i = 0
+            for idx_key in sorted(self.tri_lists):
+                tris = self.tri_lists[idx_key]
+                if not tris:
+                    continue
+
+                tex_name, lm_name = idx_key
+                lod_k = self.lod_ks.get(idx_key, c.DEFAULT_MOD_LOD_K)
+                if swap_lightmap_and_diffuse:
+                    tex_name, lm_name = lm_name, tex_name
+
+                writer.write('\n'.join((
+                    '',
+                    '#$lm_name %s' % urllib.parse.quote(lm_name),
+                    '#$lod_k %s' % lod_k,
+                    'usemtl %s' % urllib.parse.quote(tex_name),
+                    'g %s' % i
+                    )) + '\n')
+                i += 1
+
+                # write the triangles
+                writer.write_faces(tris)
 
-        digester = hashlib.md5(obj_bytes)
-        self.source_file_hash = digester.digest()
+        self.source_file_hash = writer.digest()
 
     def import_g3d(
             self, input_buffer, headerless=False, stream_len=-1, **kwargs
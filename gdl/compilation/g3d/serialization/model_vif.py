@@ -8,6 +8,11 @@ from math import sqrt
 from . import constants as c
 from .. import util
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 OBJECT_HEADER_STRUCT = struct.Struct('<fIIII 12x 16s')
 #   bounding_radius
 #   vert_count
@@ -63,15 +68,223 @@ def unpack_color_1555(color_1555):
         ((color_1555>>15)&1)*1.0,  # alpha(always set?)
         )
 
-NORM_1555_UNPACK_TABLE = tuple(map(unpack_norm_1555, range(0x8000)))
-NORM_1555_UNPACK_TABLE += NORM_1555_UNPACK_TABLE  # double length for full 16bit range
-COLOR_1555_UNPACK_TABLE = tuple(map(unpack_color_1555, range(0x10000)))
+
+# NOTE: the unpack tables below are large, so rather than building them
+#       on import, they're built as flat typed arrays the first time
+#       they're accessed as module attributes(see __getattr__ below).
+#       inside this module, use _get_table to access them.
+def _build_norm_1555_unpack_table():
+    # the high bit is the dont_draw flag, so only the lower 15 bits are
+    # stored. normals must be looked up using (norm_1555 & 0x7FFF)
+    if numpy is not None:
+        i  = numpy.arange(0x8000, dtype=numpy.int64)
+        xn = (i&31)/15 - 1
+        yn = ((i>>5)&31)/15 - 1
+        zn = ((i>>10)&31)/15 - 1
+        inv_mag = 1/(numpy.sqrt(xn*xn + yn*yn + zn*zn) + 0.0000001)
+        return array("d", numpy.stack(
+            (xn*inv_mag, yn*inv_mag, zn*inv_mag), axis=1
+            ).tobytes())
+
+    table = array("d")
+    for i in range(0x8000):
+        table.extend(unpack_norm_1555(i))
+
+    return table
+
+
+def _build_color_1555_unpack_table():
+    if numpy is not None:
+        i = numpy.arange(0x10000, dtype=numpy.int64)
+        return array("d", numpy.stack(
+            ((i&31)/31, ((i>>5)&31)/31, ((i>>10)&31)/31, ((i>>15)&1)*1.0),
+            axis=1
+            ).tobytes())
+
+    table = array("d")
+    for i in range(0x10000):
+        table.extend(unpack_color_1555(i))
+
+    return table
+
+
+_TABLE_BUILDERS = dict(
+    NORM_1555_UNPACK_TABLE=_build_norm_1555_unpack_table,
+    COLOR_1555_UNPACK_TABLE=_build_color_1555_unpack_table,
+    )
+
+
+def _get_table(name):
+    table = globals().get(name)
+    if table is None:
+        table = globals()[name] = _TABLE_BUILDERS[name]()
+
+    return table
+
+
+def __getattr__(name):
+    if name in _TABLE_BUILDERS:
+        return _get_table(name)
+
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def _unpack_with_table(table, stride, values, mask):
+    if numpy is not None:
+        table   = numpy.frombuffer(table, dtype="d").reshape((-1, stride))
+        indices = numpy.asarray(values, dtype=numpy.int64) & mask
+        return list(map(tuple, table[indices].tolist()))
+
+    return [tuple(table[(v & mask)*stride: ((v & mask) + 1)*stride]) for v in values]
+
+
+def unpack_norms_1555(norms_1555):
+    return _unpack_with_table(
+        _get_table("NORM_1555_UNPACK_TABLE"), 3, norms_1555, 0x7FFF
+        )
+
+
+def unpack_colors_1555(colors_1555):
+    return _unpack_with_table(
+        _get_table("COLOR_1555_UNPACK_TABLE"), 4, colors_1555, 0xFFFF
+        )
 
 
 def pack_g3d_stream_header(buffer, d_type, s_type, flags=0, count=0):
     buffer.write(STREAM_HEADER_STRUCT.pack(d_type, flags, count, s_type))
 
 
+def _decode_vif_stream_arrays(input_buffer, g3d_end):
+    '''
+    Decodes the data streams of a single subobject into numpy arrays.
+    Returns None if the streams contain single float32 triangles, as
+    those must be decoded by the list-based importer instead.
+    '''
+    pos_scale   = 1/c.POS_SCALE
+    uv_scale    = 1/c.UV_SCALE
+    lm_uv_scale = 1/c.LM_UV_SCALE
+
+    verts, norms, colors, uvs, lm_uvs = [], [], [], [], []
+    faces_drawn = []
+    face_dirs   = []
+
+    # scan over all the data in the stream
+    while input_buffer.tell() + STREAM_HEADER_STRUCT.size < g3d_end:
+        # ensure we're always 4-byte aligned
+        input_buffer.read(util.calculate_padding(
+            input_buffer.tell(), STREAM_HEADER_STRUCT.size
+            ))
+
+        # read the header data and unpack it
+        rawdata = input_buffer.read(STREAM_HEADER_STRUCT.size)
+        if len(rawdata) < STREAM_HEADER_STRUCT.size:
+            break
+
+        data_type, flags, count, storage_type = STREAM_HEADER_STRUCT.unpack(rawdata)
+        stream_struct = STREAM_DATA_STRUCTS.get((data_type, storage_type))
+
+        if stream_struct is None:
+            raise ValueError('Unknown data stream')
+
+        rawdata = input_buffer.read(stream_struct.size*count)
+        if len(rawdata) < stream_struct.size*count:
+            break
+
+        # every array stream is uniform, so its dtype is the
+        # byteorder and the first character of its format
+        dtype = stream_struct.format[:2]
+
+        if storage_type in (c.STORAGE_TYPE_NULL, c.STORAGE_TYPE_STRIP_N_END, c.STORAGE_TYPE_STRIP_0_END):
+            # we're reading the padding at EOF, or this is a strip terminator
+            pass
+        elif storage_type == c.STORAGE_TYPE_FLOAT32:
+            if data_type != c.DATA_TYPE_GEOM:
+                return None
+
+            # triangle strip. only need the face direction from it
+            faces_drawn.append([])
+            face_dirs.append(stream_struct.unpack_from(rawdata)[2])
+
+        elif not rawdata:
+            # nothing to unpack
+            pass
+        elif data_type == c.DATA_TYPE_POS:
+            # make sure to ignore the last vertex
+            verts.append(numpy.frombuffer(rawdata, dtype).reshape((-1, 3))[:-1] * pos_scale)
+
+        elif data_type == c.DATA_TYPE_NORM:
+            data = numpy.frombuffer(rawdata, dtype)
+            norms.append(data)
+
+            # make sure the first 2 are removed since they
+            # are always 1 and triangle strips are always
+            # made of 2 more verts than there are triangles
+            faces_drawn[-1].append(data[2:] >= 0x8000)
+
+        elif data_type == c.DATA_TYPE_COLOR:
+            colors.append(numpy.frombuffer(rawdata, dtype))
+
+        elif data_type == c.DATA_TYPE_UV and storage_type == c.STORAGE_TYPE_UINT16_LMUV:
+            # 16 bit diffuse and lightmap coordinates
+            data = numpy.frombuffer(rawdata, dtype).reshape((-1, 4))
+            uvs.append(data[:, :2] * uv_scale)
+            lm_uvs.append(data[:, 2:] * lm_uv_scale)
+
+        elif data_type == c.DATA_TYPE_UV:
+            # 8/16/32 bit uv coordinates
+            uvs.append(numpy.frombuffer(rawdata, dtype).reshape((-1, 2)) * uv_scale)
+
+    norm_table  = numpy.frombuffer(_get_table("NORM_1555_UNPACK_TABLE"), "d").reshape((-1, 3))
+    color_table = numpy.frombuffer(_get_table("COLOR_1555_UNPACK_TABLE"), "d").reshape((-1, 4))
+
+    def concatenate(arrays, *shape):
+        return numpy.concatenate(arrays) if arrays else numpy.empty((0, *shape))
+
+    verts = concatenate(verts, 3)
+    bnd_rad_square = 0.0
+    if len(verts):
+        bnd_rad_square = max(float((
+            verts[:, 0]*verts[:, 0] + verts[:, 1]*verts[:, 1] + verts[:, 2]*verts[:, 2]
+            ).max()), bnd_rad_square)
+
+    # generate the triangles for every strip at once. empty strips are
+    # skipped, and don't count towards the start vert of the next strip
+    strips = [
+        (numpy.concatenate(dont_draw), int(face_dir == -1.0))
+        for dont_draw, face_dir in zip(faces_drawn, face_dirs)
+        if sum(map(len, dont_draw))
+        ]
+    dont_draw   = concatenate([dont_draw for dont_draw, _ in strips]).astype(bool)
+    strip_dirs  = numpy.array([face_dir for _, face_dir in strips], dtype=numpy.int64)
+    strip_lens  = numpy.array([len(dont_draw) for dont_draw, _ in strips], dtype=numpy.int64)
+    strip_offs  = numpy.cumsum(strip_lens) - strip_lens
+    # increment the start vert by the number of verts used
+    start_verts = strip_offs + 2*numpy.arange(len(strips), dtype=numpy.int64)
+
+    f = numpy.arange(len(dont_draw), dtype=numpy.int64) - numpy.repeat(strip_offs, strip_lens)
+    v = numpy.repeat(start_verts, strip_lens) + f
+    # swap the vert order of every other face
+    swapped = ((f + numpy.repeat(strip_dirs, strip_lens)) & 1).astype(bool)
+    tris = numpy.stack((
+        numpy.where(swapped, v, v + 1),
+        numpy.where(swapped, v + 1, v),
+        v + 2,
+        ), axis=1)
+
+    # determine if the face is not supposed to be drawn
+    tris = tris[~dont_draw]
+
+    return dict(
+        verts=verts,
+        norms=norm_table[concatenate(norms).astype(numpy.int64) & 0x7FFF],
+        colors=color_table[concatenate(colors).astype(numpy.int64)],
+        uvs=concatenate(uvs, 2),
+        lm_uvs=concatenate(lm_uvs, 2),
+        tris=tris,
+        bnd_rad=sqrt(bnd_rad_square),
+        )
+
+
 def import_vif_to_g3d(
         g3d_model, input_buffer, headerless=False, stream_len=-1, 
         subobj_count=1, tex_name="", lm_name=""
@@ -105,6 +318,18 @@ def import_vif_to_g3d(
         tex_name = tex_name.upper()
         lm_name  = lm_name.upper()
         idx_key = (tex_name, lm_name)
+
+        if numpy is not None:
+            stream_start = input_buffer.tell()
+            arrays = _decode_vif_stream_arrays(input_buffer, g3d_end)
+            if arrays is not None:
+                g3d_model.bnd_rad = max(arrays.pop("bnd_rad"), g3d_model.bnd_rad)
+                g3d_model.extend_arrays(idx_key, **arrays)
+                continue
+
+            # fall back to the list-based importer
+            input_buffer.seek(stream_start)
+
         bnd_rad_square = 0.0
         strip_count = 0
 
@@ -205,7 +430,7 @@ def import_vif_to_g3d(
 
             elif data_type == c.DATA_TYPE_NORM:
                 dont_draw = [n >= 0x8000 for n in data]
-                norms.extend(map(NORM_1555_UNPACK_TABLE.__getitem__, data))
+                norms.extend(unpack_norms_1555(data))
 
                 # make sure the first 2 are removed since they
                 # are always 1 and triangle strips are always
@@ -213,7 +438,7 @@ def import_vif_to_g3d(
                 faces_drawn[-1].extend(dont_draw[2:])
 
             elif data_type == c.DATA_TYPE_COLOR:
-                colors.extend(map(COLOR_1555_UNPACK_TABLE.__getitem__, data))
+                colors.extend(unpack_colors_1555(data))
 
             elif data_type == c.DATA_TYPE_UV:
                 # 8/16/32 bit uv coordinates, or
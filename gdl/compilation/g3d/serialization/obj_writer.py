@@ -0,0 +1,71 @@
+import hashlib
+import itertools
+import operator
+
+# number of lines to format with each string operation
+WRITE_CHUNK_LINES = 4096
+
+FACE_TEMPLATES = {
+    3: 'f %s %s %s\n',
+    6: 'f %s/%s %s/%s %s/%s\n',
+    9: 'f %s/%s/%s %s/%s/%s %s/%s/%s\n',
+    }
+
+
+def _iter_chunks(iterable, chunk_size=WRITE_CHUNK_LINES):
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, chunk_size))
+
+
+class ObjWriter:
+    '''
+    Writes obj text to a file a block at a time, rather than building
+    the entire file in memory first, and calculates its md5 as it goes.
+    '''
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.digester = hashlib.md5()
+
+    def write(self, text):
+        data = text.encode()
+        self.digester.update(data)
+        self.out_file.write(data)
+
+    def write_lines(self, template, rows):
+        '''
+        Formats each row with the template and writes them joined by
+        newlines, followed by a newline. Each row must have exactly as
+        many items as the template has fields.
+        '''
+        template += '\n'
+        wrote_lines = False
+        for chunk in _iter_chunks(rows):
+            self.write((template * len(chunk)) % tuple(
+                itertools.chain.from_iterable(chunk)
+                ))
+            wrote_lines = True
+
+        if not wrote_lines:
+            self.write('\n')
+
+    def write_faces(self, tris):
+        '''
+        Writes each triangle as a face line. Triangles must contain
+        3, 6, or 9 zero based indices, which are written ones based.
+        '''
+        for chunk in _iter_chunks(tris):
+            for size, size_tris in itertools.groupby(chunk, len):
+                if size not in FACE_TEMPLATES:
+                    raise ValueError("Expected either 3, 6, or 9 items in tri, not %s" % size)
+
+                size_tris = list(size_tris)
+                self.write((FACE_TEMPLATES[size] * len(size_tris)) % tuple(
+                    map(operator.add, itertools.chain.from_iterable(size_tris),
+                        itertools.repeat(1))
+                    ))
+
+    def digest(self):
+        return self.digester.digest()
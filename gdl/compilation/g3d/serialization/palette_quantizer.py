@@ -0,0 +1,172 @@
+import hashlib
+import numpy
+import os
+
+from traceback import format_exc
+from . import constants as c
+
+
+def _median_cut(np_pixels, max_palette_size):
+    # build a histogram of the unique colors, and use it to weight the
+    # boxes when choosing which to split, and where to split them.
+    pixels = numpy.ascontiguousarray(np_pixels, dtype=numpy.uint8)
+    unique_colors, counts = numpy.unique(
+        pixels.view(numpy.uint32).reshape(-1), return_counts=True
+        )
+    colors = unique_colors.view(numpy.uint8).reshape((-1, 4)).astype(numpy.int64)
+    if len(colors) <= max_palette_size:
+        return colors.astype(float)
+
+    def make_box(box):
+        # split boxes by their largest range, weighted by pixel count
+        box_colors = colors[box]
+        ranges  = box_colors.max(axis=0) - box_colors.min(axis=0)
+        channel = int(ranges.argmax())
+        score   = int(ranges[channel]) * int(counts[box].sum())
+        return score, channel, box
+
+    boxes = [make_box(numpy.arange(len(colors)))]
+    while len(boxes) < max_palette_size:
+        i = max(range(len(boxes)), key=lambda i: boxes[i][0])
+        score, channel, box = boxes[i]
+        if score == 0:
+            # every remaining box is a single color
+            break
+
+        del boxes[i]
+        box = box[numpy.argsort(colors[box, channel], kind="stable")]
+
+        # split at the median pixel, keeping at least one color on each side
+        box_counts = numpy.cumsum(counts[box])
+        split = int(numpy.searchsorted(box_counts, box_counts[-1] / 2)) + 1
+        split = max(1, min(len(box) - 1, split))
+        boxes.extend((make_box(box[: split]), make_box(box[split: ])))
+
+    boxes = [box for _, _, box in boxes]
+    palette = numpy.empty((len(boxes), 4), dtype=float)
+    for i, box in enumerate(boxes):
+        weights = counts[box]
+        palette[i] = numpy.rint(
+            (colors[box] * weights[:, None]).sum(axis=0) / weights.sum()
+            )
+
+    return palette
+
+
+def _kmeans(np_pixels, max_palette_size):
+    # imported here since scipy is only needed for this quantizer
+    import scipy.cluster.vq
+    np_palette, _ = scipy.cluster.vq.kmeans(
+        numpy.asarray(np_pixels, dtype=float), max_palette_size
+        )
+    return np_palette
+
+
+QUANTIZERS = {
+    c.TEXTURE_QUANTIZER_MEDIAN_CUT: _median_cut,
+    c.TEXTURE_QUANTIZER_KMEANS:     _kmeans,
+    }
+
+
+def quantize(np_pixels, max_palette_size, quantizer=None):
+    '''
+    Calculates a palette of at most max_palette_size colors for the given
+    (N, 4) array of pixels. Returns the palette as an (M, 4) float array.
+    '''
+    if quantizer is None:
+        quantizer = c.DEFAULT_TEXTURE_QUANTIZER
+
+    if quantizer not in QUANTIZERS:
+        raise ValueError("Unknown texture quantizer '%s'" % quantizer)
+
+    return QUANTIZERS[quantizer](np_pixels, max_palette_size)
+
+
+def nearest_palette_indices(np_pixels, np_palette, chunk_size=4096):
+    '''
+    Returns the index of the closest palette color to each pixel. Like
+    scipy's vq, ties are resolved to the lowest palette index.
+    '''
+    pixels = numpy.ascontiguousarray(np_pixels, dtype=numpy.uint8)
+    palette = numpy.asarray(np_palette, dtype=float)
+
+    # textures rarely use every color they could, so only
+    # find the nearest palette color for each unique color
+    unique_colors, inverse = numpy.unique(
+        pixels.view(numpy.uint32).reshape(-1), return_inverse=True
+        )
+    colors = unique_colors.view(numpy.uint8).reshape((-1, 4)).astype(float)
+
+    # the squared distance minus the squared length of each pixel, as that's
+    # the same for every palette color. this is exact for integer colors.
+    palette_lengths = (palette * palette).sum(axis=1)
+    indices = numpy.empty(len(colors), dtype=numpy.int64)
+    for i in range(0, len(colors), chunk_size):
+        distances = palette_lengths - 2 * (colors[i: i + chunk_size] @ palette.T)
+        indices[i: i + chunk_size] = distances.argmin(axis=1)
+
+    return indices[inverse.reshape(-1)]
+
+
+def get_palette_cache_filepath(cache_dir, source_md5, *key_parts):
+    # cached palettes only depend on the source asset and the
+    # settings used to calculate them, so key them by those.
+    key_hash = hashlib.md5(repr(key_parts).encode()).hexdigest()
+    return os.path.join(cache_dir, "%s_%s.%s" % (
+        source_md5.hex(), key_hash[: 16], c.PALETTE_CACHE_EXTENSION
+        ))
+
+
+def load_cached_palette(filepath):
+    if not os.path.isfile(filepath):
+        return None
+
+    try:
+        with open(filepath, "rb") as f:
+            return numpy.frombuffer(f.read(), dtype="<f8").reshape((-1, 4))
+    except Exception:
+        print(format_exc())
+        print("Warning: Could not load cached palette '%s'" % filepath)
+
+    return None
+
+
+def save_cached_palette(filepath, np_palette):
+    try:
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        # write to a temp file first, as other processes may be reading it
+        temppath = "%s.%s.temp" % (filepath, os.getpid())
+        with open(temppath, "wb") as f:
+            f.write(numpy.asarray(np_palette, dtype="<f8").tobytes())
+
+        os.replace(temppath, filepath)
+    except Exception:
+        print(format_exc())
+        print("Warning: Could not save cached palette '%s'" % filepath)
+
+
+def prune_palette_cache(cache_dir, source_md5s):
+    '''
+    Deletes the cached palettes of any source whose md5 isn't in
+    source_md5s(hex strings), since they'll never be used again.
+    Returns the number of cached palettes deleted.
+    '''
+    if not os.path.isdir(cache_dir):
+        return 0
+
+    pruned = 0
+    for filename in sorted(os.listdir(cache_dir)):
+        name, ext = os.path.splitext(filename)
+        if ext.lstrip(".").lower() != c.PALETTE_CACHE_EXTENSION:
+            continue
+        elif name.split("_")[0] in source_md5s:
+            continue
+
+        try:
+            os.remove(os.path.join(cache_dir, filename))
+            pruned += 1
+        except Exception:
+            print(format_exc())
+            print("Warning: Could not delete cached palette '%s'" % filename)
+
+    return pruned
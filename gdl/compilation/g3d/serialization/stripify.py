@@ -1,8 +1,38 @@
+from array import array
+from collections import Counter, deque
 from math import sqrt
 
 DEFAULT_TEX = 0
 MAX_STRIP_LEN = 2**32-4
 
+# the orders strips can be started from triangles in.
+# edges:   the order the triangle edges were loaded in
+# valence: triangles with the fewest neighbors first, preferring
+#          the neighbors of the last strip made to keep them local
+START_ORDER_EDGES   = "edges"
+START_ORDER_VALENCE = "valence"
+START_ORDERS = (START_ORDER_EDGES, START_ORDER_VALENCE)
+
+
+def count_cache_misses(strips, cache_size):
+    '''Returns how many of the verts in the strips would miss a first-in
+    first-out vertex cache of the given size if drawn in order.'''
+    cache, cached = deque(), set()
+    misses = 0
+    for strip in strips:
+        for v_i in strip:
+            if v_i in cached:
+                continue
+
+            misses += 1
+            cache.append(v_i)
+            cached.add(v_i)
+            if len(cache) > cache_size:
+                cached.discard(cache.popleft())
+
+    return misses
+
+
 class Stripifier():
     ''''''
     # the max length a strip can be
@@ -14,30 +44,44 @@ class Stripifier():
     # whether or not to link strips together with 2 degen tris
     degen_link = True
 
+    # the order to try starting strips from triangles in
+    start_order = START_ORDER_EDGES
+
     def __init__(self, all_tris=None, *args, **kwargs):
         '''class initialization'''
         self.load_mesh(all_tris)
 
     def calc_strip(self, tri, neighbor_i=0, set_added=1):
-        '''Given a starting triangle and the edge to start navigating,
-        this function will return a list of the verts that make up the
-        longest strip it can find and whether the strip faces backward.
+        '''Given the index of a starting triangle in the current mesh and
+        the edge to start navigating, this function will return a list of
+        the verts that make up the longest strip it can find and whether
+        the strip faces backward.
 
         If set_added is True, triangles found will be flagged as
         added to a strip. Otherwise they will be de-flagged.'''
-        vert_data = self.vert_data
+        strip, strip_reversed, _ = self._calc_strip(tri, neighbor_i, set_added)
+        return strip, strip_reversed
+
+    def _calc_strip(self, tri, neighbor_i=0, set_added=1):
+        # same as calc_strip, but also returns the triangles in the strip
+        tri_verts = self._tri_verts
+        neighbors = self._tri_neighbors
+        added     = self._tris_added
+        seen      = self._tris_seen
+
         # each triangle has 3 edges.
         # this is the index of the edge the
         # next triangle will be connected to
         neighbor_i = neighbor_i%3
 
         strip_len = 2
-        last_neighbor_i = neighbor_i
         strip_dir = False
         strip_reversed = False
+        strip_tris = []
 
-        # keep track of which tris have been seen
-        seen = set()
+        # keep track of which tris have been seen by marking
+        # them with a number that's unique to this search
+        self._seen_id = seen_id = self._seen_id + 1
 
         set_added = bool(set_added)
 
@@ -45,31 +89,28 @@ class Stripifier():
         while True:
             # set the last triangle as this one
             last_tri = tri
-            tri = tri[4 + neighbor_i]
+            tri = neighbors[3*tri + neighbor_i]
 
             # exit if the strip has ended
-            if tri is None or tri[3] or id(tri) in seen:
+            if tri < 0 or added[tri] or seen[tri] == seen_id:
                 tri = last_tri
                 break
 
-            last_neighbor_i = (neighbor_i + 1 + strip_dir)%3
-
-            # get which index the last tri was in the new tri so we can
+            # get which edge the last tri is on in the new tri so we can
             # orient outselves and figure out which edge to travel next
-            neighbor_i = (tri.index(last_tri)-4 + 1 + strip_dir)%3
+            neighbor_i = (self._neighbor_edge(tri, last_tri) + 1 + strip_dir)%3
 
             # reverse the direction of travel
             # and set the triangle as seen
             strip_dir = not strip_dir
-            seen.add(id(last_tri))
+            seen[last_tri] = seen_id
 
-        # reset the seen set
-        seen = set()
+        # reset the seen triangles
+        self._seen_id = seen_id = seen_id + 1
 
         # make a strip starting with the first 2 verts to the triangle
-        strip = tri[neighbor_i:neighbor_i+2]
-        if neighbor_i == 2:
-            strip = [tri[2], tri[0]]
+        strip = [tri_verts[3*tri + neighbor_i],
+                 tri_verts[3*tri + (neighbor_i + 1)%3]]
 
         # if the strip direction should be reversed
         if strip_dir:
@@ -77,18 +118,11 @@ class Stripifier():
             strip = strip[::-1]
             strip_reversed = True
 
-        # get the max coordinate value of these first 2 verts and their uvs
-        v0_i = tri[neighbor_i]
-        v1_i = tri[(1+neighbor_i)%3]
-
         '''loop over triangles until the length is maxed or
         we reach a triangle without a neighbor on that edge'''
-        while not tri[3] and id(tri) not in seen and strip_len < self.max_strip_len:
-            # get the index of the vert that will be added to the strip
-            v_i = tri[(neighbor_i + 2)%3]
-
+        while not added[tri] and seen[tri] != seen_id and strip_len < self.max_strip_len:
             # add the vert to the strip
-            strip.append(v_i)
+            strip.append(tri_verts[3*tri + (neighbor_i + 2)%3])
 
             # set the last triangle as this one
             last_tri = tri
@@ -98,22 +132,88 @@ class Stripifier():
             # have the next triangle chosen from its second edge,
             # while every even numbered triangle will have the
             # next triangle chosen from its 3rd edge.
-            tri = tri[4 + (neighbor_i + 1 + strip_dir)%3]
+            tri = neighbors[3*tri + (neighbor_i + 1 + strip_dir)%3]
 
             # reverse the direction of travel, set the last triangle
             # as added and seen, and increment the strip length
-            last_tri[3] = set_added
+            added[last_tri] = set_added
+            strip_tris.append(last_tri)
             strip_dir = not strip_dir
-            seen.add(id(last_tri))
+            seen[last_tri] = seen_id
             strip_len += 1
 
             # exit if the strip has ended
-            if tri is None: break
+            if tri < 0: break
 
-            # get which index the last tri was in the new tri so we can
+            # get which edge the last tri is on in the new tri so we can
             # orient outselves and figure out which edge to travel next
-            neighbor_i = tri.index(last_tri)-4
-        return strip, strip_reversed
+            neighbor_i = self._neighbor_edge(tri, last_tri)
+        return strip, strip_reversed, strip_tris
+
+    def _neighbor_edge(self, tri, neighbor):
+        # returns the first edge of the triangle that the neighbor is on
+        tri_neighbors = self._tri_neighbors[3*tri: 3*tri + 3]
+        if not self._tris_duplicated[neighbor]:
+            # nothing else can compare equal to the neighbor
+            return tri_neighbors.index(neighbor)
+
+        for i in (0, 1, 2):
+            tri_i = tri_neighbors[i]
+            if tri_i == neighbor or (tri_i >= 0 and self._tris_equal(tri_i, neighbor)):
+                return i
+
+        raise ValueError("Triangle %s is not a neighbor of %s" % (neighbor, tri))
+
+    def _next_local_tri(self, strip_tris):
+        # returns the triangle next to the strip with the fewest
+        # neighbors that aren't in strips yet, or -1 if there's none
+        neighbors = self._tri_neighbors
+        added     = self._tris_added
+        next_tri, next_valence = -1, 4
+        for tri in reversed(strip_tris):
+            for tri_i in neighbors[3*tri: 3*tri + 3]:
+                if tri_i < 0 or added[tri_i]:
+                    continue
+
+                valence = sum(
+                    n >= 0 and not added[n]
+                    for n in neighbors[3*tri_i: 3*tri_i + 3]
+                    )
+                if valence < next_valence:
+                    next_tri, next_valence = tri_i, valence
+
+        return next_tri
+
+    def _tris_equal(self, tri_a, tri_b):
+        '''Returns whether two triangles would have compared as equal when
+        they were stored as lists of their verts, added flag, neighbors,
+        and edges. Duplicate triangles can, and when they are neighbors
+        this decides which edge of a triangle strips continue from.'''
+        if tri_a == tri_b:
+            return True
+
+        tri_verts = self._tri_verts
+        neighbors = self._tri_neighbors
+        a, b = 3*tri_a, 3*tri_b
+        if tri_verts[a: a + 3] != tri_verts[b: b + 3]:
+            return False
+
+        # the triangles are duplicates, so the outcome depends on whether
+        # they're added and their neighbors, which may need to be compared
+        # the same way. flag this since it's affected by setting tris added
+        self._compared_duplicates = True
+        if bool(self._tris_added[tri_a]) != bool(self._tris_added[tri_b]):
+            return False
+
+        for i in (0, 1, 2):
+            tri_a_i, tri_b_i = neighbors[a + i], neighbors[b + i]
+            if tri_a_i == tri_b_i:
+                continue
+            elif tri_a_i < 0 or tri_b_i < 0 or not self._tris_equal(tri_a_i, tri_b_i):
+                return False
+
+        # edges are made from the verts, so they're already known equal
+        return True
 
     def link_strips(self):
         '''Links the strips that are currently loaded together into one
@@ -251,11 +351,16 @@ class Stripifier():
         # Stores each unique combination of vert/uv/norm/color number
         self.vert_data = vert_data = []
 
-        '''Stores triangles indexed by their tex_index and then their edges.
-        The triangle edges they are indexed under are in reverse direction.
-        This is because all connected neighboring triangles will
-        share the same edge, but in the opposite direction.'''
-        self.all_tris_by_edges = {}
+        '''Stores the 3 verts of each triangle, indexed by tex_index.'''
+        self.all_tri_verts = {}
+
+        '''Stores the 3 neighbors of each triangle, indexed by tex_index.
+        Neighbor i shares the edge from vert i to vert i+1, and is -1 if
+        there is no neighbor on that edge.'''
+        self.all_tri_neighbors = {}
+
+        '''Stores the order triangles are tried as the start of strips.'''
+        self.all_start_tris = {}
 
         '''Stores lists of the direction of each tex_indexs triangle strips.
         False == strip is facing properly. True == strip is facing inverted.'''
@@ -286,112 +391,173 @@ class Stripifier():
         for tex_index in all_tris:
             tris = all_tris[tex_index]
 
-            self.all_tris_by_edges[tex_index] = t_by_e = {}
+            self.all_tri_verts[tex_index] = tri_verts = array("l")
+            self.all_tri_neighbors[tex_index] = neighbors = array("l")
             self.all_face_dirs[tex_index] = []
             self.all_strips[tex_index] = []
             self.tri_counts[tex_index] = len(tris)
             self.all_degens[tex_index] = []
+
+            '''Stores triangle edges(as the triangle's index times 3 plus
+            the edge's index) indexed by their verts. The triangle
+            edges they are indexed under are in reverse direction.
+            This is because all connected neighboring triangles will
+            share the same edge, but in the opposite direction.'''
+            tris_by_edges = {}
             if not tris:
+                self.all_start_tris[tex_index] = []
                 continue
 
+            # same as vert_map, but only for this mesh, and keyed
+            # by the source verts so new keys needn't be made for them
+            mesh_vert_map = {}
+
             iterable = hasattr(tris[0], "__iter__")
             for src_tri in tris:
                 if iterable:
-                    v0 = tuple(src_tri[0]) + (tex_index, )
-                    v1 = tuple(src_tri[1]) + (tex_index, )
-                    v2 = tuple(src_tri[2]) + (tex_index, )
+                    k0, k1, k2 = tuple(src_tri[0]), tuple(src_tri[1]), tuple(src_tri[2])
                 else:
-                    v0 = (src_tri[0], tex_index)
-                    v1 = (src_tri[1], tex_index)
-                    v2 = (src_tri[2], tex_index)
+                    k0, k1, k2 = src_tri[0], src_tri[1], src_tri[2]
 
                 # connected faces in a triangle strip must share vert,
                 # coordinates, uv coordinates, and normals. This is
                 # because the verts are reused for neighboring faces.
                 # Need to split strips up by texture coordinates as well.
 
-                v0_i = vert_map.get(v0)
-                v1_i = vert_map.get(v1)
-                v2_i = vert_map.get(v2)
+                v0_i = mesh_vert_map.get(k0)
+                v1_i = mesh_vert_map.get(k1)
+                v2_i = mesh_vert_map.get(k2)
 
                 # get if this first vert doesnt already exist
                 if v0_i is None:
-                    vert_map[v0] = v0_i = len(vert_data)
+                    v0 = k0 + (tex_index, ) if iterable else (k0, tex_index)
+                    mesh_vert_map[k0] = vert_map[v0] = v0_i = len(vert_data)
                     vert_data.append(v0)
                 # get if this second vert doesnt already exist
                 if v1_i is None:
-                    vert_map[v1] = v1_i = len(vert_data)
+                    v1 = k1 + (tex_index, ) if iterable else (k1, tex_index)
+                    mesh_vert_map[k1] = vert_map[v1] = v1_i = len(vert_data)
                     vert_data.append(v1)
                 # get if this third vert doesnt already exist
                 if v2_i is None:
-                    vert_map[v2] = v2_i = len(vert_data)
+                    v2 = k2 + (tex_index, ) if iterable else (k2, tex_index)
+                    mesh_vert_map[k2] = vert_map[v2] = v2_i = len(vert_data)
                     vert_data.append(v2)
 
-                edges = [(v0_i, v1_i), (v1_i, v2_i), (v2_i, v0_i)]
+                tri_i = len(tri_verts)
+                tri_verts.extend((v0_i, v1_i, v2_i))
+                neighbors.extend((-1, -1, -1))
 
-                #       [vert1, vert2, vert3, added,
-                #        sib1,  sib2,  sib3,
-                #        edge1, edge2, edge3]
-                tri = [v0_i,  v1_i,  v2_i,  False,
-                       None, None, None,
-                       edges[0], edges[1], edges[2]]
+                # edges are packed into ints to make them faster to hash
+                edges     = ((v0_i << 32) | v1_i, (v1_i << 32) | v2_i, (v2_i << 32) | v0_i)
+                rev_edges = ((v1_i << 32) | v0_i, (v2_i << 32) | v1_i, (v0_i << 32) | v2_i)
 
                 # loop over all 3 edges
                 for i in (0, 1, 2):
-                    # get the triangle that shares this edge
-                    conn_tri = t_by_e.get(edges[i])
-                    if conn_tri:
+                    # get the triangle edge that shares this edge
+                    conn_i = tris_by_edges.get(edges[i])
+                    if conn_i is not None:
                         # Some triangle shares this edge, so add it
-                        # to this triangle as one of its siblings and
-                        # add this triangle to it as one of its siblings
-                        tri[4+i] = conn_tri
-                        conn_tri[conn_tri.index(edges[i][::-1])-3] = tri
+                        # to this triangle as one of its neighbors and
+                        # add this triangle to it as one of its neighbors
+                        neighbors[tri_i + i] = conn_i//3
+                        neighbors[conn_i] = tri_i//3
+
+                    # neighbor edges are travelled in reverse. if the
+                    # edge is repeated, neighbors connect to the first.
+                    tris_by_edges[rev_edges[i]] = tri_i + edges.index(edges[i])
 
-                    # neighbor edges are travelled in reverse.
-                    t_by_e[edges[i][::-1]] = tri
+            # strips are started from the triangles in the order their
+            # edges were first seen, using the last triangle on each edge
+            self.all_start_tris[tex_index] = [i//3 for i in tris_by_edges.values()]
 
     def make_strips(self):
         '''Takes all loaded triangles and
         creates triangle strips out of them.'''
-        all_tris_by_edges = self.all_tris_by_edges
+        all_start_tris = self.all_start_tris
 
         '''loop over all meshes by texture'''
-        for tex_index in all_tris_by_edges:
-            tris = all_tris_by_edges[tex_index]
+        for tex_index in all_start_tris:
+            start_tris = all_start_tris[tex_index]
             self.all_face_dirs[tex_index] = face_dirs = []
             self.all_strips[tex_index] = strips = []
             self.all_degens[tex_index] = degens = []
 
             tri_count = self.tri_counts[tex_index]
-            edges = list(tris.keys())
+
+            # the triangle and neighbor tables, and flags for whether
+            # each triangle is added to a strip or has been seen
+            self._tri_verts     = self.all_tri_verts[tex_index]
+            self._tri_neighbors = self.all_tri_neighbors[tex_index]
+            self._tris_added    = added = bytearray(tri_count)
+            self._tris_seen     = array("L", [0])*tri_count
+            self._seen_id       = 0
+
+            # flag which triangles have duplicates, as only
+            # they need to be compared to find neighbor edges
+            tri_verts  = self._tri_verts
+            tri_keys   = list(zip(tri_verts[0::3], tri_verts[1::3], tri_verts[2::3]))
+            self._tris_duplicated = duplicated = bytearray(tri_count)
+            if len(set(tri_keys)) < tri_count:
+                key_counts = Counter(tri_keys)
+                for i in range(tri_count):
+                    duplicated[i] = key_counts[tri_keys[i]] > 1
+
+            neighbors = self._tri_neighbors
+            by_valence = (self.start_order == START_ORDER_VALENCE)
+            if by_valence:
+                # start from the triangles with the fewest neighbors
+                # first, as they're the hardest to fit into strips
+                start_tris = sorted(
+                    range(tri_count), key=lambda tri: (
+                        (neighbors[3*tri]     >= 0) +
+                        (neighbors[3*tri + 1] >= 0) +
+                        (neighbors[3*tri + 2] >= 0)
+                        ))
 
             tris_added = 0
-            e_i = 0
+            s_i = 0
+            next_tri = -1
 
             '''create triangle strips for this mesh'''
             while tri_count > tris_added:
                 # get the first triangle in the strip
-                tri_0 = tris[edges[e_i]]
-                e_i += 1
+                if next_tri >= 0:
+                    tri_0, next_tri = next_tri, -1
+                else:
+                    tri_0 = start_tris[s_i]
+                    s_i += 1
 
                 # if the triangle has already been added
-                if tri_0[3]:
+                if added[tri_0]:
                     continue
 
                 # calculate the 3 different possible strips
-                s0, _ = self.calc_strip(tri_0, 0, 0)
-                s1, _ = self.calc_strip(tri_0, 1, 0)
-                s2, _ = self.calc_strip(tri_0, 2, 0)
+                self._compared_duplicates = False
+                s0 = self._calc_strip(tri_0, 0, 0)
+                s1 = self._calc_strip(tri_0, 1, 0)
+                s2 = self._calc_strip(tri_0, 2, 0)
 
-                lens = (len(s0), len(s1), len(s2))
+                lens = (len(s0[0]), len(s1[0]), len(s2[0]))
+                best = lens.index(max(lens))
 
                 # use only the largest strip
-                # Need to re-run the function so it can also
-                # flag the triangles in the strip as bring added
-                strip, rev = self.calc_strip(tri_0, lens.index(max(lens)), 1)
+                if self._compared_duplicates:
+                    # flagging triangles as added can change how duplicate
+                    # triangles compare, so re-run the function so it can
+                    # flag the triangles in the strip as being added
+                    strip, rev, strip_tris = self._calc_strip(tri_0, best, 1)
+                else:
+                    # the strip will be the same, so just flag its triangles
+                    strip, rev, strip_tris = (s0, s1, s2)[best]
+                    for tri in strip_tris:
+                        added[tri] = 1
 
                 face_dirs.append(rev)
                 strips.append(strip)
                 degens.append([])
 
                 tris_added += len(strip) - 2
+
+                if by_valence:
+                    next_tri = self._next_local_tri(strip_tris)
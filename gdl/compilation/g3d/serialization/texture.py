@@ -1,17 +1,22 @@
 import hashlib
 import math
 import numpy
+import os
 import struct
-import scipy
 
 from array import array
 from copy import deepcopy
 from traceback import format_exc
+from .... import telemetry
 from .. import util
 from . import arbytmap_ext as arbytmap
 from . import texture_conversions as tex_conv
 from . import constants as c
 from . import ncc
+from . import palette_quantizer
+
+# must be a multiple of every pixel and palette entry size
+EXPORT_CHUNK_SIZE = 0x4000
 
 ROMTEX_HEADER_STRUCT = struct.Struct('<HH 4x bBbB 4x 16s')
 #   width
@@ -99,50 +104,58 @@ class G3DTexture:
         return arby_format, channel_count
 
     @staticmethod
-    def palettize_textures(textures, max_palette_size=256, min_palette_size=None):
+    def _texture_to_numpy(texture):
+        stride = texture.itemsize if isinstance(texture, array) else 1
+
+        # reshaping the pixels matrix
+        return numpy.reshape(
+            numpy.frombuffer(texture, dtype="B"),
+            ((len(texture) * stride) // 4, 4)
+            ).astype(float)
+
+    @staticmethod
+    def calculate_palette(texture, max_palette_size=256, quantizer=None):
+        np_texture = G3DTexture._texture_to_numpy(texture)
+        if len(np_texture) <= max_palette_size:
+            # entire texture will fit in palette
+            return np_texture
+
+        # convert to a UInt32 array to group for set comparison.
+        unique_pixels = set(array("I", np_texture.astype("B").tobytes()))
+        if len(unique_pixels) <= max_palette_size:
+            return numpy.reshape(
+                # convert back to byte buffer for reshaping
+                numpy.frombuffer(array("I", unique_pixels).tobytes(), dtype="B"),
+                (len(unique_pixels), 4)
+                ).astype(float)
+
+        # NOTE: it appears that kmeans doesn't work too well if
+        #       the original image was already palettized and/or
+        #       contains exactly as many colors as is necessary.
+        #       It appears to reduce the color count a bit too
+        #       far, so we'll ONLY quantize if the image contains
+        #       more unique colors than fit inside the max size.
+        return palette_quantizer.quantize(np_texture, max_palette_size, quantizer)
+
+    @staticmethod
+    def palettize_textures(textures, max_palette_size=256, min_palette_size=None,
+                           quantizer=None, np_palette=None):
         if min_palette_size is None:
             min_palette_size = max_palette_size
 
-        np_palette = None
         indexings = []
 
         for texture in textures:
-            stride = texture.itemsize if isinstance(texture, array) else 1
-
-            # reshaping the pixels matrix
-            np_texture = numpy.reshape(
-                numpy.frombuffer(texture, dtype="B"),
-                ((len(texture) * stride) // 4, 4)
-                ).astype(float)
+            np_texture = G3DTexture._texture_to_numpy(texture)
 
             # palette calculation
             if np_palette is None:
-                # calculate palette
-                if len(np_texture) <= max_palette_size:
-                    # entire texture will fit in palette
-                    np_palette = np_texture
-                else:
-                    # convert to a UInt32 array to group for set comparison.
-                    unique_pixels = set(array("I", np_texture.astype("B").tobytes()))
-                    if len(unique_pixels) <= max_palette_size:
-                        np_palette = numpy.reshape(
-                            # convert back to byte buffer for reshaping
-                            numpy.frombuffer(array("I", unique_pixels).tobytes(), dtype="B"),
-                            (len(unique_pixels), 4)
-                            ).astype(float)
-                    else:
-                        # NOTE: it appears that kmeans doesn't work too well if
-                        #       the original image was already palettized and/or
-                        #       contains exactly as many colors as is necessary.
-                        #       It appears to reduce the color count a bit too
-                        #       far, so we'll ONLY use it if the image contains
-                        #       more unique colors than fit inside the max size.
-                        np_palette, _ = scipy.cluster.vq.kmeans(
-                            np_texture, max_palette_size
-                            )
+                np_palette = G3DTexture.calculate_palette(
+                    texture, max_palette_size, quantizer
+                    )
 
             # indexing calculation
-            np_indexing, _ = scipy.cluster.vq.vq(
+            np_indexing = palette_quantizer.nearest_palette_indices(
                 np_texture, np_palette
                 )
             indexing = np_indexing.astype("B").tobytes()
@@ -154,19 +167,38 @@ class G3DTexture:
 
         return palette, indexings, palette_count
 
-    def import_asset(self, input_filepath, optimize_format=False, **kwargs):
-        arby = arbytmap.Arbytmap()
-        arby.load_from_file(input_path=input_filepath)
-        if arby.width not in c.VALID_DIMS or arby.height not in c.VALID_DIMS:
-            raise ValueError("Invalid dimensions: %sx%s" % (arby.width, arby.height))
+    def import_asset(self, input_filepath, optimize_format=False,
+                     source_cache=None, **kwargs):
+        '''
+        source_cache is an optional dict used to share work between imports
+        of the same asset to different formats/platforms. The decoded image
+        is shared by all imports, while the generated mipmaps and palette
+        are shared by imports that unpack to the same arbytmap format.
+        '''
+        if source_cache is None:
+            source_cache = {}
+
+        if "source" not in source_cache:
+            arby = arbytmap.Arbytmap()
+            with telemetry.measure("decode", input_size=os.path.getsize(input_filepath)):
+                arby.load_from_file(input_path=input_filepath)
+            source_cache["source"] = (arby.texture_block, arby.texture_info)
+
+        texture_block, texture_info = source_cache["source"]
+        width, height = texture_info.get("width", 1), texture_info.get("height", 1)
+        if width not in c.VALID_DIMS or height not in c.VALID_DIMS:
+            raise ValueError("Invalid dimensions: %sx%s" % (width, height))
 
+        source_md5         = kwargs.pop("source_md5", None)
+        quantizer          = kwargs.pop("quantizer", None)
+        palette_cache_dir  = kwargs.pop("palette_cache_dir", None)
         target_format_name = kwargs.pop("target_format_name", self.format_name)
         keep_alpha         = kwargs.pop("keep_alpha", "A" in target_format_name)
         max_mip_count      = max(0, min(
             c.MAX_MIP_COUNT,
             kwargs.get("mipmap_count", c.MAX_MIP_COUNT),
             # min dimension size is 8, which is 2^3, so subtract 3
-            int(math.ceil(math.log(max(1, min(arby.width, arby.height)), 2)) - 3)
+            int(math.ceil(math.log(max(1, min(width, height)), 2)) - 3)
             ))
 
         conv_settings = dict(
@@ -176,7 +208,7 @@ class G3DTexture:
             repack=False,
             )
 
-        source_channels = arbytmap.format_defs.CHANNEL_COUNTS[arby.format]
+        source_channels = arbytmap.format_defs.CHANNEL_COUNTS[texture_info["format"]]
         target_arby_format, target_channels = self.get_arby_format_and_channel_count(
             target_format_name, keep_alpha
             )
@@ -197,10 +229,24 @@ class G3DTexture:
             None
             )
 
-        arby.load_new_conversion_settings(**conv_settings)
+        conv_key = (
+            target_arby_format,
+            tuple(conv_settings.get("channel_merge_mapping", ()))
+            )
+        arby = source_cache.get(conv_key)
+        if arby is None:
+            # copy the decoded image, as unpacking may modify it
+            arby = arbytmap.Arbytmap()
+            arby.load_new_texture(
+                texture_block=deepcopy(texture_block),
+                texture_info=deepcopy(texture_info)
+                )
+            arby.load_new_conversion_settings(**conv_settings)
 
-        arby.unpack_all()  # unpack to depalettize
-        arby.generate_mipmaps()
+            with telemetry.measure("mipmap"):
+                arby.unpack_all()  # unpack to depalettize
+                arby.generate_mipmaps()
+            source_cache[conv_key] = arby
 
         if (optimize_format and target_format_name in c.DEPAL_FMT_MAP and
             arby.width * arby.height <= (1 << indexing_size)):
@@ -220,10 +266,39 @@ class G3DTexture:
         #       and if so, does the alpha need to be halved or not.
 
         if indexing_size:
-            # palettize
-            palette, textures, palette_size = self.palettize_textures(
-                textures, 1 << indexing_size, 16 if optimize_format else None
-                )
+            # palettize. the palette is calculated from the first mipmap,
+            # so it can be shared with imports that use fewer mipmaps.
+            palette_key = (conv_key, indexing_size, bool(optimize_format), quantizer)
+            palettized  = source_cache.get(palette_key)
+            if palettized is None or len(palettized[1]) < len(textures):
+                np_palette = palette_filepath = None
+                if palette_cache_dir and source_md5:
+                    # palettes are cached by source hash so that they
+                    # don't need to be recalculated if only the target
+                    # platform or compile settings have changed.
+                    palette_filepath = palette_quantizer.get_palette_cache_filepath(
+                        palette_cache_dir, source_md5,
+                        conv_key, 1 << indexing_size, quantizer
+                        )
+                    np_palette = palette_quantizer.load_cached_palette(palette_filepath)
+
+                if np_palette is None:
+                    with telemetry.measure("palettize"):
+                        np_palette = self.calculate_palette(
+                            textures[0], 1 << indexing_size, quantizer
+                            )
+                    if palette_filepath:
+                        palette_quantizer.save_cached_palette(palette_filepath, np_palette)
+
+                with telemetry.measure("palettize"):
+                    palettized = self.palettize_textures(
+                        textures, 1 << indexing_size, 16 if optimize_format else None,
+                        np_palette=np_palette
+                        )
+                source_cache[palette_key] = palettized
+
+            palette, indexings, palette_size = palettized
+            textures = [bytearray(tex) for tex in indexings[:len(textures)]]
             # replace the indexing size in the format name with the recalculated
             # size determined from how many colors are in the palette. Do this
             # by cutting the name in half at the indexing size and replacing it
@@ -272,8 +347,11 @@ class G3DTexture:
         self.palette = palette
         self.textures = textures
 
-        with open(input_filepath, "rb") as f:
-            self.source_file_hash = hashlib.md5(f.read()).digest()
+        if source_md5 is None:
+            with open(input_filepath, "rb") as f:
+                source_md5 = hashlib.md5(f.read()).digest()
+
+        self.source_file_hash = source_md5
 
     def import_gtx(self, input_buffer, headerless=False, flags=0, source_md5=b'\x00'*16,
                    width=0, height=0, mipmaps=0, format_name="ABGR_8888", lod_k=0,
@@ -417,6 +495,45 @@ class G3DTexture:
             keep_alpha=self.has_alpha
             )
 
+    @staticmethod
+    def _iter_export_chunks(pixels, scratch, swizzle_map=None, swap_map=None,
+                            swap_table=None, rescale_table=None):
+        '''
+        Yields the pixels swizzled, swapped, and rescaled(in that order) in
+        chunks. Each step of a chunk writes to alternating scratch buffers,
+        so the source pixels are never copied or modified.
+        '''
+        pixels = numpy.frombuffer(pixels, dtype=numpy.uint8)
+        chunk_size = len(scratch[0])
+        for i in range(0, len(pixels), chunk_size):
+            front, back = scratch
+            if swizzle_map is None:
+                src = pixels[i: i + chunk_size]
+            else:
+                indices = swizzle_map[i: i + chunk_size]
+                src = front[: len(indices)]
+                numpy.take(pixels, indices, out=src, mode="clip")
+                front, back = back, front
+
+            if swap_map is not None:
+                dst, stride = front[: len(src)], len(swap_map)
+                numpy.take(src.reshape((-1, stride)), swap_map, axis=1,
+                           out=dst.reshape((-1, stride)), mode="clip")
+                src, front, back = dst, back, front
+            elif swap_table is not None:
+                dst = front[: len(src)]
+                numpy.take(swap_table, src.view(numpy.uint16),
+                           out=dst.view(numpy.uint16), mode="clip")
+                src, front, back = dst, back, front
+
+            if rescale_table is not None:
+                dst = front[: len(src) // 2]
+                numpy.take(rescale_table, src.view(numpy.uint16),
+                           out=dst, mode="clip")
+                src = dst
+
+            yield src
+
     def export_gtx(self, output_buffer, headerless=False,
                    target_ngc=False, target_ps2=False, target_arcade=False
                    ):
@@ -436,56 +553,70 @@ class G3DTexture:
                 self.source_file_hash
                 ))
 
-        palette  = deepcopy(self.palette)
-        textures = deepcopy(self.textures)
-
         palette_stride = c.PALETTE_SIZES.get(self.format_name, 0)
         pixel_stride   = c.PIXEL_SIZES.get(self.format_name, 0)
 
-        if palette:
-            palette = deepcopy(self.palette)
-            # if necessary, unshuffle the palette
-            if not target_ngc and self.format_name not in c.MONOCHROME_FORMATS:
-                arbytmap.gauntlet_ps2_palette_shuffle(palette, palette_stride)
+        palette = self.palette
+        if palette and not target_ngc and not is_monochrome:
+            # if necessary, unshuffle the palette. it's tiny, so copy it first
+            palette = bytearray(palette)
+            arbytmap.gauntlet_ps2_palette_shuffle(palette, palette_stride)
 
+        swap_map = swap_table = None
         itemsize = palette_stride if palette else (pixel_stride//8)
-        if target_ngc:
-            # swizzle the textures and byteswap colors for gamecube
-            textures = arbytmap.swizzle_ngc_gauntlet_textures(
-                textures, width=self.width, height=self.height,
-                bits_per_pixel=pixel_stride, unswizzle=False
-                )
-
-            if itemsize > 1:
-                swap_map = tuple(range(itemsize))[::-1]
-
-                # swap from little to big endian
-                for pixels in ([palette] if palette else textures):
-                    arbytmap.bitmap_io.swap_array_items(pixels, swap_map)
-
-        elif not is_monochrome and itemsize > 1:
+        if target_ngc and itemsize > 1:
+            # swap from little to big endian for gamecube
+            swap_map = tuple(range(itemsize))[::-1]
+        elif not target_ngc and not is_monochrome and itemsize == 2:
             # swap from BGRA to RGBA for ps2 and xbox
-            if palette:
-                tex_conv.channel_swap_bgra_rgba_array([palette], itemsize)
-            else:
-                tex_conv.channel_swap_bgra_rgba_array(textures, itemsize)
+            swap_table = numpy.frombuffer(
+                tex_conv.BYTESWAP_5551_ARGB_AND_ABGR, dtype=numpy.uint16
+                )
+        elif not target_ngc and not is_monochrome and itemsize == 4:
+            swap_map = (2, 1, 0, 3)  # swap red and blue, but leave green and alpha alone
 
         # hack for 4bpp palettized to unpad from 8bpp to 4bpp
+        rescale_table = None
         if pixel_stride < 8:
-            rescaler_4bpp = (
+            rescale_table = numpy.frombuffer(
                 tex_conv.INDEXING_8BPP_TO_4BPP if palette else
-                tex_conv.MONOCHROME_8BPP_TO_4BPP
+                tex_conv.MONOCHROME_8BPP_TO_4BPP, dtype=numpy.uint8
                 )
-            textures = [
-                tex_conv.rescale_8bit_array_to_4bit(texture, rescaler_4bpp)
-                for texture in textures
-                ]
+
+        # every mip is transformed through these two scratch buffers a chunk
+        # at a time, so the source mips are never copied or modified
+        scratch = (
+            numpy.empty(EXPORT_CHUNK_SIZE, dtype=numpy.uint8),
+            numpy.empty(EXPORT_CHUNK_SIZE, dtype=numpy.uint8),
+            )
 
         if palette:
-            output_buffer.write(palette)
+            for chunk in self._iter_export_chunks(
+                    palette, scratch, swap_map=swap_map, swap_table=swap_table
+                    ):
+                output_buffer.write(chunk)
+
+        width, height = self.width, self.height
+        for texture in self.textures:
+            swizzle_map = None
+            if target_ngc:
+                # swizzle the textures for gamecube
+                swizzle_map = numpy.frombuffer(
+                    arbytmap.get_ngc_gauntlet_swizzle_map(
+                        width, height, pixel_stride, unswizzle=False
+                        ), dtype=numpy.uint32
+                    )
 
-        for texture in textures:
-            output_buffer.write(texture)
+            for chunk in self._iter_export_chunks(
+                    texture, scratch, swizzle_map=swizzle_map,
+                    swap_map=(None if palette else swap_map),
+                    swap_table=(None if palette else swap_table),
+                    rescale_table=rescale_table,
+                    ):
+                output_buffer.write(chunk)
+
+            width  = (width + 1) // 2
+            height = (height + 1) // 2
 
         if target_ps2:
             output_buffer.write(b"\x00" * util.calculate_padding(
@@ -498,8 +629,7 @@ class G3DTexture:
         if self.format_name not in c.PIXEL_SIZES:
             raise ValueError("INVALID FORMAT: '%s'" % self.format_name)
 
-        # make copies to keep originals unaffected
-        palette, textures = deepcopy(self.palette), deepcopy(self.textures)
+        palette, textures = self.palette, self.textures
         mipmap_count = len(textures) - 1 if include_mipmaps else 0
         indexing_size = 8 if palette else None
 
@@ -522,7 +652,9 @@ class G3DTexture:
                     )
 
             palette_block *= mipmap_count + 1
-            texture_block[:] = textures[: mipmap_count + 1]
+            # copy only the indexing handed to arbytmap to keep originals
+            # unaffected. everything else is converted into new arrays
+            texture_block[:] = [tex[:] for tex in textures[: mipmap_count + 1]]
 
             if "IDX_4" in self.format_name:
                 if len(palette_block[0]) < 256:
@@ -4,33 +4,68 @@ from arbytmap import bitmap_io
 
 from . import ncc
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 INDEXING_4BPP_TO_8BPP = tuple(
      (i & 0xF) |      # isolate bits 1-4
     ((i & 0xF0) << 4) # isolate bits 5-8 and shift to 9-12
      for i in range(0x100)
     )
-INDEXING_8BPP_TO_4BPP = tuple(
-     (i & 0xF) |       # isolate bits 1-4
-    ((i & 0xF00) >> 4) # isolate bits 9-12 and shift to 5-8
-    for i in range(0x10000)
-    )
 MONOCHROME_4BPP_TO_8BPP = tuple(
      ((i & 0xF) * 17) |
     (((i >> 4)  * 17) << 8)
     for i in range(0x100)
     )
-MONOCHROME_8BPP_TO_4BPP = tuple(
-    int(round((i & 0xFF) / 17)) |
-    (int(round((i >> 8)  / 17)) << 4)
-    for i in range(0x10000)
-    )
-BYTESWAP_5551_ARGB_AND_ABGR = tuple(
-    (i & 0x83E0)         | # isolate alpha and green
-    ((i & 0x7C00) >> 10) | # isolate bits 10-15 and shift to 1-5
-    ((i & 0x1F)   << 10)   # isolate bits 1-5 and shift to 10-15
-    for i in range(0x10000)
-    )
+
+
+# NOTE: the 16bit lookup tables below are large, so rather than building
+#       them on import, they're built as typed arrays the first time
+#       they're accessed as module attributes(see __getattr__ below).
+#       inside this module, use _get_table to access them.
+def _build_indexing_8bpp_to_4bpp():
+    if numpy is not None:
+        i = numpy.arange(0x10000, dtype=numpy.uint16)
+        return _array_from_numpy("B", (i & 0xF) | ((i & 0xF00) >> 4))
+
+    return array("B", (
+         (i & 0xF) |       # isolate bits 1-4
+        ((i & 0xF00) >> 4) # isolate bits 9-12 and shift to 5-8
+        for i in range(0x10000)
+        ))
+
+
+def _build_monochrome_8bpp_to_4bpp():
+    if numpy is not None:
+        i = numpy.arange(0x10000, dtype=numpy.uint16)
+        return _array_from_numpy("B",
+            numpy.rint((i & 0xFF) / 17).astype(numpy.uint8) |
+            (numpy.rint((i >> 8) / 17).astype(numpy.uint8) << 4)
+            )
+
+    return array("B", (
+        int(round((i & 0xFF) / 17)) |
+        (int(round((i >> 8)  / 17)) << 4)
+        for i in range(0x10000)
+        ))
+
+
+def _build_byteswap_5551_argb_and_abgr():
+    if numpy is not None:
+        i = numpy.arange(0x10000, dtype=numpy.uint16)
+        return _array_from_numpy("H",
+            (i & 0x83E0) | ((i & 0x7C00) >> 10) | ((i & 0x1F) << 10)
+            )
+
+    return array("H", (
+        (i & 0x83E0)         | # isolate alpha and green
+        ((i & 0x7C00) >> 10) | # isolate bits 10-15 and shift to 1-5
+        ((i & 0x1F)   << 10)   # isolate bits 1-5 and shift to 10-15
+        for i in range(0x10000)
+        ))
 
 
 def _upscale(src_depth, dst_depth, val, max_val=None):
@@ -82,6 +117,46 @@ def _ayiq_8422_to_argb_8888(ayiq_8422, ncc_table):
     return rgb_888 | (((ayiq_8422 >> 8) & 0xFF) << 24)
 
 
+def _rgb_888_to_yiq_422_array(r, g, b, ncc_table):
+    # there's no numpy version of the yiq conversion, so convert each
+    # unique color with the scalar one and map the results to the pixels
+    rgb = (r.astype(numpy.uint32) << 16) | (g.astype(numpy.uint32) << 8) | b
+    colors, color_indices = numpy.unique(rgb, return_inverse=True)
+    yiq = numpy.array([
+        _rgb_888_to_yiq_422(c >> 16, (c >> 8) & 0xFF, c & 0xFF, ncc_table)
+        for c in colors.tolist()
+        ], dtype=numpy.uint16).reshape((-1, 3))[color_indices.reshape(-1)]
+    return yiq[:, 0], yiq[:, 1], yiq[:, 2]
+
+
+def _yiq_422_to_rgb_888_table(ncc_table):
+    # there are only 256 possible yiq values, so convert them all once
+    return numpy.array(
+        [_yiq_422_to_rgb_888(i, ncc_table) for i in range(256)],
+        dtype=numpy.uint32
+        )
+
+
+def _argb_8888_channels(source_pixels):
+    # splits packed/unpacked A8R8G8B8 bytes into arrays of each channel
+    pixels = numpy.frombuffer(
+        source_pixels, dtype=numpy.uint8, count=(len(source_pixels)//4)*4
+        ).reshape((-1, 4)).astype(numpy.uint16)
+    return pixels[:, 0], pixels[:, 1], pixels[:, 2], pixels[:, 3]
+
+
+def _array_from_numpy(typecode, np_array):
+    return array(typecode, np_array.astype(typecode).tobytes())
+
+
+def _numpy_from_array(source_pixels, typecode):
+    # arrays are read by item, while anything else is read as typecode
+    if isinstance(source_pixels, array):
+        typecode = source_pixels.typecode
+
+    return numpy.frombuffer(source_pixels, dtype=typecode)
+
+
 # NOTE: we are doing some fucky stuff with the gamecube alpha values.
 #       we're intentionally unpacking it at half brightness to ensure
 #       assets are compatible between each platform(xbox/ps2/gamecube).
@@ -91,25 +166,69 @@ def _3Ato8(val): return _upscale(3, 8, val, 128)
 def _4to8(val):  return _upscale(4, 8, val)
 def _5to8(val):  return _upscale(5, 8, val)
 
-# used to quickly convert from gamecube format to A8R8G8B8
-UPSCALE_3555_TO_8888 = tuple(
-    (
-        _5to8(i&0x1F) | (_5to8((i>>5)&0x1F)<<8) | (_5to8((i>>10)&0x1F)<<16) | (0x80<<24)
-        if i & 0x8000 else
-        _4to8(i&0xF)  | (_4to8((i>>4)&0xF)<<8)  | (_4to8((i>>8)&0xF)<<16)   | (_3Ato8(i>>12)<<24)
-     )
-    for i in range(0x10000)
+
+def _build_upscale_3555_to_8888():
+    # used to quickly convert from gamecube format to A8R8G8B8
+    if numpy is not None:
+        i = numpy.arange(0x10000, dtype=numpy.uint32)
+        def upscale(src_depth, dst_depth, val, max_val=None):
+            if max_val is None:
+                max_val = 2**dst_depth - 1
+
+            scale = max_val / (2**src_depth - 1)
+            return numpy.minimum(max_val, (val * scale + 0.5).astype(numpy.uint32))
+
+        return _array_from_numpy("I", numpy.where(
+            i & 0x8000,
+            upscale(5, 8, i&0x1F) | (upscale(5, 8, (i>>5)&0x1F)<<8) |
+            (upscale(5, 8, (i>>10)&0x1F)<<16) | (0x80<<24),
+            upscale(4, 8, i&0xF)  | (upscale(4, 8, (i>>4)&0xF)<<8)  |
+            (upscale(4, 8, (i>>8)&0xF)<<16)   | (upscale(3, 8, i>>12, 128)<<24),
+            ))
+
+    return array("I", (
+        (
+            _5to8(i&0x1F) | (_5to8((i>>5)&0x1F)<<8) | (_5to8((i>>10)&0x1F)<<16) | (0x80<<24)
+            if i & 0x8000 else
+            _4to8(i&0xF)  | (_4to8((i>>4)&0xF)<<8)  | (_4to8((i>>8)&0xF)<<16)   | (_3Ato8(i>>12)<<24)
+         )
+        for i in range(0x10000)
+        ))
+
+
+_TABLE_BUILDERS = dict(
+    INDEXING_8BPP_TO_4BPP=_build_indexing_8bpp_to_4bpp,
+    MONOCHROME_8BPP_TO_4BPP=_build_monochrome_8bpp_to_4bpp,
+    BYTESWAP_5551_ARGB_AND_ABGR=_build_byteswap_5551_argb_and_abgr,
+    UPSCALE_3555_TO_8888=_build_upscale_3555_to_8888,
     )
+
+
+def _get_table(name):
+    table = globals().get(name)
+    if table is None:
+        table = globals()[name] = _TABLE_BUILDERS[name]()
+
+    return table
+
+
+def __getattr__(name):
+    if name in _TABLE_BUILDERS:
+        return _get_table(name)
+
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
 # used to quickly convert to gamecube format from A8R8G8B8
 DOWNSCALE_8_TO_3A = tuple(min(int((i / 128)*7  + 0.5), 7) for i in range(256))
 DOWNSCALE_8_TO_4  = tuple(int((i / 255)*15 + 0.5) for i in range(256))
 DOWNSCALE_8_TO_5  = tuple(int((i / 255)*31 + 0.5) for i in range(256))
 
-# these are just for the above calculation
-del _upscale
-del _3Ato8
-del _4to8
-del _5to8
+if numpy is not None:
+    # numpy copies of the above for vectorized lookups
+    _DOWNSCALE_8_TO_3A = numpy.array(DOWNSCALE_8_TO_3A, dtype=numpy.uint16)
+    _DOWNSCALE_8_TO_4  = numpy.array(DOWNSCALE_8_TO_4,  dtype=numpy.uint16)
+    _DOWNSCALE_8_TO_5  = numpy.array(DOWNSCALE_8_TO_5,  dtype=numpy.uint16)
 
 
 #############################################################
@@ -121,10 +240,20 @@ def channel_swap_bgra_rgba_array(all_pixels, pixel_stride):
     for orig_pixels in all_pixels:
         pixels = bytearray(orig_pixels) if isinstance(orig_pixels, array) else orig_pixels
 
-        if pixel_stride == 2:
+        if pixel_stride == 2 and numpy is not None:
+            # swap the red and blue bits and leave green and alpha alone
+            uint16_pixels = numpy.frombuffer(pixels, dtype=numpy.uint16)
+            pixels[:] = (
+                (uint16_pixels & 0x83E0) |
+                ((uint16_pixels & 0x7C00) >> 10) |
+                ((uint16_pixels & 0x1F) << 10)
+                ).tobytes()
+        elif pixel_stride == 2:
             # use a mapping to quickly swap 16 bit pixels
             uint16_pixels = array("H", pixels)
-            swapped_pixels = map(BYTESWAP_5551_ARGB_AND_ABGR.__getitem__, uint16_pixels)
+            swapped_pixels = map(
+                _get_table("BYTESWAP_5551_ARGB_AND_ABGR").__getitem__, uint16_pixels
+                )
             pixels[:] = bytearray(array("H", swapped_pixels))
         elif pixel_stride == 4:
             # use arbytmap to quickly swap 32bit pixels
@@ -136,6 +265,10 @@ def channel_swap_bgra_rgba_array(all_pixels, pixel_stride):
 
 
 def rescale_4bit_array_to_8bit(texture, rescale_list):
+    if numpy is not None:
+        rescale_table = numpy.asarray(rescale_list, dtype=numpy.uint16)
+        return bytearray(rescale_table[_numpy_from_array(texture, "B")].tobytes())
+
     return bytearray(array("H", map(rescale_list.__getitem__, texture)))
 
 
@@ -143,6 +276,10 @@ def rescale_8bit_array_to_4bit(texture, rescale_list):
     # NOTE: When downscaling indexing, this will break if the
     #       index value is ever higher than 15. It will take only
     #       the lower 4 bits from each byte, igoring the upper 4.
+    if numpy is not None:
+        rescale_table = numpy.asarray(rescale_list, dtype=numpy.uint8)
+        return bytearray(rescale_table[_numpy_from_array(texture, "H")].tobytes())
+
     return bytearray(map(rescale_list.__getitem__, array("H", texture)))
 
 
@@ -160,12 +297,17 @@ def argb_8888_to_ayiq_8422(source_pixels, ncc_table):
     if isinstance(source_pixels, array):
         source_pixels = source_pixels.tobytes()
 
+    if numpy is not None:
+        a, r, g, b = _argb_8888_channels(source_pixels)
+        y, i, q = _rgb_888_to_yiq_422_array(r, g, b, ncc_table)
+        return _array_from_numpy("H", q | (i << 2) | (y << 4) | (a << 8))
+
     packed_pixels = array("H", b'\x00\x00'*(len(source_pixels) // 4))
-    for i in range(len(source_pixels)//4):
-        a, r, g, b = source_pixels[i*4: i*4+4]
+    for p in range(len(source_pixels)//4):
+        a, r, g, b = source_pixels[p*4: p*4+4]
         y, i, q = _rgb_888_to_yiq_422(r, g, b, ncc_table)
 
-        packed_pixels[i] = q | (i << 2) | (y << 4) | (a << 8)
+        packed_pixels[p] = q | (i << 2) | (y << 4) | (a << 8)
 
     return array("H", packed_pixels)
 
@@ -175,18 +317,28 @@ def xrgb_8888_to_yiq_422(source_pixels, ncc_table):
     if isinstance(source_pixels, array):
         source_pixels = source_pixels.tobytes()
 
+    if numpy is not None:
+        _, r, g, b = _argb_8888_channels(source_pixels)
+        y, i, q = _rgb_888_to_yiq_422_array(r, g, b, ncc_table)
+        return _array_from_numpy("B", q | (i << 2) | (y << 4))
+
     packed_pixels = array("B", b'\x00'*(len(source_pixels) // 4))
-    for i in range(len(source_pixels)//4):
-        _, r, g, b = source_pixels[i*4: i*4+4]
+    for p in range(len(source_pixels)//4):
+        _, r, g, b = source_pixels[p*4: p*4+4]
         y, i, q = _rgb_888_to_yiq_422(r, g, b, ncc_table)
 
-        packed_pixels[i] = q | (i << 2) | (y << 4)
+        packed_pixels[p] = q | (i << 2) | (y << 4)
 
     return array("B", packed_pixels)
 
 
 def ayiq_8422_to_argb_8888(source_pixels, ncc_table):
     # converts packed pixels to packed pixels
+    if numpy is not None:
+        pixels = _numpy_from_array(source_pixels, "H").astype(numpy.uint32)
+        rgb_888 = _yiq_422_to_rgb_888_table(ncc_table)[pixels & 0xFF]
+        return _array_from_numpy("I", rgb_888 | (((pixels >> 8) & 0xFF) << 24))
+
     if not isinstance(source_pixels, array):
         source_pixels = array("H", source_pixels)
 
@@ -195,6 +347,10 @@ def ayiq_8422_to_argb_8888(source_pixels, ncc_table):
 
 def yiq_422_to_xrgb_8888(source_pixels, ncc_table):
     # converts packed pixels to packed pixels
+    if numpy is not None:
+        pixels = _numpy_from_array(source_pixels, "B")
+        return _array_from_numpy("I", _yiq_422_to_rgb_888_table(ncc_table)[pixels])
+
     if not isinstance(source_pixels, array):
         source_pixels = array("B", source_pixels)
 
@@ -211,6 +367,28 @@ def argb_8888_to_3555(source_pixels, no_alpha=False):
     if isinstance(source_pixels, array):
         source_pixels = source_pixels.tobytes()
 
+    if numpy is not None:
+        a, r, g, b = _argb_8888_channels(source_pixels)
+        alpha = _DOWNSCALE_8_TO_3A[a]
+        opaque_pixels = (
+            _DOWNSCALE_8_TO_5[b] |
+            (_DOWNSCALE_8_TO_5[g] << 5) |
+            (_DOWNSCALE_8_TO_5[r] << 10) |
+            0x8000
+            )
+        if no_alpha:
+            return _array_from_numpy("H", opaque_pixels)
+
+        transparent_pixels = (
+            _DOWNSCALE_8_TO_4[b] |
+            (_DOWNSCALE_8_TO_4[g] << 4) |
+            (_DOWNSCALE_8_TO_4[r] << 8) |
+            (alpha << 12)
+            )
+        return _array_from_numpy("H", numpy.where(
+            alpha == DOWNSCALE_8_TO_3A[255], opaque_pixels, transparent_pixels
+            ))
+
     packed_pixels = array("H", b'\x00\x00'*(len(source_pixels) // 4))
     alpha_cutoff = DOWNSCALE_8_TO_3A[255]
     for i in range(len(source_pixels)//4):
@@ -238,7 +416,12 @@ def argb_8888_to_3555(source_pixels, no_alpha=False):
 
 def argb_3555_to_8888(source_pixels):
     # converts packed pixels to packed pixels
+    if numpy is not None:
+        pixels = _numpy_from_array(source_pixels, "H")
+        upscale_table = _numpy_from_array(_get_table("UPSCALE_3555_TO_8888"), "I")
+        return _array_from_numpy("I", upscale_table[pixels])
+
     if not isinstance(source_pixels, array):
         source_pixels = array("H", source_pixels)
 
-    return array("I", map(UPSCALE_3555_TO_8888.__getitem__, source_pixels))
+    return array("I", map(_get_table("UPSCALE_3555_TO_8888").__getitem__, source_pixels))
@@ -1,54 +1,85 @@
-import hashlib
 import math
 import os
 
 from traceback import format_exc
+from ... import telemetry
 from ..metadata import objects as objects_metadata
 from .serialization.texture import G3DTexture, ROMTEX_HEADER_STRUCT
 from .serialization import ncc
+from .serialization import palette_quantizer
+from . import build_manifest
 from . import constants as c
 from . import texture_buffer_packer
 from . import util
 
 
 def _compile_texture(kwargs):
+    with telemetry.asset(kwargs["name"], "texture"):
+        return _compile_texture_targets(kwargs)
+
+
+def _compile_texture_targets(kwargs):
     name           = kwargs.pop("name")
-    target_ngc     = kwargs.pop("target_ngc")
-    target_ps2     = kwargs.pop("target_ps2")
-    target_arcade  = kwargs.pop("target_arcade")
-    cache_filepath = kwargs.pop("cache_filepath")
     asset_filepath = kwargs.pop("asset_filepath")
-
-    if target_ngc and kwargs.get("target_format_name") in (c.PIX_FMT_ABGR_1555, c.PIX_FMT_XBGR_1555):
-        # MIDWAY HACK
-        kwargs["target_format_name"] = (
-            c.PIX_FMT_ABGR_3555_NGC if kwargs.get("keep_alpha") else
-            c.PIX_FMT_XBGR_3555_NGC
-            )
+    targets        = kwargs.pop("targets")
 
     print("Compiling texture: %s" % name)
-    g3d_texture = G3DTexture()
-    g3d_texture.import_asset(asset_filepath, **kwargs)
-    os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
-    with open(cache_filepath, "wb") as f:
-        g3d_texture.export_gtx(
-            f, target_ngc=target_ngc, target_ps2=target_ps2,
-            target_arcade=target_arcade
-            )
 
-    if "YIQ" not in g3d_texture.format_name:
-        return
+    # the source image is decoded once and shared by every target. compile
+    # the targets with the most mipmaps first so the palette can be shared
+    source_cache = {}
+    compiled_filepaths = []
+    for target_kwargs in sorted(targets, key=lambda t: -t["mipmap_count"]):
+        target_kwargs  = dict(kwargs, **target_kwargs)
+        target_ngc     = target_kwargs.pop("target_ngc")
+        target_ps2     = target_kwargs.pop("target_ps2")
+        target_arcade  = target_kwargs.pop("target_arcade")
+        cache_filepath = target_kwargs.pop("cache_filepath")
+        try:
+            if target_ngc and target_kwargs.get("target_format_name") in (
+                    c.PIX_FMT_ABGR_1555, c.PIX_FMT_XBGR_1555
+                    ):
+                # MIDWAY HACK
+                target_kwargs["target_format_name"] = (
+                    c.PIX_FMT_ABGR_3555_NGC if target_kwargs.get("keep_alpha") else
+                    c.PIX_FMT_XBGR_3555_NGC
+                    )
 
-    ncc_filepath = "%s.%s" % (
-        os.path.splitext(cache_filepath)[0], c.NCC_TABLE_CACHE_EXTENSION
-        )
-    # export ncc_table if format requires it
-    if not os.path.isfile(ncc_filepath) or overwrite:
-        with open(ncc_filepath, "wb+") as f:
-            f.write(g3d_texture.ncc_table.export_to_rawdata())
+            g3d_texture = G3DTexture()
+            g3d_texture.import_asset(
+                asset_filepath, source_cache=source_cache, **target_kwargs
+                )
+            os.makedirs(os.path.dirname(cache_filepath), exist_ok=True)
+            # the texture is encoded as it's written, so they're measured together
+            with open(cache_filepath, "wb") as f, telemetry.measure("encode") as record:
+                g3d_texture.export_gtx(
+                    f, target_ngc=target_ngc, target_ps2=target_ps2,
+                    target_arcade=target_arcade
+                    )
+                record["output_size"] = f.tell()
+
+            if "YIQ" in g3d_texture.format_name:
+                # export ncc_table since the format requires it
+                ncc_filepath = "%s.%s" % (
+                    os.path.splitext(cache_filepath)[0], c.NCC_TABLE_CACHE_EXTENSION
+                    )
+                with open(ncc_filepath, "wb+") as f:
+                    f.write(g3d_texture.ncc_table.export_to_rawdata())
+
+            compiled_filepaths.append(cache_filepath)
+        except Exception:
+            print(format_exc())
+            print("Could not compile texture: '%s'" % cache_filepath)
+
+    return compiled_filepaths
 
 
 def _decompile_texture(kwargs):
+    with telemetry.asset(kwargs["name"], "texture"):
+        _decompile_texture_asset(kwargs)
+
+
+def _decompile_texture_asset(kwargs):
     name = kwargs["name"]
     asset_type = kwargs["asset_type"]
     bitm_data = kwargs["bitm_data"]
@@ -57,27 +88,34 @@ def _decompile_texture(kwargs):
 
     print("Decompiling texture: %s" % name)
     g3d_texture = G3DTexture()
-    with open(kwargs["textures_filepath"], "rb") as f:
-        # go to the start of the palette/pixel data
-        f.seek(kwargs["tex_pointer"])
+    # the textures file is only opened once by each process running jobs
+    f = util.get_shared_job_file(kwargs["textures_filepath"])
+    # go to the start of the palette/pixel data
+    f.seek(kwargs["tex_pointer"])
+    with telemetry.measure("decode") as record:
         g3d_texture.import_gtx(
             input_buffer=f, headerless=True, **bitm_data
             )
+        record["input_size"] = f.tell() - kwargs["tex_pointer"]
 
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
     if asset_type not in c.TEXTURE_CACHE_EXTENSIONS:
-        g3d_texture.export_asset(
-            filepath, overwrite=overwrite,
-            include_mipmaps=kwargs["include_mipmaps"],
-            )
+        with telemetry.measure("write") as record:
+            g3d_texture.export_asset(
+                filepath, overwrite=overwrite,
+                include_mipmaps=kwargs["include_mipmaps"],
+                )
+            if os.path.isfile(filepath):
+                record["output_size"] = os.path.getsize(filepath)
         return
 
     if not os.path.isfile(filepath) or overwrite:
-        with open(filepath, "wb+") as f:
+        with open(filepath, "wb+") as f, telemetry.measure("write") as record:
             g3d_texture.export_gtx(
                 f, target_ngc=(asset_type == c.TEXTURE_CACHE_EXTENSION_NGC),
                 target_arcade=(asset_type == c.TEXTURE_CACHE_EXTENSION_ARC)
                 )
+            record["output_size"] = f.tell()
 
     if "YIQ" not in g3d_texture.format_name:
         return
@@ -94,29 +132,43 @@ def _decompile_texture(kwargs):
 def compile_textures(
         data_dir,
         force_recompile=False, optimize_format=False, parallel_processing=False,
-        target_ps2=False, target_ngc=False, target_xbox=False, target_arcade=False
+        target_ps2=False, target_ngc=False, target_xbox=False, target_arcade=False,
+        metadata_store=None, quantizer=c.DEFAULT_TEXTURE_QUANTIZER
         ):
     asset_folder    = os.path.join(data_dir, c.EXPORT_FOLDERNAME, c.TEX_FOLDERNAME)
     cache_path_base = os.path.join(data_dir, c.IMPORT_FOLDERNAME, c.TEX_FOLDERNAME)
+    palette_cache_dir = os.path.join(data_dir, c.IMPORT_FOLDERNAME, c.PAL_FOLDERNAME)
 
     # get the metadata for all bitmaps to import and
     # key it by name to allow matching to asset files
-    all_metadata = objects_metadata.compile_objects_metadata(data_dir)
+    all_metadata = objects_metadata.compile_objects_metadata(
+        data_dir, metadata_store=metadata_store
+        )
     bitmap_metadata = {
         m.get("name"): m
         for m in all_metadata.get("bitmaps", ())
         if isinstance(m, dict) and m.get("name")
         }
 
-    all_job_args = []
+    manifest = build_manifest.BuildManifest(data_dir)
+    manifest_args = {}
+
+    all_job_args = {}
     all_assets = util.locate_textures(os.path.join(asset_folder), cache_files=False)
 
-    asset_type = (
-        c.TEXTURE_CACHE_EXTENSION_PS2  if target_ps2 else
-        c.TEXTURE_CACHE_EXTENSION_NGC  if target_ngc else
-        c.TEXTURE_CACHE_EXTENSION_ARC  if target_arcade else
-        c.TEXTURE_CACHE_EXTENSION_XBOX
-        )
+    all_targets = []
+    for target_flag, asset_type in (
+            (target_ps2,    c.TEXTURE_CACHE_EXTENSION_PS2),
+            (target_ngc,    c.TEXTURE_CACHE_EXTENSION_NGC),
+            (target_xbox,   c.TEXTURE_CACHE_EXTENSION_XBOX),
+            (target_arcade, c.TEXTURE_CACHE_EXTENSION_ARC),
+            ):
+        if target_flag:
+            all_targets.append(asset_type)
+
+    if not all_targets:
+        all_targets.append(c.TEXTURE_CACHE_EXTENSION_XBOX)
+
     for name in sorted(all_assets):
         meta = bitmap_metadata.get(name)
         asset_filepath = all_assets[name]
@@ -124,80 +176,149 @@ def compile_textures(
             # texture isn't listed in metadata. don't compile it
             continue
 
-        try:
-            filename = os.path.splitext(os.path.relpath(asset_filepath, asset_folder))[0]
-            cache_filepath = os.path.join(cache_path_base, "%s.%s" % (filename, asset_type))
+        for asset_type in all_targets:
+            try:
+                with telemetry.asset(name, "texture"):
+                    _create_texture_compile_job(
+                        name, meta, asset_filepath, asset_type, asset_folder,
+                        cache_path_base, manifest, manifest_args, all_job_args,
+                        force_recompile, optimize_format, quantizer, palette_cache_dir
+                        )
+            except Exception:
+                print(format_exc())
+                print("Error: Could not create texture compilation job: '%s'" % asset_filepath)
 
-            source_md5 = b'\x00'*16
-            gtx_cached_md5 = b''
-            with open(asset_filepath, "rb") as f:
-                source_md5 = hashlib.md5(f.read()).digest()
+    all_job_args = list(all_job_args.values())
+    print("Compiling %s textures to %s in %s" % (
+        len(all_job_args), "/".join(all_targets),
+        "parallel" if parallel_processing else "series"
+        ))
+    def record_compiled_texture(job_args, compiled_filepaths):
+        # record what each successfully compiled texture was built from
+        for cache_filepath in compiled_filepaths:
+            if cache_filepath in manifest_args:
+                manifest.record_asset(*manifest_args[cache_filepath])
+
+    # start the largest textures first, so one isn't left compiling alone
+    costs = [
+        util.get_file_cost(job_args["asset_filepath"]) * len(job_args["targets"])
+        for job_args in all_job_args
+        ]
+    util.process_jobs(
+        _compile_texture, all_job_args,
+        process_count=None if parallel_processing else 1,
+        costs=costs, callback=record_compiled_texture, raise_errors=False
+        )
 
-            if os.path.isfile(cache_filepath):                
-                with open(cache_filepath, "rb") as f:
-                    data = f.read(ROMTEX_HEADER_STRUCT.size)
+    manifest.save()
 
-                if len(data) >= ROMTEX_HEADER_STRUCT.size:
-                    gtx_cached_md5 = ROMTEX_HEADER_STRUCT.unpack(data)[6]
+    # palettes are cached by source md5, so once a source has changed
+    # its old palettes are never used again. don't let them pile up
+    palette_quantizer.prune_palette_cache(
+        palette_cache_dir, manifest.get_source_md5s()
+        )
 
-            if gtx_cached_md5 == source_md5 and not force_recompile:
-                # original asset file; don't recompile
-                continue
 
-            target_format = meta.get("format", c.DEFAULT_FORMAT_NAME)
-            has_alpha     = meta.get("flags", {}).get("has_alpha")
-            new_format    = target_format
-
-            # do some format swapping depending on the target platform
-            if target_ngc:
-                # retarget to the format replacements gamecube uses
-                if target_format in (c.PIX_FMT_ABGR_8888, c.PIX_FMT_XBGR_8888):
-                    new_format = c.PIX_FMT_ABGR_3555_NGC if has_alpha else c.PIX_FMT_XBGR_3555_NGC
-                elif target_format in (c.PIX_FMT_ABGR_8888_IDX_4, c.PIX_FMT_XBGR_8888_IDX_4):
-                    new_format = c.PIX_FMT_ABGR_3555_IDX_4_NGC
-                elif target_format in (c.PIX_FMT_ABGR_8888_IDX_8, c.PIX_FMT_XBGR_8888_IDX_8):
-                    new_format = c.PIX_FMT_ABGR_3555_IDX_8_NGC
-            elif target_arcade:
-                # TODO: fill out the many format swaps
-                pass
-            else:
-                # target away from gamecube-exclusive formats
-                if target_format == c.PIX_FMT_XBGR_3555_NGC:
-                    new_format = c.PIX_FMT_ABGR_1555
-                elif target_format == c.PIX_FMT_ABGR_3555_NGC:
-                    new_format = c.PIX_FMT_ABGR_8888 if has_alpha else c.PIX_FMT_XBGR_8888
-                elif target_format == c.PIX_FMT_ABGR_3555_IDX_4_NGC:
-                    new_format = c.PIX_FMT_ABGR_8888_IDX_4
-                elif target_format == c.PIX_FMT_ABGR_3555_IDX_8_NGC:
-                    new_format = c.PIX_FMT_ABGR_8888_IDX_8
-
-            if new_format != target_format:
-                print(f"Retargeting {filename} from '{target_format}' to '{new_format}' to match platform.")
-                target_format = new_format
-
-            all_job_args.append(dict(
-                asset_filepath=asset_filepath, optimize_format=optimize_format,
-                mipmap_count=max(0, 0 if target_ngc else meta.get("mipmap_count", 0)),
-                name=name, cache_filepath=cache_filepath, target_format_name=target_format,
-                keep_alpha=(has_alpha or "A" in target_format),
-                target_ngc=target_ngc, target_ps2=target_ps2, target_arcade=target_arcade
-                ))
-        except Exception:
-            print(format_exc())
-            print("Error: Could not create texture compilation job: '%s'" % asset_filepath)
+def _create_texture_compile_job(
+        name, meta, asset_filepath, asset_type, asset_folder, cache_path_base,
+        manifest, manifest_args, all_job_args, force_recompile, optimize_format,
+        quantizer, palette_cache_dir
+        ):
+    target_ngc    = asset_type == c.TEXTURE_CACHE_EXTENSION_NGC
+    target_ps2    = asset_type == c.TEXTURE_CACHE_EXTENSION_PS2
+    target_arcade = asset_type == c.TEXTURE_CACHE_EXTENSION_ARC
+
+    filename = os.path.splitext(os.path.relpath(asset_filepath, asset_folder))[0]
+    cache_filepath = os.path.join(cache_path_base, "%s.%s" % (filename, asset_type))
+
+    target_format = meta.get("format", c.DEFAULT_FORMAT_NAME)
+    has_alpha     = meta.get("flags", {}).get("has_alpha")
+    new_format    = target_format
+
+    # do some format swapping depending on the target platform
+    if target_ngc:
+        # retarget to the format replacements gamecube uses
+        if target_format in (c.PIX_FMT_ABGR_8888, c.PIX_FMT_XBGR_8888):
+            new_format = c.PIX_FMT_ABGR_3555_NGC if has_alpha else c.PIX_FMT_XBGR_3555_NGC
+        elif target_format in (c.PIX_FMT_ABGR_8888_IDX_4, c.PIX_FMT_XBGR_8888_IDX_4):
+            new_format = c.PIX_FMT_ABGR_3555_IDX_4_NGC
+        elif target_format in (c.PIX_FMT_ABGR_8888_IDX_8, c.PIX_FMT_XBGR_8888_IDX_8):
+            new_format = c.PIX_FMT_ABGR_3555_IDX_8_NGC
+    elif target_arcade:
+        # TODO: fill out the many format swaps
+        pass
+    else:
+        # target away from gamecube-exclusive formats
+        if target_format == c.PIX_FMT_XBGR_3555_NGC:
+            new_format = c.PIX_FMT_ABGR_1555
+        elif target_format == c.PIX_FMT_ABGR_3555_NGC:
+            new_format = c.PIX_FMT_ABGR_8888 if has_alpha else c.PIX_FMT_XBGR_8888
+        elif target_format == c.PIX_FMT_ABGR_3555_IDX_4_NGC:
+            new_format = c.PIX_FMT_ABGR_8888_IDX_4
+        elif target_format == c.PIX_FMT_ABGR_3555_IDX_8_NGC:
+            new_format = c.PIX_FMT_ABGR_8888_IDX_8
+
+    # the options that affect the compiled texture. if any of
+    # these change, the texture must be recompiled.
+    compile_options = dict(
+        format=new_format, optimize_format=bool(optimize_format),
+        mipmap_count=max(0, 0 if target_ngc else meta.get("mipmap_count", 0)),
+        keep_alpha=bool(has_alpha or "A" in new_format),
+        )
+    if "IDX" in new_format:
+        compile_options.update(quantizer=quantizer)
 
-    print("Compiling %s textures in %s" % (
-        len(all_job_args), "parallel" if parallel_processing else "series"
-        ))
-    util.process_jobs(
-        _compile_texture, all_job_args,
-        process_count=None if parallel_processing else 1
+    source_md5 = manifest.get_source_md5(asset_type, asset_filepath)
+    up_to_date = manifest.is_up_to_date(
+        asset_type, asset_filepath, cache_filepath, source_md5, compile_options
         )
+    if not(up_to_date or manifest.get_record(asset_type, asset_filepath)):
+        # nothing recorded for this asset yet. fall
+        # back to the hash stored in the cache file
+        gtx_cached_md5 = b''
+        if os.path.isfile(cache_filepath):
+            with open(cache_filepath, "rb") as f:
+                data = f.read(ROMTEX_HEADER_STRUCT.size)
+
+            if len(data) >= ROMTEX_HEADER_STRUCT.size:
+                gtx_cached_md5 = ROMTEX_HEADER_STRUCT.unpack(data)[6]
+
+        up_to_date = (gtx_cached_md5 == source_md5)
+        if up_to_date:
+            manifest.record_asset(
+                asset_type, asset_filepath, cache_filepath,
+                source_md5, compile_options
+                )
+
+    if up_to_date and not force_recompile:
+        # original asset file; don't recompile
+        telemetry.record_skipped(name, "texture")
+        return
+
+    if new_format != target_format:
+        print(f"Retargeting {filename} from '{target_format}' to '{new_format}' to match platform.")
+
+    manifest_args[cache_filepath] = (
+        asset_type, asset_filepath, cache_filepath, source_md5, compile_options
+        )
+    # all targets of the same asset are compiled by the same job
+    job_args = all_job_args.setdefault(asset_filepath, dict(
+        asset_filepath=asset_filepath, name=name, source_md5=source_md5,
+        optimize_format=optimize_format, quantizer=quantizer,
+        palette_cache_dir=palette_cache_dir, targets=[]
+        ))
+    job_args["targets"].append(dict(
+        cache_filepath=cache_filepath, target_format_name=new_format,
+        mipmap_count=compile_options["mipmap_count"],
+        keep_alpha=compile_options["keep_alpha"],
+        target_ngc=target_ngc, target_ps2=target_ps2, target_arcade=target_arcade
+        ))
 
 
 def import_textures(
         objects_tag, data_dir, use_force_index_hack=False,
-        target_ngc=False, target_ps2=False, target_xbox=False, target_arcade=False
+        target_ngc=False, target_ps2=False, target_xbox=False, target_arcade=False,
+        metadata_store=None
         ):
     # locate and load all assets
     gtx_textures_by_name = {}
@@ -208,12 +329,15 @@ def import_textures(
         )
     for name in sorted(all_asset_filepaths):
         try:
-            with open(all_asset_filepaths[name], "rb") as f:
+            with telemetry.asset(name, "texture"),\
+                 telemetry.measure("read") as record,\
+                 open(all_asset_filepaths[name], "rb") as f:
                 name = name.upper()
                 gtx_textures_by_name[name] = G3DTexture()
                 gtx_textures_by_name[name].import_gtx(
                     f, is_ngc=target_ngc, is_arcade=target_arcade
                     )
+                record["input_size"] = f.tell()
         except Exception:
             print(format_exc())
             print("Could not load texture:\n    %s" % all_asset_filepaths[name])
@@ -225,7 +349,8 @@ def import_textures(
 
     # get the metadata for all bitmaps to import
     all_metadata = objects_metadata.compile_objects_metadata(
-        data_dir, by_asset_name=not use_force_index_hack
+        data_dir, by_asset_name=not use_force_index_hack,
+        metadata_store=metadata_store
         )
 
     # for returning to the caller for easy iteration
@@ -555,5 +680,9 @@ def decompile_textures(
         ))
     util.process_jobs(
         _decompile_texture, all_job_args,
-        process_count=None if parallel_processing else 1
+        process_count=None if parallel_processing else 1,
+        costs=lambda job_args: (
+            job_args["bitm_data"]["width"] * job_args["bitm_data"]["height"]
+            ),
+        raise_errors=False
         )
@@ -1,6 +1,7 @@
 import os
 from traceback import format_exc
 
+from .. import telemetry
 from ..defs.rom import rom_def, rom_arcade_def
 from .metadata import messages as metadata_comp
 from .util import get_is_arcade_wad
@@ -14,6 +15,9 @@ class MessagesCompiler:
     target_arcade   = False
 
     serialize_cache_files = True
+    # path to write a report of how long each file took to build to.
+    # json, or csv if it ends in .csv. empty means don't write one
+    telemetry_filepath = ""
     
     def __init__(self, **kwargs):
         # simple initialization setup where kwargs are
@@ -22,6 +26,14 @@ class MessagesCompiler:
             setattr(self, k, v)
 
     def compile(self):
+        with telemetry.report(self.telemetry_filepath):
+            return self._compile()
+
+    def decompile(self, **kwargs):
+        with telemetry.report(self.telemetry_filepath):
+            self._decompile(**kwargs)
+
+    def _compile(self):
         target_filenames = list(self.target_filenames)
         if not os.path.isdir(self.target_dir):
             return
@@ -34,7 +46,8 @@ class MessagesCompiler:
         for dirname in target_filenames:
             dirpath = os.path.join(self.target_dir, dirname)
             try:
-                metadata = metadata_comp.compile_messages_metadata(dirpath)
+                with telemetry.asset(dirname, "messages"), telemetry.measure("decode"):
+                    metadata = metadata_comp.compile_messages_metadata(dirpath)
 
                 if self.target_arcade:
                     rom_tag = rom_arcade_def.build()
@@ -46,7 +59,10 @@ class MessagesCompiler:
                 rom_tag.add_messages(metadata["messages"])
                 rom_tag.add_message_lists(metadata["message_lists"])
                 if self.serialize_cache_files:
-                    rom_tag.serialize(temp=False)
+                    with telemetry.asset(dirname, "messages"),\
+                         telemetry.measure("serialize") as record:
+                        rom_tag.serialize(temp=False)
+                        record["output_size"] = os.path.getsize(rom_tag.filepath)
 
                 rom_tags.append(rom_tag)
             except Exception:
@@ -54,7 +70,7 @@ class MessagesCompiler:
 
         return rom_tags
 
-    def decompile(self, **kwargs):
+    def _decompile(self, **kwargs):
         target_filenames = list(self.target_filenames)
         if not os.path.isdir(self.target_dir):
             return
@@ -68,18 +84,21 @@ class MessagesCompiler:
         for filename in target_filenames:
             filepath = os.path.join(self.target_dir, filename)
             try:
-                if get_is_arcade_wad(filepath):
-                    rom_tag = rom_arcade_def.build(filepath=filepath)
-                else:
-                    rom_tag = rom_def.build(filepath=filepath)
+                with telemetry.asset(filename, "messages"),\
+                     telemetry.measure("read", input_size=os.path.getsize(filepath)):
+                    if get_is_arcade_wad(filepath):
+                        rom_tag = rom_arcade_def.build(filepath=filepath)
+                    else:
+                        rom_tag = rom_def.build(filepath=filepath)
 
                 decompile_kwargs = dict(
                     overwrite=self.overwrite,
                     individual_meta=self.individual_meta
                     )
                 decompile_kwargs.update(kwargs)
-                metadata_comp.decompile_messages_metadata(
-                    rom_tag, os.path.splitext(filepath)[0], **decompile_kwargs
-                    )
+                with telemetry.asset(filename, "messages"), telemetry.measure("write"):
+                    metadata_comp.decompile_messages_metadata(
+                        rom_tag, os.path.splitext(filepath)[0], **decompile_kwargs
+                        )
             except Exception:
                 print(format_exc())
@@ -1,5 +1,9 @@
 from ..constants import *
 
+# binary snapshot of the parsed metadata files, stored in the assets
+# directory. must not use one of the METADATA_ASSET_EXTENSIONS
+METADATA_SNAPSHOT_FILENAME = "metadata.snapshot"
+
 
 OBJECT_FLAG_NAMES = (
     "tex2", "sharp", "blur", "chrome",
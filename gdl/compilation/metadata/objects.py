@@ -1,46 +1,157 @@
 import os
+import pickle
 
 from traceback import format_exc
 from . import constants as c
 from . import util
 
 
-def compile_objects_metadata(data_dir, by_asset_name=False):
-    all_assets = util.locate_metadata(data_dir)
-    meta_type_lists = {}
-    meta_type_seen  = {}
+class ObjectsMetadataStore:
+    '''
+    Parses each metadata file in a data directory once and serves the
+    combined metadata to everything that needs it during a compile.
+
+    The parsed files are kept in a binary snapshot in the data directory,
+    keyed by their size and mtime, so later runs only reparse the files
+    that changed. Every call to get_metadata returns a fresh copy, as the
+    callers modify the metadata dicts they're given.
+    '''
+    snapshot_version = 1
+
+    def __init__(self, data_dir, use_snapshot=True):
+        self.data_dir     = data_dir
+        self.use_snapshot = use_snapshot
+        self.snapshot_filepath = os.path.join(
+            data_dir, c.METADATA_SNAPSHOT_FILENAME
+            )
+        self._parsed_files   = {}
+        self._pickled_by_type = None
+
+    def _load_snapshot(self):
+        if not(self.use_snapshot and os.path.isfile(self.snapshot_filepath)):
+            return {}
 
-    for metadata_name in sorted(all_assets):
-        asset_filepath = all_assets[metadata_name]
         try:
-            metadata = util.load_metadata(asset_filepath)
-
-            for typ in metadata:
-                typ  = typ.lower()
-                lst  = meta_type_lists.setdefault(typ, [])
-                seen = meta_type_seen.setdefault(typ, set())
-                src_lst = metadata.get(typ, ())
-                for i in range(len(src_lst)):
-                    name = src_lst[i].get("name")
-                    if name in seen:
-                        print(f"Skipping duplicate {typ} name '{name}' in '{asset_filepath}'")
-                    else:
-                        lst.append(src_lst[i])
-                        seen.add(name)
+            with open(self.snapshot_filepath, "rb") as f:
+                snapshot = pickle.load(f)
 
+            if snapshot.get("version") == self.snapshot_version:
+                return snapshot["files"]
         except Exception:
             print(format_exc())
-            print(f"Could not load metadata file '{asset_filepath}'")
+            print(f"Warning: Could not load metadata snapshot '{self.snapshot_filepath}'")
 
-    if by_asset_name:
-        all_metadata = util.split_metadata_by_asset_name(
-            group_singletons=False,
-            metadata_by_type=meta_type_lists
-            )
-    else:
-        all_metadata = meta_type_lists
+        return {}
+
+    def _save_snapshot(self):
+        if not self.use_snapshot or not os.path.isdir(self.data_dir):
+            return
+
+        try:
+            temppath = self.snapshot_filepath + ".temp"
+            with open(temppath, "wb") as f:
+                pickle.dump(
+                    dict(version=self.snapshot_version, files=self._parsed_files),
+                    f, protocol=pickle.HIGHEST_PROTOCOL
+                    )
+
+            os.replace(temppath, self.snapshot_filepath)
+        except Exception:
+            print(format_exc())
+            print(f"Warning: Could not save metadata snapshot '{self.snapshot_filepath}'")
+
+    def refresh(self):
+        '''
+        Reparses any metadata files that were added or changed since the
+        last refresh. Unchanged files are only stat'd.
+        '''
+        all_assets = util.locate_metadata(self.data_dir)
+        if not self._parsed_files:
+            self._parsed_files = self._load_snapshot()
+
+        parsed_files = {}
+        changed = self._pickled_by_type is None
+        for metadata_name in sorted(all_assets):
+            asset_filepath = all_assets[metadata_name]
+            key  = os.path.relpath(asset_filepath, self.data_dir).replace("\\", "/")
+            stat = os.stat(asset_filepath)
+            file_stat = (stat.st_size, stat.st_mtime_ns)
+
+            parsed = self._parsed_files.get(key)
+            if parsed and parsed["stat"] == file_stat:
+                parsed_files[key] = parsed
+                continue
+
+            try:
+                metadata = util.load_metadata(asset_filepath)
+            except Exception:
+                print(format_exc())
+                print(f"Could not load metadata file '{asset_filepath}'")
+                metadata = None
+
+            parsed_files[key] = dict(
+                stat=file_stat, filepath=asset_filepath, metadata=metadata
+                )
+            changed = True
+
+        if changed or parsed_files.keys() != self._parsed_files.keys():
+            self._parsed_files = parsed_files
+            self._pickled_by_type = pickle.dumps(
+                self._combine_metadata(), protocol=pickle.HIGHEST_PROTOCOL
+                )
+            self._save_snapshot()
+
+    def _combine_metadata(self):
+        meta_type_lists = {}
+        meta_type_seen  = {}
+
+        # keys are sorted the same way the metadata filenames are located
+        for key in self._parsed_files:
+            asset_filepath = self._parsed_files[key]["filepath"]
+            metadata       = self._parsed_files[key]["metadata"]
+            if metadata is None:
+                continue
+
+            try:
+                for typ in metadata:
+                    typ  = typ.lower()
+                    lst  = meta_type_lists.setdefault(typ, [])
+                    seen = meta_type_seen.setdefault(typ, set())
+                    src_lst = metadata.get(typ, ())
+                    for i in range(len(src_lst)):
+                        name = src_lst[i].get("name")
+                        if name in seen:
+                            print(f"Skipping duplicate {typ} name '{name}' in '{asset_filepath}'")
+                        else:
+                            lst.append(src_lst[i])
+                            seen.add(name)
+
+            except Exception:
+                print(format_exc())
+                print(f"Could not load metadata file '{asset_filepath}'")
+
+        return meta_type_lists
+
+    def get_metadata(self, by_asset_name=False):
+        if self._pickled_by_type is None:
+            self.refresh()
+
+        # return a copy so callers can't modify what we hand out later
+        meta_type_lists = pickle.loads(self._pickled_by_type)
+        if by_asset_name:
+            return util.split_metadata_by_asset_name(
+                group_singletons=False,
+                metadata_by_type=meta_type_lists
+                )
+
+        return meta_type_lists
+
+
+def compile_objects_metadata(data_dir, by_asset_name=False, metadata_store=None):
+    if metadata_store is None:
+        metadata_store = ObjectsMetadataStore(data_dir)
 
-    return all_metadata
+    return metadata_store.get_metadata(by_asset_name=by_asset_name)
 
 
 def decompile_objects_metadata(
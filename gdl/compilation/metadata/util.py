@@ -5,6 +5,12 @@ import yaml
 from . import constants as c
 from ..util import *
 
+try:
+    # libyaml's loader is many times faster than the pure python one
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 
 def locate_metadata(data_dir):
     return locate_assets(data_dir, c.METADATA_ASSET_EXTENSIONS)
@@ -14,7 +20,7 @@ def load_metadata(filepath):
     asset_type = os.path.splitext(filepath)[-1].strip(".").lower()
     if asset_type in ("yaml", "yml"):
         with open(filepath) as f:
-            metadata = yaml.safe_load(f)
+            metadata = yaml.load(f, Loader=SafeLoader)
     elif asset_type == "json":
         with open(filepath) as f:
             metadata = json.load(f)
@@ -1,10 +1,12 @@
 import os
 
+from .. import telemetry
 from ..defs.objects import objects_ps2_def
 from .g3d import cache as cache_comp
 from .g3d import model as model_comp
 from .g3d import texture as texture_comp
 from .g3d import constants as c
+from .metadata import objects as objects_metadata
 
 class ObjectsCompiler:
     target_dir = "."
@@ -19,6 +21,9 @@ class ObjectsCompiler:
     use_force_index_hack = True
     optimize_models      = True
     optimize_textures    = True
+    optimize_vertex_cache = False
+    vertex_cache_size    = c.DEFAULT_VERTEX_CACHE_SIZE
+    texture_quantizer    = c.DEFAULT_TEXTURE_QUANTIZER
     force_recompile      = False
     swap_lightmap_and_diffuse = False  # debug feature
 
@@ -28,14 +33,46 @@ class ObjectsCompiler:
     serialize_cache_files = True
     build_anim_cache = True
     build_texdef_cache = True
-    
+
+    # path to write a report of how long each asset took to build to.
+    # json, or csv if it ends in .csv. empty means don't write one
+    telemetry_filepath = ""
+
+    _metadata_store = None
+
     def __init__(self, **kwargs):
         # simple initialization setup where kwargs are
         # copied into the attributes of this new class
         for k, v in kwargs.items():
             setattr(self, k, v)
 
+    def get_metadata_store(self):
+        # metadata is shared between every compile step and target, so
+        # it only needs to be parsed once(or not at all if unchanged)
+        asset_dir = os.path.join(self.target_dir, c.DATA_FOLDERNAME)
+        if getattr(self._metadata_store, "data_dir", None) != asset_dir:
+            self._metadata_store = objects_metadata.ObjectsMetadataStore(asset_dir)
+
+        self._metadata_store.refresh()
+        return self._metadata_store
+
     def compile_textures(self):
+        with telemetry.report(self.telemetry_filepath):
+            self._compile_textures()
+
+    def compile_models(self):
+        with telemetry.report(self.telemetry_filepath):
+            self._compile_models()
+
+    def compile(self):
+        with telemetry.report(self.telemetry_filepath):
+            return self._compile()
+
+    def decompile(self, **kwargs):
+        with telemetry.report(self.telemetry_filepath):
+            self._decompile(**kwargs)
+
+    def _compile_textures(self):
         asset_dir = os.path.join(self.target_dir, c.DATA_FOLDERNAME)
         if not os.path.isdir(asset_dir):
             return
@@ -47,20 +84,17 @@ class ObjectsCompiler:
             parallel_processing=self.parallel_processing,
             force_recompile=self.force_recompile,
             optimize_format=self.optimize_textures,
+            metadata_store=self.get_metadata_store(),
+            quantizer=self.texture_quantizer,
+            )
+        # compile all targets at once so each source is only decoded once
+        texture_comp.compile_textures(
+            asset_dir, target_ps2=self.build_ps2_files,
+            target_ngc=self.build_ngc_files, target_xbox=self.build_xbox_files,
+            target_arcade=self.build_arcade_files, **kwargs
             )
-        if self.build_ps2_files:
-            texture_comp.compile_textures(asset_dir, target_ps2=True, **kwargs)
-
-        if self.build_ngc_files:
-            texture_comp.compile_textures(asset_dir, target_ngc=True, **kwargs)
-
-        if self.build_xbox_files:
-            texture_comp.compile_textures(asset_dir, target_xbox=True, **kwargs)
-
-        if self.build_arcade_files:
-            texture_comp.compile_textures(asset_dir, target_arcade=True, **kwargs)
 
-    def compile_models(self):
+    def _compile_models(self):
         asset_dir = os.path.join(self.target_dir, c.DATA_FOLDERNAME)
         if not os.path.isdir(asset_dir):
             return
@@ -72,6 +106,8 @@ class ObjectsCompiler:
             force_recompile=self.force_recompile,
             parallel_processing=self.parallel_processing,
             optimize_strips=self.optimize_models,
+            optimize_vertex_cache=self.optimize_vertex_cache,
+            vertex_cache_size=self.vertex_cache_size,
             )
         if self.build_ps2_files:
             model_comp.compile_models(asset_dir, target_ps2=True, **kwargs)
@@ -85,7 +121,7 @@ class ObjectsCompiler:
         if self.build_arcade_files:
             model_comp.compile_models(asset_dir, target_arcade=True, **kwargs)
 
-    def compile(self):
+    def _compile(self):
         if not os.path.isdir(self.target_dir):
             return
         elif not(self.build_ngc_files or self.build_ps2_files or
@@ -105,6 +141,7 @@ class ObjectsCompiler:
         if self.build_arcade_files:
             comp_kwargs.append(dict(name="ARC", target_arcade=True))
 
+        metadata_store = self.get_metadata_store()
         compilation_outputs = dict()
         for kwargs in comp_kwargs:
             name = kwargs.pop("name")
@@ -113,12 +150,13 @@ class ObjectsCompiler:
                 serialize_cache_files=self.serialize_cache_files,
                 build_anim_cache=self.build_anim_cache,
                 build_texdef_cache=(self.build_texdef_cache and name == "PS2"),
-                use_force_index_hack=self.use_force_index_hack
+                use_force_index_hack=self.use_force_index_hack,
+                metadata_store=metadata_store
                 )
 
         return compilation_outputs
 
-    def decompile(self, **kwargs):
+    def _decompile(self, **kwargs):
         kwargs.setdefault("overwrite", self.overwrite)
         kwargs.setdefault("individual_meta", self.individual_meta)
         kwargs.setdefault("parallel_processing", self.parallel_processing)
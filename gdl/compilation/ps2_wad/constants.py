@@ -33,6 +33,11 @@ PS2_WAD_UNKNOWN_FILE_TEMPLATE = "unknown/%s." + PS2_WAD_UNKNOWN_EXTENSION
 PS2_WAD_PATHHASH_CHUNK_SIZE = 12
 PS2_WAD_PATHHASH_SEED = 0x9E3779B9
 
+# version of the index written beside wads when patching them. it
+# records the md5 of each file's data so unchanged files can be skipped
+PS2_WAD_PATCH_INDEX_VERSION   = 1
+PS2_WAD_PATCH_INDEX_EXTENSION = "index"
+
 # the name and hash of the file we store the filenames in
 INTERNAL_NAMES_FILEPATH_HASH = 0x17FFD2F2
 INTERNAL_NAMES_FILEPATH = "internal\\files.%s" % PS2_WAD_INTERNAL_NAMES_EXTENSION
@@ -0,0 +1,136 @@
+import fnmatch
+import re
+
+from . import util
+
+
+def infer_load_groups(filenames):
+    '''
+    Returns a dict mapping the name of each level to patterns matching the
+    files it loads: its LEVELS, MAPS and ITEMS folders, plus the ITEMS
+    folder shared by its world(LEVELA1 also loads ITEMS\\LEVELA). Which
+    monsters a level loads can't be told from filenames alone, so those
+    need to be added to a supplied load groups list to be grouped.
+    '''
+    dirnames = set()
+    for filename in filenames:
+        parts = util.sanitize_filename(filename).split("\\")
+        if len(parts) > 2:
+            dirnames.add("\\".join(parts[:2]))
+
+    load_groups = {}
+    for dirname in sorted(dirnames):
+        top_dir, level = dirname.split("\\")
+        if top_dir != "LEVELS":
+            continue
+
+        world = level.rstrip("0123456789")
+        load_groups[level] = [
+            "%s\\*" % group_dirname for group_dirname in (
+                "LEVELS\\" + level, "MAPS\\" + level,
+                "ITEMS\\" + level, "ITEMS\\" + world,
+                )
+            if group_dirname in dirnames
+            ]
+
+    return load_groups
+
+
+def read_load_groups(input_data):
+    '''
+    Reads a load groups list. Each group starts with its name in square
+    brackets, and is followed by the filenames, folders, or wildcard
+    patterns of the files it loads, one per line. Lines starting with
+    # are ignored.
+    '''
+    if isinstance(input_data, str):
+        input_data = input_data.splitlines()
+
+    load_groups, patterns = {}, None
+    for line in input_data:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        elif line.startswith("[") and line.endswith("]"):
+            patterns = load_groups.setdefault(line[1: -1].strip().upper(), [])
+        elif patterns is None:
+            raise ValueError("Load group pattern '%s' is not in a group." % line)
+        else:
+            patterns.append(line)
+
+    return load_groups
+
+
+def match_load_groups(filenames, load_groups):
+    '''
+    Returns a dict mapping the name of each group to the indices of the
+    filenames it loads. Patterns without wildcards match either the file
+    with that name, or everything in the folder with that name.
+    '''
+    filenames = [util.sanitize_filename(filename) for filename in filenames]
+
+    matched_groups = {}
+    for name, patterns in load_groups.items():
+        regexes = []
+        for pattern in patterns:
+            pattern = util.sanitize_filename(pattern).strip("\\")
+            regex = fnmatch.translate(pattern)
+            if not any(char in pattern for char in "*?["):
+                regex = "%s|%s" % (regex, fnmatch.translate(pattern + "\\*"))
+            regexes.append(regex)
+
+        if not regexes:
+            matched_groups[name] = []
+            continue
+
+        match = re.compile("|".join(regexes)).match
+        matched_groups[name] = [
+            i for i, filename in enumerate(filenames) if match(filename)
+            ]
+
+    return matched_groups
+
+
+def order_by_load_groups(file_count, matched_groups):
+    '''
+    Returns the indices of the files ordered so each group's files are
+    as close together as possible. Groups are laid out in order, and
+    files already laid out by an earlier group are not moved. Files also
+    loaded by a later group are put at the end of the group, so they
+    border on the start of that group. Files in no group are put last.
+    '''
+    last_group = {}
+    for group_index, indices in enumerate(matched_groups.values()):
+        for i in indices:
+            last_group[i] = group_index
+
+    order, placed = [], set()
+    for group_index, indices in enumerate(matched_groups.values()):
+        indices = [i for i in indices if i not in placed]
+        indices.sort(key=lambda i: last_group[i] > group_index)
+
+        order.extend(indices)
+        placed.update(indices)
+
+    order.extend(i for i in range(file_count) if i not in placed)
+    return order
+
+
+def count_group_seeks(order, matched_groups):
+    '''
+    Returns a dict mapping the name of each group to an estimate of the
+    number of seeks needed to read all of its files, if they're laid out
+    in the given order. Reading a group is assumed to start with a seek,
+    and to need another each time the next file isn't right after it.
+    '''
+    positions = {file_index: position for position, file_index in enumerate(order)}
+
+    seek_counts = {}
+    for name, indices in matched_groups.items():
+        group_positions = sorted(positions[i] for i in indices)
+        seek_counts[name] = sum(
+            1 for j in range(len(group_positions))
+            if j == 0 or group_positions[j] != group_positions[j - 1] + 1
+            )
+
+    return seek_counts
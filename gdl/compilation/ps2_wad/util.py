@@ -1,6 +1,11 @@
 import os
 import struct
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 from ..util import *
 from . import constants as c
 
@@ -203,8 +208,9 @@ def _mix_filepath_hash_values(x, y, z):
     return x, y, z
 
 
-def hash_filepath(filepath):
-    filepath = sanitize_filename(filepath)
+def _hash_filepath_chars(filepath):
+    # hashes the filepath one character at a time. only
+    # needed for characters that don't fit in one byte
     str_len = len(filepath)
 
     x = c.PS2_WAD_PATHHASH_SEED
@@ -237,3 +243,156 @@ def hash_filepath(filepath):
         x, y, z = _mix_filepath_hash_values(x, y, z)
 
     return z
+
+
+def hash_filepath(filepath):
+    filepath = sanitize_filename(filepath)
+    try:
+        data = filepath.encode("latin-1")
+    except UnicodeEncodeError:
+        return _hash_filepath_chars(filepath)
+
+    str_len = len(data)
+
+    x = c.PS2_WAD_PATHHASH_SEED
+    y = c.PS2_WAD_PATHHASH_SEED
+    z = c.PS2_WAD_PATHHASH_CHUNK_SIZE + 1
+
+    mix_length_at_end = str_len % c.PS2_WAD_PATHHASH_CHUNK_SIZE == 0
+
+    # hash the filepath string. each character is one byte, so
+    # each set of 4 can be read as a little endian integer
+    for i in range(0, str_len, c.PS2_WAD_PATHHASH_CHUNK_SIZE):
+        x += int.from_bytes(data[i:     i + 4],  'little')
+        y += int.from_bytes(data[i + 4: i + 8],  'little')
+        # the third set of 4 is shifted up a byte if the filepath ends in it
+        z += int.from_bytes(data[i + 8: i + 12], 'little') << (8 * (str_len - i < 12))
+
+        # mix the length into the hash on the last iteration
+        if not mix_length_at_end and i + c.PS2_WAD_PATHHASH_CHUNK_SIZE > str_len:
+            z += str_len
+
+        x, y, z = _mix_filepath_hash_values(x, y, z)
+
+    if mix_length_at_end:
+        # one last mix round
+        z += str_len
+        x, y, z = _mix_filepath_hash_values(x, y, z)
+
+    return z
+
+
+def hash_filepaths(filepaths):
+    '''
+    Returns a list of the hashes of each filepath. If numpy is installed,
+    filepaths of the same length are hashed together as arrays.
+    '''
+    filepaths = [sanitize_filename(filepath) for filepath in filepaths]
+    if numpy is None:
+        return [hash_filepath(filepath) for filepath in filepaths]
+
+    path_hashes = [None] * len(filepaths)
+    indices_by_len = {}
+    for i, filepath in enumerate(filepaths):
+        try:
+            data = filepath.encode("latin-1")
+        except UnicodeEncodeError:
+            path_hashes[i] = _hash_filepath_chars(filepath)
+            continue
+
+        indices_by_len.setdefault(len(data), ([], []))
+        indices_by_len[len(data)][0].append(i)
+        indices_by_len[len(data)][1].append(data)
+
+    chunk_size = c.PS2_WAD_PATHHASH_CHUNK_SIZE
+    for str_len, (indices, datas) in indices_by_len.items():
+        # pad the filepaths to whole chunks and view them as 3 ints per chunk
+        chunk_count = (str_len + chunk_size - 1) // chunk_size
+        padded_len  = chunk_count * chunk_size
+        chunks = numpy.frombuffer(
+            b''.join(data.ljust(padded_len, b'\x00') for data in datas),
+            dtype="<u4"
+            ).reshape((len(datas), chunk_count, 3)).astype(numpy.uint32)
+
+        x = numpy.full(len(datas), c.PS2_WAD_PATHHASH_SEED, dtype=numpy.uint32)
+        y = numpy.full(len(datas), c.PS2_WAD_PATHHASH_SEED, dtype=numpy.uint32)
+        z = numpy.full(len(datas), chunk_size + 1, dtype=numpy.uint32)
+
+        mix_length_at_end = str_len % chunk_size == 0
+        for i in range(chunk_count):
+            x += chunks[:, i, 0]
+            y += chunks[:, i, 1]
+            if str_len - i*chunk_size < chunk_size:
+                # the third set of 4 is shifted up a byte if the filepath ends in it
+                z += chunks[:, i, 2] << numpy.uint32(8)
+                z += numpy.uint32(str_len)
+            else:
+                z += chunks[:, i, 2]
+
+            x, y, z = _mix_filepath_hash_values_array(x, y, z)
+
+        if mix_length_at_end:
+            # one last mix round
+            z += numpy.uint32(str_len)
+            x, y, z = _mix_filepath_hash_values_array(x, y, z)
+
+        for i, path_hash in zip(indices, z.tolist()):
+            path_hashes[i] = path_hash
+
+    return path_hashes
+
+
+def _mix_filepath_hash_values_array(x, y, z):
+    # same as _mix_filepath_hash_values, but on uint32 numpy arrays,
+    # which wrap around on overflow the same as the masking does
+    u32 = numpy.uint32
+    x = (z >> u32(13)) ^ (x-y-z)
+    y = (x << u32( 8)) ^ (y-z-x)
+    z = (y >> u32(13)) ^ (z-x-y)
+
+    x = (z >> u32(12)) ^ (x-y-z)
+    y = (x << u32(16)) ^ (y-z-x)
+    z = (y >> u32( 5)) ^ (z-x-y)
+
+    x = (z >> u32( 3)) ^ (x-y-z)
+    y = (x << u32(10)) ^ (y-z-x)
+    z = (y >> u32(15)) ^ (z-x-y)
+
+    return x, y, z
+
+
+def find_path_hash_collisions(filepaths, path_hashes):
+    '''
+    Returns a dict mapping each path hash that different filepaths
+    hash to, to a sorted list of those filepaths.
+    '''
+    filepaths_by_hash = {}
+    for filepath, path_hash in zip(filepaths, path_hashes):
+        filepaths_by_hash.setdefault(path_hash, set()).add(sanitize_filename(filepath))
+
+    return {
+        path_hash: sorted(filepaths)
+        for path_hash, filepaths in filepaths_by_hash.items()
+        if len(filepaths) > 1
+        }
+
+
+def warn_path_hash_collisions(filepaths, path_hashes):
+    for path_hash, filepaths in find_path_hash_collisions(filepaths, path_hashes).items():
+        print("Warning: These filepaths all have the same path hash %s: %s" % (
+            path_hash, ", ".join("'%s'" % filepath for filepath in filepaths)
+            ))
+
+
+_retail_filepath_hashmap = None
+def get_retail_filepath_hashmap():
+    '''
+    Returns a dict mapping the path hash of each retail filepath to it.
+    It's only calculated once, so it must not be modified.
+    '''
+    global _retail_filepath_hashmap
+    if _retail_filepath_hashmap is None:
+        filepaths = sorted(c.RETAIL_NAMES)
+        _retail_filepath_hashmap = dict(zip(hash_filepaths(filepaths), filepaths))
+
+    return _retail_filepath_hashmap
@@ -0,0 +1,261 @@
+import io
+import mmap
+import struct
+import zlib
+
+from traceback import format_exc
+from . import constants as c
+from . import util
+
+# how much compressed data to decompress at a time when reading
+DECOMP_CHUNK_SIZE = 256 * 1024
+
+
+class WadFileIO(io.RawIOBase):
+    '''
+    Read-only, seekable file object for one file inside a wad. Compressed
+    files are decompressed only as far as they've been read into, and the
+    decompressed data is kept so seeking backward doesn't start over.
+    '''
+    def __init__(self, wad_map, header):
+        self._wad_map = wad_map
+        self._start   = header["data_pointer"]
+        self._size    = header["uncomp_size"]
+        self._pos     = 0
+
+        self._comp_size    = header["comp_size"]
+        self._comp_pos     = 0
+        self._decompressor = None
+        self._decomp_data  = None
+        if self._comp_size >= 0:
+            self._decompressor = zlib.decompressobj()
+            self._decomp_data  = bytearray()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self._size
+        elif whence != io.SEEK_SET:
+            raise ValueError("Invalid whence (%s)" % whence)
+
+        if pos < 0:
+            raise ValueError("Negative seek position %s" % pos)
+
+        self._pos = pos
+        return pos
+
+    def _decompress_to(self, end):
+        # decompress until the data is decompressed up to end
+        decomp_data = self._decomp_data
+        while len(decomp_data) < end and self._comp_pos < self._comp_size:
+            chunk_start = self._start + self._comp_pos
+            chunk_size  = min(DECOMP_CHUNK_SIZE, self._comp_size - self._comp_pos)
+            self._comp_pos += chunk_size
+            decomp_data += self._decompressor.decompress(
+                self._wad_map[chunk_start: chunk_start + chunk_size]
+                )
+
+        if self._comp_pos >= self._comp_size and self._decompressor:
+            decomp_data += self._decompressor.flush()
+            self._decompressor = None
+
+    def readinto(self, buffer):
+        self._checkClosed()
+        with memoryview(buffer) as view:
+            end = min(self._size, self._pos + len(view))
+            if end <= self._pos:
+                return 0
+
+            if self._decomp_data is None:
+                data = self._wad_map[self._start + self._pos: self._start + end]
+            else:
+                self._decompress_to(end)
+                data = self._decomp_data[self._pos: end]
+
+            view[:len(data)] = data
+            self._pos += len(data)
+            return len(data)
+
+    def readall(self):
+        return self.read(max(0, self._size - self._pos))
+
+    def read(self, size=-1):
+        self._checkClosed()
+        if size is None or size < 0:
+            size = max(0, self._size - self._pos)
+
+        buffer = bytearray(min(size, max(0, self._size - self._pos)))
+        return bytes(buffer[:self.readinto(buffer)])
+
+    def close(self):
+        self._decomp_data = self._decompressor = None
+        super().close()
+
+
+class WadFS:
+    '''
+    Read-only filesystem view of a ps2 wad.bin. The wad is memory mapped
+    once, and files are found by path hash in constant time, so single
+    files can be read out of the wad without extracting the whole thing.
+    Paths are case-insensitive, and can use either slash direction.
+    '''
+    def __init__(self, wad_filepath, filepath_hashmap=None, use_internal_names=True):
+        self.wad_filepath = wad_filepath
+        self._wad_file = open(wad_filepath, "rb")
+        try:
+            self._wad_map = mmap.mmap(self._wad_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._wad_file.close()
+            raise
+
+        file_count = struct.unpack_from('<I', self._wad_map)[0]
+        if file_count > c.PS2_WAD_MAX_FILE_COUNT:
+            self.close()
+            raise ValueError("WAD does not appear valid(too many files).")
+
+        # index the headers by path hash. if a hash is somehow
+        # repeated, the first header is the one that's used
+        self._headers_by_hash = {}
+        for uncomp_size, data_pointer, path_hash, comp_size in util.INDEX_HEADER_STRUCT.iter_unpack(
+                self._wad_map[4: 4 + file_count*util.INDEX_HEADER_STRUCT.size]
+                ):
+            self._headers_by_hash.setdefault(path_hash, dict(
+                uncomp_size  = uncomp_size,
+                data_pointer = data_pointer,
+                path_hash    = path_hash,
+                comp_size    = comp_size
+                ))
+
+        if filepath_hashmap is None:
+            filepath_hashmap = util.get_retail_filepath_hashmap()
+
+        self.filepath_hashmap = dict(filepath_hashmap)
+        if use_internal_names:
+            self._load_internal_names()
+
+        self._build_directories()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._wad_map is not None:
+            self._wad_map.close()
+            self._wad_file.close()
+            self._wad_map = self._wad_file = None
+
+    def _load_internal_names(self):
+        header = self._headers_by_hash.get(c.INTERNAL_NAMES_FILEPATH_HASH)
+        if header is None:
+            return
+
+        try:
+            with WadFileIO(self._wad_map, header) as f:
+                internal_names = util.read_names_list(f.read().decode())
+
+            self.filepath_hashmap.update(zip(
+                util.hash_filepaths(internal_names), internal_names
+                ))
+        except Exception:
+            print(format_exc())
+            print("Could not load internal filepath names list.")
+
+    def _build_directories(self):
+        # map each file's name to its header, and each
+        # directory to the names of the files and folders in it
+        self._headers_by_name = {}
+        self._dirs = {"": ({}, {})}
+        for path_hash, header in self._headers_by_hash.items():
+            filepath = util.sanitize_filename(self.filepath_hashmap.get(
+                path_hash, c.PS2_WAD_UNKNOWN_FILE_TEMPLATE % path_hash
+                ))
+            self._headers_by_name[filepath] = header
+
+            dirpath, _, filename = filepath.rpartition("\\")
+            self._get_directory(dirpath)[1][filename] = header
+
+    def _get_directory(self, dirpath):
+        directory = self._dirs.get(dirpath)
+        if directory is None:
+            self._dirs[dirpath] = directory = ({}, {})
+            parent, _, dirname = dirpath.rpartition("\\")
+            self._get_directory(parent)[0][dirname] = directory
+
+        return directory
+
+    def _get_header(self, filepath):
+        filepath = util.sanitize_filename(filepath).strip("\\")
+        header = self._headers_by_name.get(filepath)
+        if header is None:
+            # the name might not be known, but its hash may match
+            header = self._headers_by_hash.get(util.hash_filepath(filepath))
+
+        if header is None:
+            raise FileNotFoundError("No such file in wad: '%s'" % filepath)
+
+        return header
+
+    def exists(self, filepath):
+        try:
+            self._get_header(filepath)
+            return True
+        except FileNotFoundError:
+            return util.sanitize_filename(filepath).strip("\\") in self._dirs
+
+    def isdir(self, dirpath):
+        return util.sanitize_filename(dirpath).strip("\\") in self._dirs
+
+    def stat(self, filepath):
+        '''
+        Returns a copy of the header of the file in the wad. uncomp_size is
+        the size of the file, and comp_size is -1 if it isn't compressed.
+        '''
+        return dict(self._get_header(filepath))
+
+    def open(self, filepath):
+        '''Returns a read-only, seekable file object for the file in the wad.'''
+        if self._wad_map is None:
+            raise ValueError("I/O operation on closed WadFS.")
+
+        return WadFileIO(self._wad_map, self._get_header(filepath))
+
+    def read(self, filepath):
+        with self.open(filepath) as f:
+            return f.read()
+
+    def listdir(self, dirpath=""):
+        '''Returns the sorted names of the files and folders in the folder.'''
+        directory = self._dirs.get(util.sanitize_filename(dirpath).strip("\\"))
+        if directory is None:
+            raise FileNotFoundError("No such directory in wad: '%s'" % dirpath)
+
+        return sorted((*directory[0], *directory[1]))
+
+    def walk(self, top=""):
+        '''
+        Yields a tuple of the path to each folder under the top folder,
+        the names of the folders in it, and the names of the files in it,
+        the same as os.walk. Folders are walked from the top down.
+        '''
+        dirpath = util.sanitize_filename(top).strip("\\")
+        directory = self._dirs.get(dirpath)
+        if directory is None:
+            return
+
+        dirnames = sorted(directory[0])
+        yield dirpath, dirnames, sorted(directory[1])
+        for dirname in dirnames:
+            yield from self.walk(dirpath + "\\" + dirname if dirpath else dirname)
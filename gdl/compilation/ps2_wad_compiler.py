@@ -1,11 +1,80 @@
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import json
 import os
 import tempfile
 import zlib
 
 from traceback import format_exc
+from .. import telemetry
 from .ps2_wad import constants as c
+from .ps2_wad import layout
 from .ps2_wad import util
 
+# size of the chunks to copy or decompress files in when extracting to disk
+EXTRACT_CHUNK_SIZE = 1024**2
+
+
+def _copy_wad_data(fin, fout, offset, size):
+    # copies stored data from the wad to the file. where possible this
+    # is done by the os, so the data is never read into python at all
+    fout.flush()
+    in_fd, out_fd = fin.fileno(), fout.fileno()
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                count = os.copy_file_range(in_fd, out_fd, size - copied, offset + copied)
+                if not count:
+                    break
+                copied += count
+        except OSError:
+            # not supported for these files(different filesystems, etc)
+            pass
+
+    if copied < size and hasattr(os, "sendfile"):
+        try:
+            while copied < size:
+                count = os.sendfile(out_fd, in_fd, offset + copied, size - copied)
+                if not count:
+                    break
+                copied += count
+        except OSError:
+            pass
+
+    # move the file object to wherever the os finished writing
+    fout.seek(os.lseek(out_fd, 0, os.SEEK_CUR))
+
+    # copy whatever's left a chunk at a time
+    fin.seek(offset + copied)
+    while copied < size:
+        data = fin.read(min(EXTRACT_CHUNK_SIZE, size - copied))
+        if not data:
+            break
+        fout.write(data)
+        copied += len(data)
+
+
+def _decompress_wad_data(fin, fout, offset, size):
+    # decompresses data from the wad to the file a chunk at a time
+    decompressor = zlib.decompressobj()
+    fin.seek(offset)
+    while size > 0:
+        data = fin.read(min(EXTRACT_CHUNK_SIZE, size))
+        if not data:
+            break
+
+        size -= len(data)
+        while data:
+            fout.write(decompressor.decompress(data, EXTRACT_CHUNK_SIZE))
+            data = decompressor.unconsumed_tail
+
+    fout.write(decompressor.flush())
+    if not decompressor.eof:
+        raise zlib.error("Error -5 while decompressing data: incomplete or truncated stream")
+
 
 def _extract_files(kwargs):
     file_buffers = {}
@@ -21,17 +90,32 @@ def _extract_files(kwargs):
                 print(f"Reading file: %s" % header["filename"])
 
             try:
-                fin.seek(header["data_pointer"])
-                if header["comp_size"] < 0:
-                    data = fin.read(header["uncomp_size"])
-                else:
-                    data = zlib.decompress(fin.read(header["comp_size"]))
-
                 if kwargs["to_disk"]:
+                    # stream the data to the file, rather than reading it
+                    # all into memory, so memory use doesn't grow with size
                     os.makedirs(os.path.dirname(filepath), exist_ok=True)
-                    with open(filepath, "wb") as fout:
-                        fout.write(data)
+                    try:
+                        with open(filepath, "wb") as fout:
+                            if header["comp_size"] < 0:
+                                _copy_wad_data(
+                                    fin, fout, header["data_pointer"], header["uncomp_size"]
+                                    )
+                            else:
+                                _decompress_wad_data(
+                                    fin, fout, header["data_pointer"], header["comp_size"]
+                                    )
+                    except Exception:
+                        # don't leave a partially extracted file
+                        if os.path.isfile(filepath):
+                            os.remove(filepath)
+                        raise
                 else:
+                    fin.seek(header["data_pointer"])
+                    if header["comp_size"] < 0:
+                        data = fin.read(header["uncomp_size"])
+                    else:
+                        data = zlib.decompress(fin.read(header["comp_size"]))
+
                     file_buffers[header["filename"]] = data
 
             except Exception:
@@ -41,60 +125,203 @@ def _extract_files(kwargs):
     return file_buffers
 
 
-def _compile_wad(kwargs):
-    file_headers = [
+def _make_wad_file_headers(file_headers):
+    return [
         dict(
             filename=header["filename"], filepath=header["filepath"],
             compress_level=header.get("compress_level", 0),
             data_pointer=0, uncomp_size=0, comp_size=-1,
-            path_hash=util.hash_filepath(header.get("filename", "")),
+            path_hash=_get_path_hash(header.get("filename", ""), header.get("path_hash")),
             )
-        for header in kwargs["file_headers"]
+        for header in file_headers
         ]
 
+
+def _get_path_hash(filename, path_hash=None):
+    # returns the path hash for the filename. if it's already
+    # been hashed, pass it in so it doesn't need to be again
+    filename_no_ext, ext = os.path.splitext(os.path.basename(filename))
+    ext = ext.lower().strip(".")
+    if ext == c.PS2_WAD_UNKNOWN_EXTENSION and filename_no_ext.isdigit():
+        # unknown files store the path hash in the filename
+        return int(filename_no_ext)
+
+    return util.hash_filepath(filename) if path_hash is None else path_hash
+
+
+def _read_wad_file(header):
+    # this may run on another thread, so the asset is set here
+    with telemetry.asset(header["filename"], "wad_file"):
+        return _read_wad_file_data(header)
+
+
+def _read_wad_file_data(header):
+    # read the data, and update the sizes/path hash
+    with telemetry.measure("read") as record, open(header["filepath"], "rb") as fin:
+        data = fin.read()
+        record["input_size"] = len(data)
+
+    header["path_hash"] = _get_path_hash(header["filename"], header["path_hash"])
+
+    # compress the data if needed, and return what to write to file
+    data_to_write = data
+    header["uncomp_size"] = len(data)
+    header["comp_size"] = -1
+    if (len(data) > c.PS2_WAD_FILE_CHUNK_SIZE and header["compress_level"] and
+        util.is_compressible(header["filename"])
+        ):
+        with telemetry.measure("encode", len(data)) as record:
+            comp_data = zlib.compress(data, header["compress_level"])
+            record["output_size"] = len(comp_data)
+        if len(comp_data) < len(data):
+            header["comp_size"] = len(comp_data)
+            data_to_write = comp_data
+
+    return data_to_write
+
+
+def _write_wad_file(header, data_future, fout):
+    print(f"Compiling file: %s" % header["filename"])
+    try:
+        header["data_pointer"] = fout.tell()
+        data = data_future()
+        with telemetry.asset(header["filename"], "wad_file"),\
+             telemetry.measure("write", output_size=len(data)):
+            fout.write(data)
+
+            # write padding
+            fout.write(b'\x00' * util.calculate_padding(fout.tell(), c.PS2_WAD_FILE_CHUNK_SIZE))
+    except Exception:
+        print(format_exc())
+        print("Failed to compile '%s'" % header["filepath"])
+
+
+def _compile_wad(kwargs):
+    file_headers = _make_wad_file_headers(kwargs["file_headers"])
+
     with open(kwargs["wad_filepath"], "wb") as fout:
         # write the headers to allocate enough space for file index
         util.write_file_headers(file_headers, fout)
 
         for header in file_headers:
-            print(f"Compiling file: %s" % header["filename"])
-            try:
-                # read the data, and update the sizes/path hash/pointer
-                header["data_pointer"] = fout.tell()
-                with open(header["filepath"], "rb") as fin:
-                    data = fin.read()
-
-                filename_no_ext, ext = os.path.splitext(os.path.basename(header["filename"]))
-                ext = ext.lower().strip(".")
-                if ext == c.PS2_WAD_UNKNOWN_EXTENSION:
-                    # unknown files store the path hash in the filename
-                    header["path_hash"] = int(filename_no_ext)
-
-                # compress the data if needed, and write to file
-                data_to_write = data
-                header["uncomp_size"] = len(data)
-                header["comp_size"] = -1
-                if (len(data) > c.PS2_WAD_FILE_CHUNK_SIZE and header["compress_level"] and
-                    util.is_compressible(header["filename"])
-                    ):
-                    comp_data = zlib.compress(data, header["compress_level"])
-                    if len(comp_data) < len(data):
-                        header["comp_size"] = len(comp_data)
-                        data_to_write = comp_data
-
-                fout.write(data_to_write)
-
-                # write padding
-                fout.write(b'\x00' * util.calculate_padding(fout.tell(), c.PS2_WAD_FILE_CHUNK_SIZE))
-            except Exception:
-                print(format_exc())
-                print("Failed to compile '%s'" % header["filepath"])
+            _write_wad_file(header, lambda: _read_wad_file(header), fout)
+
+        fout.seek(0)
+        # write the headers again after we've calculated all the offsets, hashes, and sizes
+        util.write_file_headers(file_headers, fout)
+
+
+def _compile_wad_threaded(kwargs):
+    '''
+    Same as _compile_wad, except files are read and compressed by a pool
+    of threads(zlib releases the GIL while compressing), and written to
+    the wad in order as they finish. Files are only queued while the
+    total size of those queued and not written is under max_queued_size,
+    so memory use stays bounded no matter how many files there are.
+    '''
+    file_headers = _make_wad_file_headers(kwargs["file_headers"])
+    max_queued_size = kwargs["max_queued_size"]
+
+    file_sizes = []
+    for header in file_headers:
+        try:
+            file_sizes.append(os.path.getsize(header["filepath"]))
+        except OSError:
+            # let reading it fail and report the error
+            file_sizes.append(0)
+
+    with open(kwargs["wad_filepath"], "wb") as fout,\
+         concurrent.futures.ThreadPoolExecutor(kwargs["thread_count"]) as executor:
+        # write the headers to allocate enough space for file index
+        util.write_file_headers(file_headers, fout)
+
+        queued, queued_size, next_i = collections.deque(), 0, 0
+        for i, header in enumerate(file_headers):
+            # queue files until enough are queued, but always queue
+            # at least one, otherwise large files would never be queued
+            while next_i < len(file_headers):
+                if queued and queued_size + file_sizes[next_i] > max_queued_size:
+                    break
+
+                queued.append(executor.submit(_read_wad_file, file_headers[next_i]))
+                queued_size += file_sizes[next_i]
+                next_i += 1
+
+            _write_wad_file(header, queued.popleft().result, fout)
+            queued_size -= file_sizes[i]
 
         fout.seek(0)
         # write the headers again after we've calculated all the offsets, hashes, and sizes
         util.write_file_headers(file_headers, fout)
 
 
+def _get_stored_size(header):
+    # size of the data in the wad, including padding to the next chunk
+    size = header["uncomp_size"] if header["comp_size"] < 0 else header["comp_size"]
+    return size + util.calculate_padding(size, c.PS2_WAD_FILE_CHUNK_SIZE)
+
+
+def _read_wad_entry(fin, header, decompress=True):
+    fin.seek(header["data_pointer"])
+    if header["comp_size"] < 0:
+        return fin.read(header["uncomp_size"])
+
+    data = fin.read(header["comp_size"])
+    return zlib.decompress(data) if decompress else data
+
+
+def _load_patch_index(wad_filepath):
+    # returns the md5s and stats of the files in the wad that were
+    # recorded when it was last patched, as long as it hasn't changed
+    index_filepath = "%s.%s" % (wad_filepath, c.PS2_WAD_PATCH_INDEX_EXTENSION)
+    if not os.path.isfile(index_filepath):
+        return {}
+
+    try:
+        with open(index_filepath, "r") as f:
+            index = json.load(f)
+
+        wad_stat = os.stat(wad_filepath)
+        if (index.get("version") == c.PS2_WAD_PATCH_INDEX_VERSION and
+            index["wad_size"] == wad_stat.st_size and
+            index["wad_mtime_ns"] == wad_stat.st_mtime_ns
+            ):
+            return index["files"]
+    except Exception:
+        print(format_exc())
+        print("Warning: Could not load wad patch index '%s'" % index_filepath)
+
+    return {}
+
+
+def _save_patch_index(wad_filepath, records):
+    index_filepath = "%s.%s" % (wad_filepath, c.PS2_WAD_PATCH_INDEX_EXTENSION)
+    wad_stat = os.stat(wad_filepath)
+    with open(index_filepath + ".temp", "w") as f:
+        json.dump(
+            dict(
+                version=c.PS2_WAD_PATCH_INDEX_VERSION, files=records,
+                wad_size=wad_stat.st_size, wad_mtime_ns=wad_stat.st_mtime_ns,
+                ),
+            f, sort_keys=True, indent=1
+            )
+
+    os.replace(index_filepath + ".temp", index_filepath)
+
+
+def _allocate_wad_space(used_spans, size, data_start):
+    # returns the pointer to the first unused span of the wad
+    # that's large enough, or the end of the wad if there's none
+    pointer = data_start
+    for start, end in used_spans:
+        if start - pointer >= size:
+            break
+        pointer = max(pointer, end)
+
+    bisect.insort(used_spans, (pointer, pointer + size))
+    return pointer
+
+
 class Ps2WadCompiler:
     wad_dirpath  = ""
     wad_filepath = ""
@@ -105,6 +332,27 @@ class Ps2WadCompiler:
     use_compression_names = False
     compression_level = zlib.Z_NO_COMPRESSION
 
+    # when processing in parallel, compress files with threads and write
+    # them straight to the wad, rather than having processes each write
+    # a temp wad that are all concatenated together afterward.
+    use_threads = True
+    thread_count = None  # None means use ThreadPoolExecutor's default
+    # max bytes of files to hold in memory while waiting to be written
+    max_queued_size = 256 * 1024**2
+
+    # path to write a report of how long each file took to compile to.
+    # json, or csv if it ends in .csv. empty means don't write one
+    telemetry_filepath = ""
+
+    # order the files in the wad so the files each load group(level)
+    # loads are together, to reduce seeking while loading. load_groups
+    # can be a dict mapping each group's name to patterns matching its
+    # files, the path to a load groups list(see layout.read_load_groups),
+    # or None to infer the groups from the folders of each level.
+    optimize_layout = False
+    load_groups = None
+    layout_report = None
+
     filepath_hashmap = ()
     file_headers     = ()
 
@@ -121,10 +369,7 @@ class Ps2WadCompiler:
         if not wad_filepath:
             wad_filepath = self.wad_filepath
 
-        self.filepath_hashmap = {
-            util.hash_filepath(filepath): filepath
-            for filepath in c.RETAIL_NAMES
-            }
+        self.filepath_hashmap = dict(util.get_retail_filepath_hashmap())
 
         if not(use_internal_names and os.path.isfile(wad_filepath)):
             return
@@ -139,10 +384,9 @@ class Ps2WadCompiler:
                 data = self.extract_file(file_header)
                 internal_names = util.read_names_list(data.decode())
 
-                self.filepath_hashmap.update({
-                    util.hash_filepath(filepath): filepath
-                    for filepath in internal_names
-                    })
+                self.filepath_hashmap.update(zip(
+                    util.hash_filepaths(internal_names), internal_names
+                    ))
                 break
         except Exception:
             print(format_exc())
@@ -226,11 +470,17 @@ class Ps2WadCompiler:
             process_count=None if self.parallel_processing else 1
             )
 
-    def compile(self):
+    def _get_compile_file_headers(self, temp_files):
+        # returns headers for all the files to compile into the wad. any
+        # temp files made for them are added to temp_files to clean up.
         files_to_compile = list(util.locate_ps2_wad_files(self.wad_dirpath))
-
-        if not self.overwrite and os.path.isfile(self.wad_filepath):
-            return
+        filenames = [
+            os.path.relpath(filepath, self.wad_dirpath)
+            for filepath in files_to_compile
+            ]
+        # hash every filename once, and warn if any will overwrite each other
+        path_hashes = util.hash_filepaths(filenames)
+        util.warn_path_hash_collisions(filenames, path_hashes)
 
         explicit_compress_level = self.compression_level
         default_compress_level  = self.compression_level
@@ -240,34 +490,27 @@ class Ps2WadCompiler:
         if self.use_compression_names:
             default_compress_level = zlib.Z_NO_COMPRESSION
 
-            for filepath in files_to_compile:
-                filename = os.path.relpath(filepath, self.wad_dirpath)
-
-                if util.hash_filepath(filename) == c.COMPRESS_NAMES_FILEPATH_HASH:
+            for filepath, path_hash in zip(files_to_compile, path_hashes):
+                if path_hash == c.COMPRESS_NAMES_FILEPATH_HASH:
                     with open(filepath, "r") as f:
-                        compress.update(
-                            util.hash_filepath(filename)
-                            for filename in util.read_names_list(f)
-                            )
+                        compress.update(util.hash_filepaths(util.read_names_list(f)))
                     break
 
         file_headers = []
-        for filepath in files_to_compile:
-            filename = os.path.relpath(filepath, self.wad_dirpath)
+        for filepath, filename, path_hash in zip(files_to_compile, filenames, path_hashes):
             # don't include the extracted filepaths list
-            if util.hash_filepath(filename) in (c.INTERNAL_NAMES_FILEPATH_HASH,
-                                                c.COMPRESS_NAMES_FILEPATH_HASH):
+            if path_hash in (c.INTERNAL_NAMES_FILEPATH_HASH,
+                             c.COMPRESS_NAMES_FILEPATH_HASH):
                 continue
 
             file_headers.append(dict(
-                filename=filename, filepath=filepath,
+                filename=filename, filepath=filepath, path_hash=path_hash,
                 compress_level=(
-                    default_compress_level if util.hash_filepath(filename) in compress else
+                    default_compress_level if path_hash in compress else
                     explicit_compress_level
                     )
                 ))
 
-        temp_files = []
         if self.use_internal_names:
             # create a temp file to hold the filenames
             names_tempfile = tempfile.NamedTemporaryFile("w+", delete=False)
@@ -276,6 +519,7 @@ class Ps2WadCompiler:
             file_headers.append(dict(
                 filename=c.INTERNAL_NAMES_FILEPATH,
                 filepath=names_tempfile.name,
+                path_hash=c.INTERNAL_NAMES_FILEPATH_HASH,
                 compress_level=explicit_compress_level
                 ))
 
@@ -284,14 +528,263 @@ class Ps2WadCompiler:
                 )
             names_tempfile.flush()
 
-        wad_files = []
-        if self.parallel_processing:
-            # create temp files to write each process's wad to
+        return file_headers
+
+    def _optimize_layout(self, file_headers, job_count=1):
+        # returns the file headers ordered by load group, and
+        # reports how many seeks loading each group should take
+        filenames = [header["filename"] for header in file_headers]
+        load_groups = self.load_groups
+        if load_groups is None:
+            load_groups = layout.infer_load_groups(filenames)
+        elif isinstance(load_groups, str):
+            with open(load_groups, "r") as f:
+                load_groups = layout.read_load_groups(f)
+
+        matched_groups = layout.match_load_groups(filenames, load_groups)
+
+        # the order the files would've been written in. when compiled
+        # by processes, each process gets every job_count'th file
+        old_order = [
+            i for j in range(job_count) for i in range(j, len(file_headers), job_count)
+            ]
+        new_order = layout.order_by_load_groups(len(file_headers), matched_groups)
+
+        seeks_before = layout.count_group_seeks(old_order, matched_groups)
+        seeks_after  = layout.count_group_seeks(new_order, matched_groups)
+        self.layout_report = {
+            name: dict(
+                file_count=len(matched_groups[name]),
+                seeks_before=seeks_before[name], seeks_after=seeks_after[name],
+                )
+            for name in matched_groups
+            }
+
+        print("%-16s %6s %13s %12s" % ("Load group", "files", "seeks before", "seeks after"))
+        for name, report in self.layout_report.items():
+            print("%-16s %6d %13d %12d" % (
+                name, report["file_count"], report["seeks_before"], report["seeks_after"]
+                ))
+        print("%-16s %6s %13d %12d" % (
+            "Total", "", sum(seeks_before.values()), sum(seeks_after.values())
+            ))
+
+        return [file_headers[i] for i in new_order]
+
+    def _cleanup_temp_files(self, temp_files):
+        # close and cleanup the temp files
+        for file in temp_files:
+            try:
+                file.close()
+                os.unlink(file.name)
+            except Exception:
+                print(format_exc())
+                print(f"Could not clean up temp files '{file.name}'")
+
+    def patch(self, compact=False):
+        '''
+        Updates the wad in place with the files that changed since it was
+        compiled or last patched. Changed files are written into the first
+        space in the wad that no file used before the patch, or at the end.
+        Files are seen as unchanged if their size and md5 match what's in
+        the wad. The md5s are recorded beside the wad so files only need to
+        be hashed when their size or modification time changes.
+
+        The header table is written last, and until then it still points at
+        the old data, which isn't touched. So if the patch is interrupted
+        before then the wad still holds the old files, though it isn't safe
+        against being interrupted while the header table itself is written.
+        Space the old data used is reused by the next patch.
+
+        Files that are unchanged aren't recompressed, even if the compression
+        level changed. If compact is True, or the wad doesn't exist yet, the
+        entire wad is compiled again instead, removing any unused space.
+        '''
+        if compact or not os.path.isfile(self.wad_filepath):
+            overwrite, self.overwrite = self.overwrite, True
+            try:
+                self.compile()
+            finally:
+                self.overwrite = overwrite
+
+            index_filepath = "%s.%s" % (self.wad_filepath, c.PS2_WAD_PATCH_INDEX_EXTENSION)
+            if os.path.isfile(index_filepath):
+                os.remove(index_filepath)
+            return
+
+        temp_files = []
+        try:
+            with telemetry.report(self.telemetry_filepath):
+                self._patch(self._get_compile_file_headers(temp_files))
+        finally:
+            self._cleanup_temp_files(temp_files)
+
+    def _patch(self, compile_headers):
+        chunk_size = c.PS2_WAD_FILE_CHUNK_SIZE
+        old_records = _load_patch_index(self.wad_filepath)
+        new_records = {}
+
+        with open(self.wad_filepath, "r+b") as f:
+            old_headers = util.read_file_headers(f)
+            old_headers_by_hash = {}
+            for header in old_headers:
+                old_headers_by_hash.setdefault(header["path_hash"], header)
+
+            # figure out which files changed, and which are the same
+            file_headers, changed = [], []
+            for header in _make_wad_file_headers(compile_headers):
+                path_hash = header["path_hash"]
+                old_header = old_headers_by_hash.get(path_hash)
+                old_record = old_records.get(str(path_hash))
+                try:
+                    stat = os.stat(header["filepath"])
+                    record = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                    if old_header is None or old_header["uncomp_size"] != stat.st_size:
+                        unchanged = False
+                    elif old_record and all(old_record[k] == record[k] for k in record):
+                        unchanged = True
+                    else:
+                        old_md5 = (old_record or {}).get("md5")
+                        if not old_md5:
+                            old_md5 = hashlib.md5(_read_wad_entry(f, old_header)).hexdigest()
+
+                        with open(header["filepath"], "rb") as fin:
+                            record.update(md5=hashlib.md5(fin.read()).hexdigest())
+                        unchanged = (record["md5"] == old_md5)
+
+                    if unchanged:
+                        record.setdefault("md5", old_record and old_record["md5"])
+                        header = dict(old_header, filename=header["filename"])
+                except Exception:
+                    print(format_exc())
+                    print("Failed to compile '%s'" % header["filepath"])
+                    continue
+
+                if not unchanged:
+                    changed.append((header, old_header))
+
+                file_headers.append(header)
+                new_records[str(path_hash)] = record
+
+            # the header table might grow over the data of some files,
+            # so they'll need to be moved. the rest of the data stays put
+            data_start = 4 + 16*len(file_headers)
+            data_start += util.calculate_padding(data_start, chunk_size)
+            changed_ids = set(id(header) for header, _ in changed)
+            moved = [
+                header for header in file_headers
+                if id(header) not in changed_ids and header["data_pointer"] < data_start
+                ]
+
+            # nothing the old headers point to is written over, including
+            # the old data of changed, removed, and moved files, so the wad
+            # is intact until the new headers are written. that space is
+            # only reused by the next patch. files the header table grows
+            # over may still have data past it, so that part is reserved.
+            used_spans = sorted(set(
+                (max(header["data_pointer"], data_start),
+                 header["data_pointer"] + _get_stored_size(header))
+                for header in old_headers
+                if header["data_pointer"] + _get_stored_size(header) > data_start
+                ))
+
+            for header in moved:
+                print(f"Moving file: %s" % header["filename"])
+                data = _read_wad_entry(f, header, decompress=False)
+                header["data_pointer"] = _allocate_wad_space(
+                    used_spans, _get_stored_size(header), data_start
+                    )
+                f.seek(header["data_pointer"])
+                f.write(data)
+                f.write(b'\x00' * util.calculate_padding(len(data), chunk_size))
+
+            for header, old_header in changed:
+                print(f"Compiling file: %s" % header["filename"])
+                try:
+                    data = _read_wad_file(header)
+                    record = new_records[str(header["path_hash"])]
+                    if "md5" not in record:
+                        with open(header["filepath"], "rb") as fin:
+                            record.update(md5=hashlib.md5(fin.read()).hexdigest())
+                except Exception:
+                    print(format_exc())
+                    print("Failed to compile '%s'" % header["filepath"])
+                    data = b''
+
+                header["data_pointer"] = _allocate_wad_space(
+                    used_spans, _get_stored_size(header), data_start
+                    )
+                f.seek(header["data_pointer"])
+                f.write(data)
+                f.write(b'\x00' * util.calculate_padding(len(data), chunk_size))
+
+            # remove any unused space at the end of the wad
+            f.truncate(max([data_start] + [end for _, end in used_spans]))
+
+            # write the headers last, so the wad is only changed to use the
+            # new data once it's all been written. make sure it's on disk
+            # first, so the headers can't be written before the data is
+            f.flush()
+            os.fsync(f.fileno())
+            get_header_values = lambda h: (
+                h["uncomp_size"], h["data_pointer"], h["path_hash"], h["comp_size"]
+                )
+            if [h["path_hash"] for h in file_headers] == [h["path_hash"] for h in old_headers]:
+                # only the headers of the files that changed need updating
+                for i in range(len(file_headers)):
+                    header_values = get_header_values(file_headers[i])
+                    if header_values != get_header_values(old_headers[i]):
+                        f.seek(4 + 16*i)
+                        f.write(util.INDEX_HEADER_STRUCT.pack(*header_values))
+            else:
+                f.seek(0)
+                util.write_file_headers(file_headers, f)
+
+        print("Patched %s of %s files in wad" % (len(changed), len(file_headers)))
+        _save_patch_index(self.wad_filepath, new_records)
+
+    def compile(self):
+        if not self.overwrite and os.path.isfile(self.wad_filepath):
+            return
+
+        # the temp files are cleaned up even if a job fails, and the
+        # failure is raised before the temp wads are concatenated
+        temp_files = []
+        try:
+            with telemetry.report(self.telemetry_filepath):
+                self._compile(temp_files)
+        finally:
+            self._cleanup_temp_files(temp_files)
+
+    def _compile(self, temp_files):
+        file_headers = self._get_compile_file_headers(temp_files)
+
+        job_count = 1
+        if self.parallel_processing and not self.use_threads:
             job_count = min(os.cpu_count(), len(file_headers))
 
+        if self.optimize_layout:
+            file_headers = self._optimize_layout(file_headers, job_count)
+
+        wad_files = []
+        compile_wad_func = _compile_wad
+        if self.parallel_processing and self.use_threads:
+            # compress on threads in this process, writing directly to the wad
+            compile_wad_func = _compile_wad_threaded
+            file_headers_by_job = [file_headers]
+            wad_files.append(self.wad_filepath)
+        elif self.parallel_processing:
+            # create temp files to write each process's wad to
             file_headers_by_job = tuple([] for i in range(job_count))
-            for i in range(len(file_headers)):
-                file_headers_by_job[i % len(file_headers_by_job)].append(file_headers[i])
+            if self.optimize_layout:
+                # give each process a run of files, so they stay in order
+                for i in range(job_count):
+                    file_headers_by_job[i].extend(file_headers[
+                        i*len(file_headers)//job_count: (i + 1)*len(file_headers)//job_count
+                        ])
+            else:
+                for i in range(len(file_headers)):
+                    file_headers_by_job[i % len(file_headers_by_job)].append(file_headers[i])
 
             for i in range(job_count):
                 wad_tempfile = tempfile.NamedTemporaryFile("wb+", buffering=0, delete=False)
@@ -304,6 +797,7 @@ class Ps2WadCompiler:
         all_job_args = [
             dict(
                 file_headers=file_headers_by_job[i], wad_filepath=wad_files[i],
+                thread_count=self.thread_count, max_queued_size=self.max_queued_size,
                 )
             for i in range(len(wad_files))
             ]
@@ -311,18 +805,9 @@ class Ps2WadCompiler:
         # process the build jobs, and concat the resulting wads
         if all_job_args:
             util.process_jobs(
-                _compile_wad, all_job_args,
+                compile_wad_func, all_job_args,
                 process_count=len(file_headers_by_job)
                 )
 
             if wad_files[0] != self.wad_filepath:
                 util.concat_wad_files(self.wad_filepath, wad_files)
-
-        # close and cleanup the temp files
-        for file in temp_files:
-            try:
-                file.close()
-                os.unlink(file.name)
-            except Exception:
-                print(format_exc())
-                print(f"Could not clean up temp files '{file.name}'")
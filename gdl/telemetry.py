@@ -0,0 +1,202 @@
+import contextlib
+import csv
+import json
+import os
+import threading
+import time
+import traceback
+
+# the phases of building an asset that are measured
+PHASES = (
+    "read", "hash", "decode", "mipmap", "palettize",
+    "stripify", "encode", "write", "serialize",
+    )
+RECORD_FIELDS = (
+    "asset", "asset_type", "phase", "wall_time", "cpu_time",
+    "input_size", "output_size", "skipped",
+    )
+
+# records of everything measured while collecting, or None if not
+_records = None
+_records_lock = threading.Lock()
+# the asset being worked on by each thread
+_local = threading.local()
+
+
+def is_collecting():
+    return _records is not None
+
+
+@contextlib.contextmanager
+def collect(report_filepath=None):
+    '''
+    Collects records of the phases measured while in this context, and
+    yields the list they're collected in. If records are already being
+    collected, this collects into the same list, so several compile steps
+    can be wrapped in one collect to get one report of all of them.
+    If report_filepath is given, a report of the records collected in
+    this context is written to it when the context exits.
+    '''
+    global _records
+    outermost = _records is None
+    if outermost:
+        _records = []
+
+    records, start = _records, len(_records)
+    try:
+        yield records
+    finally:
+        if outermost:
+            _records = None
+
+        if report_filepath:
+            try:
+                write_report(report_filepath, records[start:])
+            except Exception:
+                print(traceback.format_exc())
+                print("Warning: Could not write build report '%s'" % report_filepath)
+
+
+@contextlib.contextmanager
+def report(report_filepath):
+    '''
+    Same as collect, except nothing is collected if report_filepath is
+    empty, unless records are already being collected.
+    '''
+    if not report_filepath:
+        yield _records
+        return
+
+    with collect(report_filepath) as records:
+        yield records
+
+
+@contextlib.contextmanager
+def collect_separately():
+    '''
+    Collects records separately from any already being collected, and
+    yields the list they're collected in. Used by worker processes, which
+    may have been forked while their parent was collecting records.
+    '''
+    global _records
+    prev_records, _records = _records, []
+    try:
+        yield _records
+    finally:
+        _records = prev_records
+
+
+@contextlib.contextmanager
+def asset(name, asset_type=""):
+    '''Sets the asset that phases measured in this thread are recorded for.'''
+    prev_asset = getattr(_local, "asset", None)
+    _local.asset = (name, asset_type)
+    try:
+        yield
+    finally:
+        _local.asset = prev_asset
+
+
+def _make_record(phase, input_size=0, output_size=0, skipped=False):
+    name, asset_type = getattr(_local, "asset", None) or ("", "")
+    return dict(
+        asset=name, asset_type=asset_type, phase=phase,
+        wall_time=0.0, cpu_time=0.0, input_size=input_size,
+        output_size=output_size, skipped=skipped,
+        )
+
+
+@contextlib.contextmanager
+def measure(phase, input_size=0, output_size=0):
+    '''
+    Measures the wall and cpu time of a phase of building the current
+    asset. Yields the record, so the input and output sizes can be set
+    once they're known. Does nothing if records aren't being collected.
+    '''
+    record = _make_record(phase, input_size, output_size)
+    if _records is None:
+        yield record
+        return
+
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    try:
+        yield record
+    finally:
+        record.update(
+            wall_time=time.perf_counter() - start,
+            cpu_time=time.thread_time() - cpu_start,
+            )
+        add_records([record])
+
+
+def record_skipped(name, asset_type=""):
+    '''Records that the asset was skipped, as it was already up to date.'''
+    if _records is not None:
+        with asset(name, asset_type):
+            add_records([_make_record("build", skipped=True)])
+
+
+def add_records(records):
+    # adds records, such as those collected in another process
+    if _records is not None and records:
+        with _records_lock:
+            _records.extend(records)
+
+
+def summarize(records):
+    '''
+    Returns a list of the totals of each asset's records, sorted by the
+    wall time spent on them, and a dict of the totals of each phase.
+    '''
+    assets, phases = {}, {}
+    for record in records:
+        key = (record["asset_type"], record["asset"])
+        asset_totals = assets.setdefault(key, dict(
+            asset=record["asset"], asset_type=record["asset_type"],
+            wall_time=0.0, cpu_time=0.0, input_size=0, output_size=0,
+            skipped=True, phases={},
+            ))
+        phase_totals = phases.setdefault(record["phase"], dict(
+            wall_time=0.0, cpu_time=0.0, input_size=0, output_size=0, count=0,
+            ))
+        for totals in (asset_totals, phase_totals):
+            for k in ("wall_time", "cpu_time", "input_size", "output_size"):
+                totals[k] += record[k]
+
+        phase_totals["count"] += 1
+        # an asset was only skipped if nothing was done to build it
+        asset_totals["skipped"] &= record["skipped"]
+        asset_totals["phases"][record["phase"]] = (
+            asset_totals["phases"].get(record["phase"], 0.0) + record["wall_time"]
+            )
+
+    return sorted(assets.values(), key=lambda a: -a["wall_time"]), phases
+
+
+def write_report(filepath, records):
+    '''
+    Writes the records to a report. If the filepath ends in .csv, each
+    record is written as a row. Otherwise, the records are written as
+    json, along with the totals of each asset and phase.
+    '''
+    dirpath = os.path.dirname(filepath)
+    if dirpath:
+        os.makedirs(dirpath, exist_ok=True)
+
+    if os.path.splitext(filepath)[-1].lower() == ".csv":
+        with open(filepath, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+        return
+
+    assets, phases = summarize(records)
+    with open(filepath, "w") as f:
+        json.dump(
+            dict(
+                assets=assets, phases=phases,
+                skipped_count=sum(1 for a in assets if a["skipped"]),
+                records=records,
+                ),
+            f, indent=1
+            )
@@ -0,0 +1,446 @@
+import binascii
+import io
+import lzma
+import os
+import random
+import struct
+import tempfile
+import time
+import zlib
+
+import setup_tests
+
+from gdl.compilation.arcade_hdd import constants as c
+from gdl.compilation.arcade_hdd import chd
+from gdl.compilation.arcade_hdd import util
+from gdl.compilation.arcade_hdd_compiler import ArcadeHddCompiler
+
+
+SECTOR_COUNT = 4096
+
+# a hunk compressed the way mame's chd lzma codec does it, with the lzma
+# sdk's encoder set to not write an end marker. python's compressor can't
+# leave it out, so this was made with pylzma.compress(hunk, 12, 64, eos=0)
+MAME_LZMA_HUNK_DATA = b"".join(b"HUNK %04d OF A MAME LZMA CHD\n" % i for i in range(142))[:4096]
+MAME_LZMA_HUNK = bytes.fromhex(
+    "00241545df0dfd40c8ea6a0b809dd1e409158412feaa84cb6ea280b9b99e6b3c"
+    "e993b7d9eaad3eef7cfd3af8ce0aa45a00108366b284c0ff4cd7bb5b7cf09c48"
+    "52bed203e1161e66d89db70897348934f27913db7f7a9bf1f95c1a06a8fccb52"
+    "69de4825193bcc94bdd999e87a7c11a26bedbea03a7e185626c79ad514ca77f8"
+    "e6640781e4e8ce4f493a318b9356783d081f68bf98f8fc204ebe8794f1f420ea"
+    "fe2a017d2f5278c62855d241b351418292b7574a9d767c6ed8aab18551204448"
+    "a2c11813bee3f735"
+    )
+
+
+def randbytes(size):
+    # same as random.randbytes, which python 3.8 doesn't have
+    return random.getrandbits(size*8).to_bytes(size, "little") if size else b''
+
+
+def make_block_header(sector_count, data_size, contiguous):
+    # split the sectors into up to 20 fragments, some
+    # of which are right after the one before them
+    fragments, sector = [], random.randrange(SECTOR_COUNT - sector_count*2)
+    while sector_count > 0 and len(fragments) < 40:
+        frag_size = min(sector_count, random.randint(1, 16))
+        if len(fragments) == 38:
+            frag_size = sector_count
+
+        fragments += (sector, frag_size)
+        sector += frag_size + (0 if contiguous else random.randint(0, 3))
+        sector_count -= frag_size
+
+    fragments = tuple(fragments) + (0, 0) * (20 - len(fragments)//2)
+    return util.BlockHeader(
+        data_size=data_size, fragments_pri=fragments,
+        fragments_sec=fragments[2:] + (0, 0)
+        )
+
+
+def read_file_fragments_reference(block_header, rawdata, disc):
+    # reads the fragments one at a time, concatenating them
+    fragments = block_header.fragments_sec if disc == 1 else block_header.fragments_pri
+    data_remaining = block_header.data_size
+    ft_data = b''
+    for i in range(0, len(fragments), 2):
+        read_size = min(data_remaining, fragments[i+1] * c.SECTOR_SIZE)
+        if read_size <= 0:
+            break
+
+        rawdata.seek(fragments[i]*c.SECTOR_SIZE)
+        ft_data += rawdata.read(read_size)
+        data_remaining = max(0, data_remaining - read_size)
+
+    return ft_data
+
+
+class BitWriter:
+    def __init__(self):
+        self.value = self.bit_count = 0
+
+    def write(self, value, count):
+        self.value = (self.value << count) | value
+        self.bit_count += count
+
+    def get_bytes(self):
+        padding = -self.bit_count % 8
+        return (self.value << padding).to_bytes((self.bit_count + padding)//8, 'big')
+
+
+def write_chd(filepath, image_data, hunk_bytes, hunk_plans=None):
+    # writes the image to a v5 chd. each hunk's plan is how to store
+    # it: a codec slot, "none", ("self", hunk_index), or ("compressed",
+    # codec_slot, data) to store it as data compressed some other way.
+    # if there are no plans, the chd is written uncompressed
+    hunk_count = (len(image_data) + hunk_bytes - 1) // hunk_bytes
+    hunks = [
+        image_data[i*hunk_bytes: (i + 1)*hunk_bytes].ljust(hunk_bytes, b'\0')
+        for i in range(hunk_count)
+        ]
+    codecs = (c.CHD_CODEC_NONE,)*4 if hunk_plans is None else (
+        c.CHD_CODEC_ZLIB, c.CHD_CODEC_LZMA, c.CHD_CODEC_NONE, c.CHD_CODEC_NONE
+        )
+    hunk_data = bytearray()
+    if hunk_plans is None:
+        # hunks of all zeros don't need to be stored
+        hunk_data += bytes(hunk_bytes - chd.CHD_V5_HEADER_STRUCT.size)
+        map_data = b''
+        for hunk in hunks:
+            map_data += (len(hunk_data)//hunk_bytes + 1 if any(hunk) else 0).to_bytes(4, 'big')
+            hunk_data += hunk if any(hunk) else b''
+    else:
+        # every map value is coded in 4 bits, stored as a
+        # run of 16 4s, so each type's code is its value
+        types, map_bits, raw_map = BitWriter(), BitWriter(), bytearray()
+        types.write(1, 4); types.write(4, 4); types.write(13, 4)
+
+        last_type, last_self, run = None, 0, 0
+        for i, (hunk, plan) in enumerate(zip(hunks, hunk_plans)):
+            offset = chd.CHD_V5_HEADER_STRUCT.size + len(hunk_data)
+            crc = binascii.crc_hqx(hunk, 0xFFFF)
+            if plan == "none":
+                hunk_type, map_type, length = c.CHD_COMPRESSION_NONE, None, hunk_bytes
+                hunk_data += hunk
+            elif isinstance(plan, tuple) and plan[0] == "self":
+                hunk_type, offset, length, crc = c.CHD_COMPRESSION_SELF, plan[1], 0, 0
+                map_type = (
+                    c.CHD_COMPRESSION_SELF_0 if offset == last_self else
+                    c.CHD_COMPRESSION_SELF_1 if offset == last_self + 1 else
+                    c.CHD_COMPRESSION_SELF
+                    )
+                last_self = offset
+            elif isinstance(plan, tuple):
+                _, hunk_type, data = plan
+                map_type, length = None, len(data)
+                hunk_data += data
+            else:
+                compressor = (
+                    zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS) if plan == 0 else
+                    lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[chd._get_lzma_filter(hunk_bytes)])
+                    )
+                data = compressor.compress(hunk) + compressor.flush()
+                hunk_type, map_type, length = plan, None, len(data)
+                hunk_data += data
+
+            map_type = hunk_type if map_type is None else map_type
+            if map_type == last_type and map_type != c.CHD_COMPRESSION_SELF:
+                run += 1
+            else:
+                run = 0
+                types.write(map_type, 4)
+
+            # hunks repeating the last type are written as a run when it ends
+            next_plan = hunk_plans[i + 1] if i + 1 < len(hunk_plans) else None
+            if run and next_plan != plan:
+                while run:
+                    if run < 3:
+                        types.write(map_type, 4)
+                        run -= 1
+                    elif run < 19:
+                        types.write(c.CHD_COMPRESSION_RLE_SMALL, 4)
+                        types.write(run - 3, 4)
+                        run = 0
+                    else:
+                        count = min(run, 19 + 0xFF)
+                        types.write(c.CHD_COMPRESSION_RLE_LARGE, 4)
+                        types.write((count - 19) >> 4, 4)
+                        types.write((count - 19) & 15, 4)
+                        run -= count
+
+            last_type = map_type
+            if hunk_type == c.CHD_COMPRESSION_SELF:
+                if map_type == c.CHD_COMPRESSION_SELF:
+                    map_bits.write(offset, 8)
+            else:
+                if hunk_type != c.CHD_COMPRESSION_NONE:
+                    map_bits.write(length, 16)
+                map_bits.write(crc, 16)
+
+            raw_map += (
+                (hunk_type << 88) | (length << 64) | (offset << 16) | crc
+                ).to_bytes(12, 'big')
+
+        types.write(map_bits.value, map_bits.bit_count)
+        map_data = types.get_bytes()
+        map_data = chd.CHD_V5_MAP_HEADER_STRUCT.pack(
+            len(map_data), chd.CHD_V5_HEADER_STRUCT.size.to_bytes(6, 'big'),
+            binascii.crc_hqx(raw_map, 0xFFFF), 16, 8, 0
+            ) + map_data
+
+    with open(filepath, "wb") as f:
+        f.write(chd.CHD_V5_HEADER_STRUCT.pack(
+            c.CHD_SIGNATURE, chd.CHD_V5_HEADER_STRUCT.size, c.CHD_V5_VERSION,
+            *codecs, len(image_data), chd.CHD_V5_HEADER_STRUCT.size + len(hunk_data),
+            0, hunk_bytes, c.SECTOR_SIZE, bytes(20), bytes(20), bytes(20)
+            ))
+        f.write(hunk_data)
+        f.write(map_data)
+
+
+def write_hdd_image(filepath, files):
+    # writes a minimal hdd image holding the files, which map paths
+    # to their data. returns the image's data so it can be modified
+    sector_data = [bytes(c.SECTOR_SIZE*2)]  # partition and mbr blocks
+    def add_data(data):
+        sector = sum(len(d) for d in sector_data) // c.SECTOR_SIZE
+        sector_data.append(data + bytes(-len(data) % c.SECTOR_SIZE))
+        return sector, (len(data) + c.SECTOR_SIZE - 1) // c.SECTOR_SIZE
+
+    # the file table, unknown file, and root directory come first
+    entries = [None, (c.FILE_BLOCK_TYPE_REGULAR, b'unknown'), None]
+    dirs = {"": 2}
+    for path in sorted(files):
+        parts = path.split("/")
+        for i in range(1, len(parts)):
+            dirname = "/".join(parts[:i])
+            if dirname not in dirs:
+                dirs[dirname] = len(entries)
+                entries.append(None)
+        entries.append((c.FILE_BLOCK_TYPE_REGULAR, files[path]))
+        dirs[path] = len(entries) - 1
+
+    dir_lists = {}
+    for path, index in dirs.items():
+        if path:
+            parent, _, name = path.rpartition("/")
+            dir_lists.setdefault(parent, b'')
+            dir_lists[parent] += struct.pack(
+                "<HHB", index, 0x100, len(name)
+                ) + name.encode("latin-1")
+
+    for path, index in dirs.items():
+        if entries[index] is None:
+            entries[index] = (c.FILE_BLOCK_TYPE_DIRECTORY, dir_lists.get(path, b''))
+
+    def pack_header(block_type, file_type, data_size, sector, sector_count):
+        fragments = struct.pack("<40I", sector, sector_count, *[0]*38)
+        return struct.pack(
+            "<3I2B2x8x", block_type, data_size, sector_count, 1, file_type
+            ) + fragments*3
+
+    header_sectors = []
+    for file_type, data in entries[1:]:
+        sector, count = add_data(data)
+        header_sectors.append(add_data(pack_header(
+            c.REGULAR_FILE_SIG, file_type, len(data), sector, count
+            ))[0])
+
+    # the file table is last, and lists its own header first
+    table_size = 12*len(entries)
+    table_sector = sum(len(d) for d in sector_data) // c.SECTOR_SIZE
+    table_header_sector = table_sector + (table_size + c.SECTOR_SIZE - 1) // c.SECTOR_SIZE
+    header_sectors.insert(0, table_header_sector)
+    add_data(b''.join(struct.pack("<3I", *(s,)*3) for s in header_sectors))
+    add_data(pack_header(
+        c.FILE_TABLE_SIG, c.FILE_BLOCK_TYPE_REGULAR, table_size,
+        table_sector, table_header_sector - table_sector
+        ))
+
+    image_data = bytearray(b''.join(sector_data))
+    struct.pack_into("<I", image_data, c.SECTOR_SIZE, c.MBR_HEADER_SIG)
+    struct.pack_into("<I", image_data, c.SECTOR_SIZE + 56, c.UNKNOWN_MBR_SIG)
+    struct.pack_into("<3I", image_data, c.SECTOR_SIZE + 68, *(table_header_sector,)*3)
+    with open(filepath, "wb") as f:
+        f.write(image_data)
+
+    return image_data
+
+
+random.seed(0)
+image_data = randbytes(SECTOR_COUNT * c.SECTOR_SIZE)
+block_headers = [
+    make_block_header(sector_count, data_size, contiguous)
+    for contiguous in (False, True)
+    for sector_count in (0, 1, 5, 40, 300)
+    for data_size in (
+        0, sector_count*c.SECTOR_SIZE, max(0, sector_count*c.SECTOR_SIZE - 100),
+        sector_count*c.SECTOR_SIZE + 5000
+        )
+    ]
+# a file running past the end of the image
+block_headers.append(util.BlockHeader(
+    data_size=10*c.SECTOR_SIZE,
+    fragments_pri=(SECTOR_COUNT - 4, 4, 0, 6) + (0, 0)*18
+    ))
+
+# runs only merge fragments that are right after each other
+assert util.get_fragment_runs((3, 2, 5, 1, 7, 1, 0, 0), 10*c.SECTOR_SIZE) == [
+    [3*c.SECTOR_SIZE, 3*c.SECTOR_SIZE], [7*c.SECTOR_SIZE, c.SECTOR_SIZE]
+    ]
+assert util.get_fragment_runs((3, 2, 5, 1, 7, 1), c.SECTOR_SIZE + 10) == [
+    [3*c.SECTOR_SIZE, c.SECTOR_SIZE + 10]
+    ]
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    image_filepath = os.path.join(temp_dir, "hdd.img")
+    with open(image_filepath, "wb") as f:
+        f.write(image_data)
+
+    for use_mmap, thread_safe in ((False, False), (True, False), (False, True)):
+        with util.open_hdd_image(image_filepath, use_mmap, thread_safe) as fin:
+            for rawdata in (fin, io.BytesIO(image_data), image_data):
+                for block_header in block_headers:
+                    for disc in (0, 1):
+                        data = util.read_file_fragments(
+                            block_header=block_header, rawdata=rawdata, disc=disc
+                            )
+                        expected = read_file_fragments_reference(
+                            block_header, io.BytesIO(image_data), disc
+                            )
+                        assert data == expected, (use_mmap, thread_safe, type(rawdata), disc)
+
+    # time reading a file in many fragments both ways
+    block_header = make_block_header(2000, 2000*c.SECTOR_SIZE, True)
+    for use_mmap in (False, True):
+        with util.open_hdd_image(image_filepath, use_mmap) as fin:
+            start = time.time()
+            for i in range(100):
+                util.read_file_fragments(block_header=block_header, rawdata=fin)
+            elapsed = time.time() - start
+
+        print("use_mmap: %-5s read %d fragments 100 times in %6.3f sec" % (
+            use_mmap, len(block_header.fragments_pri)//2, elapsed
+            ))
+
+    with open(image_filepath, "rb") as fin:
+        start = time.time()
+        for i in range(100):
+            read_file_fragments_reference(block_header, fin, 0)
+
+        print("reading fragments one at a time took %6.3f sec" % (time.time() - start))
+
+    # chds should read back as the same image, however they're stored
+    hunk_bytes = 8*c.SECTOR_SIZE
+    chd_image_data = bytearray(image_data[: 60*hunk_bytes + 1000])
+    chd_image_data[20*hunk_bytes: 24*hunk_bytes] = bytes(4*hunk_bytes)
+    hunk_plans = (
+        [0]*5 + [1]*5 + ["none", ("self", 3), ("self", 3), ("self", 4)] +
+        [0]*25 + [1]*6 + [("self", 0), ("self", 1), ("self", 2)] + [0]*12 + ["none"]
+        )
+    assert len(hunk_plans) == (len(chd_image_data) + hunk_bytes - 1) // hunk_bytes
+    for i, plan in enumerate(hunk_plans):
+        if isinstance(plan, tuple):
+            chd_image_data[i*hunk_bytes: (i + 1)*hunk_bytes] = \
+                chd_image_data[plan[1]*hunk_bytes: (plan[1] + 1)*hunk_bytes]
+
+    chd_filepath = os.path.join(temp_dir, "hdd.chd")
+    for plans in (hunk_plans, None):
+        write_chd(chd_filepath, chd_image_data, hunk_bytes, plans)
+        assert util.is_arcade_chd(chd_filepath)
+
+        for cache_size, thread_count in ((c.CHD_HUNK_CACHE_SIZE, None), (2*hunk_bytes, 1)):
+            with chd.ChdFile(chd_filepath, cache_size, thread_count) as chd_file:
+                assert chd_file.read() == chd_image_data
+                for pos, size in ((5, 10), (hunk_bytes - 5, 10), (len(chd_image_data) - 5, 10),
+                                  (3*hunk_bytes, 20*hunk_bytes), (len(chd_image_data) + 5, 10)):
+                    chd_file.seek(pos)
+                    assert chd_file.read(size) == chd_image_data[pos: pos + size], (pos, size)
+
+        with util.open_hdd_image(chd_filepath, True) as chd_file:
+            assert isinstance(chd_file, chd.ChdFile)
+            for block_header in block_headers[:-1]:
+                for disc in (0, 1):
+                    data = util.read_file_fragments(
+                        block_header=block_header, rawdata=chd_file, disc=disc
+                        )
+                    expected = read_file_fragments_reference(
+                        block_header, io.BytesIO(chd_image_data), disc
+                        )
+                    assert data == expected
+
+    # hunks compressed by mame decode, even without the lzma end marker
+    assert len(MAME_LZMA_HUNK_DATA) == hunk_bytes
+    compressor = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[chd._get_lzma_filter(hunk_bytes)])
+    assert compressor.compress(MAME_LZMA_HUNK_DATA) + compressor.flush() != MAME_LZMA_HUNK
+
+    mame_image_data = MAME_LZMA_HUNK_DATA*2 + chd_image_data[: hunk_bytes]
+    write_chd(chd_filepath, mame_image_data, hunk_bytes, [("compressed", 1, MAME_LZMA_HUNK), 1, 1])
+    with chd.ChdFile(chd_filepath) as chd_file:
+        assert chd_file.read_hunk(0) == MAME_LZMA_HUNK_DATA
+        assert chd_file.read() == mame_image_data
+
+    # the directory listing is saved beside the image, and used until it changes
+    hdd_files = {
+        "/%s/FILE%d.BIN" % (dirname, i): randbytes(random.randrange(3000))
+        for dirname in ("A", "A/B", "C") for i in range(5)
+        }
+    hdd_files["/EMPTY.BIN"] = b''
+    hdd_filepath = os.path.join(temp_dir, "index.img")
+    hdd_image_data = write_hdd_image(hdd_filepath, hdd_files)
+    hdd_chd_filepath = os.path.join(temp_dir, "index.chd")
+    write_chd(hdd_chd_filepath, hdd_image_data, hunk_bytes, [0]*(
+        (len(hdd_image_data) + hunk_bytes - 1) // hunk_bytes
+        ))
+
+    read_file_headers = util.read_file_headers
+    def read_file_headers_indexed(**kwargs):
+        raise AssertionError("Index was not used.")
+
+    for filepath in (hdd_filepath, hdd_chd_filepath):
+        index_filepath = "%s.%s" % (filepath, c.HDD_INDEX_EXTENSION)
+        assert not os.path.isfile(index_filepath)
+        for indexed in (False, True):
+            util.read_file_headers = read_file_headers_indexed if indexed else read_file_headers
+            try:
+                compiler = ArcadeHddCompiler(hdd_filepath=filepath, hdd_dirpath=temp_dir)
+                compiler.load_hdd()
+            finally:
+                util.read_file_headers = read_file_headers
+
+            assert os.path.isfile(index_filepath)
+            assert set(compiler.flat_file_map) == set(hdd_files) | {"/unknown"}
+            file_datas = compiler.extract_files(filenames=list(hdd_files))
+            assert file_datas == hdd_files, (filepath, indexed)
+
+    # changing the file table should cause the image to be parsed again
+    hdd_image_data[-c.SECTOR_SIZE: -c.SECTOR_SIZE + 8] = b'\xff'*8
+    for image_stat in (os.stat(hdd_filepath), None):
+        with open(hdd_filepath, "r+b") as f:
+            f.write(hdd_image_data)
+
+        if image_stat:
+            # even if it looks like the image wasn't modified
+            os.utime(hdd_filepath, ns=(image_stat.st_atime_ns, image_stat.st_mtime_ns))
+
+        assert util.load_hdd_index(hdd_filepath) is None
+
+    # extracting with threads or processes should extract the same files
+    write_hdd_image(hdd_filepath, hdd_files)
+    for filepath in (hdd_filepath, hdd_chd_filepath):
+        for use_threads in (True, False):
+            extract_dirpath = os.path.join(temp_dir, "extract_%s" % use_threads)
+            compiler = ArcadeHddCompiler(
+                hdd_filepath=filepath, hdd_dirpath=extract_dirpath,
+                use_threads=use_threads, overwrite=True,
+                )
+            compiler.load_hdd()
+            start = time.time()
+            compiler.extract_files_to_disk()
+            print("use_threads: %-5s extracted in %6.3f sec" % (use_threads, time.time() - start))
+            for filename, data in hdd_files.items():
+                extract_filepath = os.path.join(extract_dirpath, filename.lstrip("/"))
+                assert os.path.isfile(extract_filepath) == bool(data), filename
+                if data:
+                    with open(extract_filepath, "rb") as f:
+                        assert f.read() == data, (filepath, use_threads, filename)
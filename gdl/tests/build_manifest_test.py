@@ -0,0 +1,116 @@
+import hashlib
+import os
+import tempfile
+
+import setup_tests
+
+from gdl.compilation.g3d import build_manifest
+from gdl.compilation.g3d.build_manifest import BuildManifest
+
+
+hash_count = 0
+hash_file = build_manifest.hash_file
+
+
+def counting_hash_file(filepath, *args, **kwargs):
+    global hash_count
+    hash_count += 1
+    return hash_file(filepath, *args, **kwargs)
+
+
+build_manifest.hash_file = counting_hash_file
+
+
+def write_file(filepath, data):
+    with open(filepath, "wb") as f:
+        f.write(data)
+
+
+def touch(filepath, offset_ns=10**9):
+    # change the mtime without changing the contents
+    stat = os.stat(filepath)
+    os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + offset_ns))
+
+
+OPTIONS = dict(format_name="ABGR_8888", mipmaps=2)
+
+with tempfile.TemporaryDirectory() as data_dir:
+    asset_filepath = os.path.join(data_dir, "TEX.png")
+    cache_filepath = os.path.join(data_dir, "TEX.ps2")
+    write_file(asset_filepath, b'source data')
+    write_file(cache_filepath, b'compiled data')
+
+    # nothing is up to date without a manifest
+    manifest = BuildManifest(data_dir)
+    assert manifest.records == {}
+    source_md5 = manifest.get_source_md5("ps2", asset_filepath)
+    assert source_md5 == hashlib.md5(b'source data').digest()
+    assert not manifest.is_up_to_date("ps2", asset_filepath, cache_filepath, source_md5, OPTIONS)
+
+    manifest.record_asset("ps2", asset_filepath, cache_filepath, source_md5, OPTIONS)
+    manifest.save()
+    assert os.path.isfile(manifest.filepath)
+
+    # the recorded stat matches, so the source isn't hashed again
+    hash_count = 0
+    manifest = BuildManifest(data_dir)
+    assert manifest.get_source_md5("ps2", asset_filepath) == source_md5
+    assert manifest.is_up_to_date("ps2", asset_filepath, cache_filepath, source_md5, OPTIONS)
+    assert hash_count == 0
+    assert not manifest.modified
+
+    # touched but unchanged, so it's hashed once and is still up to date
+    touch(asset_filepath)
+    assert manifest.get_source_md5("ps2", asset_filepath) == source_md5
+    assert manifest.is_up_to_date("ps2", asset_filepath, cache_filepath, source_md5, OPTIONS)
+    assert hash_count == 1
+    manifest.save()
+
+    # and the new stat was recorded, so it isn't hashed the next time
+    manifest = BuildManifest(data_dir)
+    assert manifest.get_source_md5("ps2", asset_filepath) == source_md5
+    assert hash_count == 1
+
+    # a source compiled to several targets is only hashed once for all of them
+    touch(asset_filepath)
+    for asset_type in ("ps2", "ngc", "xbox", "ps2"):
+        assert manifest.get_source_md5(asset_type, asset_filepath) == source_md5
+    assert hash_count == 2
+
+    # and is hashed again if it changes after that
+    touch(asset_filepath)
+    assert manifest.get_source_md5("ngc", asset_filepath) == source_md5
+    assert hash_count == 3
+
+    # different compile options or target need recompiling
+    assert not manifest.is_up_to_date(
+        "ps2", asset_filepath, cache_filepath, source_md5, dict(OPTIONS, mipmaps=0)
+        )
+    assert not manifest.is_up_to_date("ngc", asset_filepath, cache_filepath, source_md5, OPTIONS)
+
+    # as does a cache file changed outside of a compile
+    touch(cache_filepath)
+    assert not manifest.is_up_to_date("ps2", asset_filepath, cache_filepath, source_md5, OPTIONS)
+    manifest.record_asset("ps2", asset_filepath, cache_filepath, source_md5, OPTIONS)
+    assert manifest.is_up_to_date("ps2", asset_filepath, cache_filepath, source_md5, OPTIONS)
+
+    # and a changed source
+    write_file(asset_filepath, b'changed source data')
+    new_md5 = manifest.get_source_md5("ps2", asset_filepath)
+    assert new_md5 == hashlib.md5(b'changed source data').digest()
+    assert not manifest.is_up_to_date("ps2", asset_filepath, cache_filepath, new_md5, OPTIONS)
+
+    # a corrupt or outdated manifest is treated like there isn't one
+    for manifest_data in (b'{"version": 1, "records": {"ps2', b'\x00garbage', b'[]',
+                          b'{"version": 0, "records": {}}'):
+        write_file(manifest.filepath, manifest_data)
+        manifest = BuildManifest(data_dir)
+        assert manifest.records == {}, manifest_data
+        assert not manifest.is_up_to_date("ps2", asset_filepath, cache_filepath, new_md5, OPTIONS)
+
+    # and is replaced the next time it's saved
+    manifest.record_asset("ps2", asset_filepath, cache_filepath, new_md5, OPTIONS)
+    manifest.save()
+    assert BuildManifest(data_dir).is_up_to_date(
+        "ps2", asset_filepath, cache_filepath, new_md5, OPTIONS
+        )
@@ -0,0 +1,32 @@
+# jobs run in worker processes by the tests. these are kept out of the
+# test scripts, since pytest runs the tests while importing the script,
+# and pickling a job defined in it would wait on the import to finish.
+import time
+
+import setup_tests
+
+from gdl import telemetry, util
+
+
+def square_job(kwargs):
+    if kwargs.get("fail"):
+        raise ValueError("Job %s failed on purpose." % kwargs["value"])
+
+    time.sleep(kwargs.get("sleep", 0))
+    return kwargs["value"]**2
+
+
+def read_payload_job(kwargs):
+    # returns the slice of the payload, and the shared value, to check
+    # they got to the worker without being copied into the job's args
+    payload = util.get_shared_job_data("payload")
+    return payload.read(kwargs["offset"], kwargs["size"]) + util.get_shared_job_data("suffix")
+
+
+def build_job(kwargs):
+    with telemetry.asset(kwargs["name"], "test"):
+        with telemetry.measure("decode", input_size=kwargs["size"]) as record:
+            record["output_size"] = len(bytes(kwargs["size"]*2))
+        with telemetry.measure("write", output_size=kwargs["size"]*2):
+            if kwargs.get("fail"):
+                raise ValueError("Job %s failed on purpose." % kwargs["name"])
@@ -0,0 +1,99 @@
+import pickle
+import time
+
+import setup_tests
+
+from gdl import util
+from job_functions import square_job, read_payload_job
+
+
+all_job_args = [dict(value=i) for i in range(10)]
+all_job_args[3]["fail"] = True
+expected = [i**2 for i in range(10) if i != 3]
+
+for process_count in (1, 2):
+    # results come back in job order, regardless of the order jobs ran in
+    finished = []
+    results = util.process_jobs(
+        square_job, all_job_args, process_count=process_count,
+        costs=[(i*7) % 10 for i in range(10)],
+        callback=lambda job_args, result: finished.append(job_args["value"]),
+        raise_errors=False
+        )
+    assert results == expected, (process_count, results)
+    assert sorted(finished) == [i for i in range(10) if i != 3]
+
+    if process_count == 1:
+        # the most costly jobs are run first
+        assert finished == sorted(finished, key=lambda i: -((i*7) % 10)), finished
+
+    # by default, a failed job is raised and the jobs after it are cancelled
+    finished = []
+    try:
+        util.process_jobs(
+            square_job, [dict(value=i, sleep=0.05) for i in range(20)] + [dict(value=20, fail=True)],
+            process_count=process_count, costs=[0]*20 + [1],
+            callback=lambda job_args, result: finished.append(job_args["value"])
+            )
+        raise AssertionError("Failed job was not raised.")
+    except ValueError:
+        pass
+
+    assert len(finished) < 20, (process_count, len(finished))
+
+# cost functions work the same as cost lists
+finished = []
+util.process_jobs(
+    square_job, all_job_args, process_count=1,
+    costs=lambda job_args: job_args["value"],
+    callback=lambda job_args, result: finished.append(job_args["value"]),
+    raise_errors=False
+    )
+assert finished == [9, 8, 7, 6, 5, 4, 2, 1, 0], finished
+
+# cancelling stops jobs that haven't started yet from running
+for process_count in (1, 2):
+    with util.JobScheduler(process_count) as scheduler:
+        def cancel_after_first(job_args, result):
+            scheduler.cancel()
+
+        results = scheduler.run_jobs(
+            square_job, [dict(value=i, sleep=0.05) for i in range(20)],
+            callback=cancel_after_first
+            )
+        assert scheduler.cancelled
+        assert 1 <= len(results) < 20, (process_count, len(results))
+
+# the pool is shut down when the scheduler is closed
+with util.JobScheduler(2) as scheduler:
+    scheduler.run_jobs(square_job, all_job_args[:2])
+    processes = list(scheduler._executor._processes.values())
+    assert processes
+
+assert scheduler._executor is None
+assert not any(process.is_alive() for process in processes)
+
+# a large job started last leaves the pool idle while it runs
+# alone, but started first it runs alongside the small jobs
+all_job_args = [dict(value=i, sleep=0.05) for i in range(8)] + [dict(value=8, sleep=0.4)]
+for costs in (None, [job_args["sleep"] for job_args in all_job_args]):
+    start = time.time()
+    util.process_jobs(square_job, all_job_args, process_count=2, costs=costs)
+    print("costs: %-5s ran jobs in %.3f sec" % (costs is not None, time.time() - start))
+
+# payloads and shared data are sent to each worker once, not every job
+datas = [bytes([i])*(i*1000) for i in range(20)]
+for process_count in (1, 2):
+    with util.SharedPayload(datas, process_count > 1) as payload:
+        assert (payload.name is not None) == (process_count > 1)
+        all_job_args = [dict(offset=offset, size=size) for offset, size in payload.spans]
+        results = util.process_jobs(
+            read_payload_job, all_job_args, process_count=process_count,
+            shared_job_data=dict(payload=payload, suffix=b'end')
+            )
+        assert results == [data + b'end' for data in datas], process_count
+        if payload.name:
+            # only the name of the shared memory is pickled
+            assert len(pickle.dumps(payload)) < 200
+
+    assert util.get_shared_job_data("payload") is None
@@ -0,0 +1,129 @@
+import hashlib
+import io
+import os
+import random
+import tempfile
+import time
+
+import setup_tests
+
+from gdl.compilation.g3d.serialization import model
+from gdl.compilation.g3d.serialization.model import G3DModel
+
+
+GRID_SIZE = 160
+
+
+def make_obj_text(unusual=False):
+    vert_lines, uv_lines, norm_lines, lm_uv_lines, color_lines = [], [], [], [], []
+    for y in range(GRID_SIZE):
+        for x in range(GRID_SIZE):
+            vert_lines.append("v %.7f %.7f %.7f" % (
+                x*0.5 - 4, random.uniform(-2, 2), y*0.5 - 4
+                ))
+            uv_lines.append("vt %.7f %.7f" % (x/4, y/GRID_SIZE))
+            norm_lines.append("vn %.7f %.7f %.7f" % (
+                random.uniform(-1, 1), 1.0, random.uniform(-1, 1)
+                ))
+            lm_uv_lines.append("#lmvt %.7f %.7f" % (x/GRID_SIZE, y/GRID_SIZE))
+            color_lines.append("#vc %.7f %.7f %.7f 1.0000000" % (
+                random.random(), random.random(), random.random()
+                ))
+
+    if unusual:
+        # things that can't be parsed in bulk
+        vert_lines[1]  = "v 1.0 2.0 3.0 1.0"
+        norm_lines[2]  = "vn\t0 0 0"
+        uv_lines[3]    = "vt  .5  1e-3 0"
+        color_lines[4] = "# vc 2 -1 0.5 1"
+
+    face_lines = []
+    for y in range(GRID_SIZE - 1):
+        if y % 40 == 0:
+            face_lines.extend((
+                "#$lm_name LMAP%d" % (y//80),
+                "#$lod_k %d" % y,
+                "usemtl TEX%%20%d" % (y//40),
+                "g %d" % y,
+                ))
+
+        for x in range(GRID_SIZE - 1):
+            v0 = y*GRID_SIZE + x + 1
+            v1, v2, v3 = v0 + 1, v0 + GRID_SIZE, v0 + GRID_SIZE + 1
+            face_lines.append("f %s/%s/%s %s/%s/%s %s/%s/%s" % ((v0,)*3 + (v2,)*3 + (v1,)*3))
+            face_lines.append("f %s/%s/%s %s/%s/%s %s/%s/%s" % ((v1,)*3 + (v2,)*3 + (v3,)*3))
+
+    if unusual:
+        face_lines[5] = "f 1/1 2/2 3/3 4/4"
+
+    return "\n".join((
+        "# test model", "mtllib test.mtl", *vert_lines, *norm_lines,
+        *uv_lines, *lm_uv_lines, *color_lines, *face_lines
+        ))
+
+
+def import_model(obj_text, use_numpy):
+    numpy_module = model.numpy
+    model.numpy = numpy_module if use_numpy else None
+    try:
+        g3d_model = G3DModel()
+        start = time.time()
+        g3d_model.import_obj(io.StringIO(obj_text))
+        g3d_model.verts  # make sure any arrays are converted to lists
+        return g3d_model, time.time() - start
+    finally:
+        model.numpy = numpy_module
+
+
+for unusual in (False, True):
+    random.seed(0)
+    obj_text = make_obj_text(unusual)
+
+    list_model, list_time = import_model(obj_text, False)
+    if model.numpy is None:
+        print("numpy not installed. only tested line-by-line import")
+        break
+
+    bulk_model, bulk_time = import_model(obj_text, True)
+
+    # bulk importing must give the exact same results
+    assert bulk_model.bnd_rad == list_model.bnd_rad
+    assert bulk_model.lod_ks == list_model.lod_ks
+    assert bulk_model.tri_lists == list_model.tri_lists
+    for name in ("verts", "norms", "uvs", "lm_uvs", "colors"):
+        assert getattr(bulk_model, name) == getattr(list_model, name), name
+
+    print("unusual: %-5s %6d tris  line-by-line: %6.3f sec  bulk: %6.3f sec" % (
+        unusual, sum(map(len, list_model.tri_lists.values())), list_time, bulk_time
+        ))
+
+
+# exporting should write the same triangles that are imported, and
+# calculate the hash of the obj as it streams it to the file
+export_model = G3DModel()
+export_model.verts  = bulk_model.verts
+export_model.norms  = bulk_model.norms
+export_model.uvs    = bulk_model.uvs
+export_model.lm_uvs = bulk_model.lm_uvs
+export_model.colors = bulk_model.colors
+export_model.lod_ks = dict(bulk_model.lod_ks)
+export_model.tri_lists = {
+    idx_key: [sum(tri, ()) for tri in tris]
+    for idx_key, tris in bulk_model.tri_lists.items()
+    }
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    obj_filepath = os.path.join(temp_dir, "test.obj")
+    start = time.time()
+    export_model.export_obj(obj_filepath)
+    export_time = time.time() - start
+
+    with open(obj_filepath, "rb") as f:
+        obj_data = f.read()
+
+assert hashlib.md5(obj_data).digest() == export_model.source_file_hash
+
+reimported_model, _ = import_model(obj_data.decode(), True)
+assert reimported_model.tri_lists == bulk_model.tri_lists
+
+print("exported %.2f MB obj in %6.3f sec" % (len(obj_data)/1000000, export_time))
@@ -0,0 +1,103 @@
+import random
+import time
+
+import setup_tests
+
+from gdl.supyr_struct_ext import FixedBytearrayBuffer
+from gdl.compilation.g3d.serialization import model_vif
+from gdl.compilation.g3d.serialization.model import G3DModel
+
+
+GRID_SIZE = 48
+
+
+def make_obj_lines(materials=("TEX_A", "TEX_B", "TEX_C"), lightmap=True, colors=True):
+    lines = []
+    for y in range(GRID_SIZE):
+        for x in range(GRID_SIZE):
+            lines.append("v %f %f %f" % (
+                x*0.5 - 4, random.uniform(-2, 2), y*0.5 - 4
+                ))
+            lines.append("vt %f %f" % (x/4, y/GRID_SIZE))
+            lines.append("vn %f %f %f" % (
+                random.uniform(-1, 1), 1.0, random.uniform(-1, 1)
+                ))
+            if lightmap:
+                lines.append("#lmvt %f %f" % (x/GRID_SIZE, y/GRID_SIZE))
+            if colors:
+                lines.append("#vc %f %f %f 1.0" % (
+                    random.random(), random.random(), random.random()
+                    ))
+
+    for y in range(GRID_SIZE - 1):
+        if y % 16 == 0:
+            if lightmap:
+                lines.append("#$lm_name LMAP")
+            lines.append("usemtl %s" % materials[(y//16) % len(materials)])
+
+        for x in range(GRID_SIZE - 1):
+            if random.random() < 0.05:
+                continue  # leave some holes
+
+            v0 = y*GRID_SIZE + x + 1
+            v1, v2, v3 = v0 + 1, v0 + GRID_SIZE, v0 + GRID_SIZE + 1
+            lines.append("f %s/%s/%s %s/%s/%s %s/%s/%s" % ((v0,)*3 + (v2,)*3 + (v1,)*3))
+            lines.append("f %s/%s/%s %s/%s/%s %s/%s/%s" % ((v1,)*3 + (v2,)*3 + (v3,)*3))
+
+    return lines
+
+
+def import_model(vif_data, use_numpy):
+    numpy_module = model_vif.numpy
+    model_vif.numpy = numpy_module if use_numpy else None
+    try:
+        g3d_model = G3DModel()
+        start = time.time()
+        # import twice to test appending to existing geometry
+        for i in range(2):
+            g3d_model.import_g3d(FixedBytearrayBuffer(vif_data))
+        return g3d_model, time.time() - start
+    finally:
+        model_vif.numpy = numpy_module
+
+
+for target in ("target_ps2", "target_ngc", "target_xbox"):
+    for lightmap, colors in ((True, True), (False, False), (False, True)):
+        random.seed(0)
+        g3d_model = G3DModel(**{target: True})
+        g3d_model.import_obj(make_obj_lines(lightmap=lightmap, colors=colors))
+        g3d_model.make_strips()
+
+        buffer = FixedBytearrayBuffer()
+        g3d_model.export_g3d(buffer, headerless=True)
+        vif_data = bytes(buffer)
+
+        list_model, list_time = import_model(vif_data, False)
+        if model_vif.numpy is None:
+            print("%-11s numpy not installed. only tested list import" % target)
+            continue
+
+        array_model, array_time = import_model(vif_data, True)
+
+        # check the array-backed data before the list view converts it
+        vert_count = array_model.vert_count
+        assert array_model.get_vertex_array("verts").shape == (vert_count, 3)
+        assert array_model.get_vertex_array("norms").shape == (len(list_model.norms), 3)
+        assert array_model.get_vertex_array("colors").shape == (len(list_model.colors), 4)
+        assert array_model.get_vertex_array("lm_uvs").shape == (len(list_model.lm_uvs), 2)
+        for idx_key, tris in list_model.tri_lists.items():
+            assert array_model.get_tri_array(idx_key).tolist() == [
+                list(tri[::3]) for tri in tris
+                ], idx_key
+
+        # the list view must match the list-based importer exactly
+        assert array_model.bnd_rad == list_model.bnd_rad
+        for name in ("verts", "norms", "uvs", "lm_uvs", "colors"):
+            list_data = [list(v) for v in getattr(list_model, name)]
+            assert [list(v) for v in getattr(array_model, name)] == list_data, name
+
+        assert array_model.tri_lists == list_model.tri_lists
+
+        print("%-11s lmap: %-5s colors: %-5s %6d verts  list: %7.2f ms  numpy: %7.2f ms" % (
+            target, lightmap, colors, vert_count, list_time*1000, array_time*1000
+            ))
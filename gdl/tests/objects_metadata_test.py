@@ -0,0 +1,85 @@
+import json
+import os
+import pickle
+import tempfile
+
+import setup_tests
+
+from gdl.compilation.metadata import objects as objects_metadata
+from gdl.compilation.metadata import util as metadata_util
+from gdl.compilation.metadata.objects import ObjectsMetadataStore
+
+
+loaded_filepaths = []
+load_metadata = metadata_util.load_metadata
+
+
+def recording_load_metadata(filepath):
+    loaded_filepaths.append(os.path.basename(filepath))
+    return load_metadata(filepath)
+
+
+objects_metadata.util.load_metadata = recording_load_metadata
+
+
+def write_metadata(data_dir, filename, bitmap_names, mtime_offset_ns=0):
+    filepath = os.path.join(data_dir, filename)
+    with open(filepath, "w") as f:
+        json.dump(dict(bitmaps=[
+            dict(name=name, asset_name=name) for name in bitmap_names
+            ]), f)
+
+    if mtime_offset_ns:
+        # make sure the change is seen, even if the mtime is coarse
+        stat = os.stat(filepath)
+        os.utime(filepath, ns=(stat.st_atime_ns, stat.st_mtime_ns + mtime_offset_ns))
+
+
+def get_bitmap_names():
+    # every run uses a new store, so all it knows is what's in the snapshot
+    del loaded_filepaths[:]
+    metadata = ObjectsMetadataStore(data_dir).get_metadata()
+    return [bitm["name"] for bitm in metadata.get("bitmaps", ())]
+
+
+with tempfile.TemporaryDirectory() as data_dir:
+    write_metadata(data_dir, "bitmaps_a.json", ["A0", "A1"])
+    write_metadata(data_dir, "bitmaps_b.json", ["B0"])
+
+    assert get_bitmap_names() == ["A0", "A1", "B0"]
+    assert sorted(loaded_filepaths) == ["bitmaps_a.json", "bitmaps_b.json"]
+    snapshot_filepath = os.path.join(data_dir, "metadata.snapshot")
+    assert os.path.isfile(snapshot_filepath)
+
+    # nothing changed, so nothing is parsed
+    assert get_bitmap_names() == ["A0", "A1", "B0"]
+    assert loaded_filepaths == []
+
+    # only the edited file is parsed again
+    write_metadata(data_dir, "bitmaps_a.json", ["A0", "A1", "A2"], 10**9)
+    assert get_bitmap_names() == ["A0", "A1", "A2", "B0"]
+    assert loaded_filepaths == ["bitmaps_a.json"]
+
+    # added files are parsed, and combined in the order they're located
+    write_metadata(data_dir, "bitmaps_0.json", ["Z0"])
+    assert get_bitmap_names() == ["Z0", "A0", "A1", "A2", "B0"]
+    assert loaded_filepaths == ["bitmaps_0.json"]
+
+    # removed files are dropped without parsing anything
+    os.remove(os.path.join(data_dir, "bitmaps_b.json"))
+    assert get_bitmap_names() == ["Z0", "A0", "A1", "A2"]
+    assert loaded_filepaths == []
+    with open(snapshot_filepath, "rb") as f:
+        assert sorted(pickle.load(f)["files"]) == ["bitmaps_0.json", "bitmaps_a.json"]
+
+    # a corrupt snapshot is ignored, and every file is parsed again
+    for snapshot_data in (b'', b'\x80\x05garbage', b'not a pickle'):
+        with open(snapshot_filepath, "wb") as f:
+            f.write(snapshot_data)
+
+        assert get_bitmap_names() == ["Z0", "A0", "A1", "A2"]
+        assert sorted(loaded_filepaths) == ["bitmaps_0.json", "bitmaps_a.json"]
+
+    # and then it's replaced with a working one
+    assert get_bitmap_names() == ["Z0", "A0", "A1", "A2"]
+    assert loaded_filepaths == []
@@ -0,0 +1,84 @@
+import os
+import tempfile
+
+import numpy
+
+import setup_tests
+
+from gdl.compilation.g3d import constants as c
+from gdl.compilation.g3d.serialization import palette_quantizer
+
+
+rand = numpy.random.RandomState(0)
+# a gradient with noise, so there are many more colors than fit in a palette
+gradient = numpy.linspace(0, 255, 64*64)
+pixels = numpy.stack([
+    gradient, gradient[::-1], rand.randint(0, 256, 64*64), numpy.full(64*64, 255)
+    ], axis=1).astype(numpy.uint8)
+
+for max_palette_size in (16, 256):
+    palette = palette_quantizer.quantize(
+        pixels, max_palette_size, c.TEXTURE_QUANTIZER_MEDIAN_CUT
+        )
+    assert palette.shape == (max_palette_size, 4), palette.shape
+    assert palette.min() >= 0 and palette.max() <= 255
+
+    # the same pixels always give the same palette, in any order
+    for shuffled in (False, True):
+        other_pixels = pixels[rand.permutation(len(pixels))] if shuffled else pixels.copy()
+        other_palette = palette_quantizer.quantize(
+            other_pixels, max_palette_size, c.TEXTURE_QUANTIZER_MEDIAN_CUT
+            )
+        assert numpy.array_equal(palette, other_palette), (max_palette_size, shuffled)
+
+# when there are fewer colors than fit, the palette is just those colors
+few_colors = numpy.array([
+    (0, 0, 0, 255), (255, 0, 0, 255), (0, 255, 0, 128), (255, 0, 0, 255)
+    ]*50, dtype=numpy.uint8)
+for max_palette_size in (3, 16, 256):
+    palette = palette_quantizer.quantize(
+        few_colors, max_palette_size, c.TEXTURE_QUANTIZER_MEDIAN_CUT
+        )
+    assert len(palette) == 3, (max_palette_size, len(palette))
+    assert sorted(map(tuple, palette.astype(int))) == sorted(set(map(tuple, few_colors.tolist())))
+
+    indices = palette_quantizer.nearest_palette_indices(few_colors, palette)
+    assert numpy.array_equal(palette[indices].astype(numpy.uint8), few_colors)
+
+# and fewer boxes are made than asked for, if every box is a single color
+palette = palette_quantizer.quantize(few_colors, 2, c.TEXTURE_QUANTIZER_MEDIAN_CUT)
+assert len(palette) == 2
+
+with tempfile.TemporaryDirectory() as cache_dir:
+    source_md5s = [bytes([i])*16 for i in range(3)]
+    palette = palette_quantizer.quantize(pixels, 256, c.TEXTURE_QUANTIZER_MEDIAN_CUT)
+
+    # cached palettes load back exactly as they were saved
+    filepaths = []
+    for source_md5 in source_md5s:
+        for key in ((256, "median_cut"), (16, "median_cut")):
+            filepath = palette_quantizer.get_palette_cache_filepath(
+                cache_dir, source_md5, *key
+                )
+            assert palette_quantizer.load_cached_palette(filepath) is None
+            palette_quantizer.save_cached_palette(filepath, palette)
+            assert numpy.array_equal(palette_quantizer.load_cached_palette(filepath), palette)
+            filepaths.append(filepath)
+
+    assert len(set(filepaths)) == len(filepaths)
+
+    # a truncated palette isn't loaded
+    with open(filepaths[0], "r+b") as f:
+        f.truncate(100)
+    assert palette_quantizer.load_cached_palette(filepaths[0]) is None
+
+    # palettes of sources that aren't in the build manifest are deleted
+    with open(os.path.join(cache_dir, "unrelated.txt"), "w") as f:
+        f.write("not a palette")
+
+    assert palette_quantizer.prune_palette_cache(cache_dir, {source_md5s[1].hex()}) == 4
+    assert sorted(os.listdir(cache_dir)) == sorted(
+        [os.path.basename(filepath) for filepath in filepaths[2: 4]] + ["unrelated.txt"]
+        )
+    assert palette_quantizer.prune_palette_cache(cache_dir, {source_md5s[1].hex()}) == 0
+    assert palette_quantizer.prune_palette_cache(os.path.join(cache_dir, "missing"), ()) == 0
@@ -0,0 +1,303 @@
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+import setup_tests
+
+from gdl.compilation.ps2_wad_compiler import Ps2WadCompiler, EXTRACT_CHUNK_SIZE
+from gdl.compilation.ps2_wad import constants as c
+from gdl.compilation.ps2_wad import layout
+from gdl.compilation.ps2_wad import util
+from gdl.compilation.ps2_wad.wad_fs import WadFS
+
+
+FILE_COUNT = 48
+
+
+def randbytes(size):
+    # same as random.randbytes, which python 3.8 doesn't have
+    return random.getrandbits(size*8).to_bytes(size, "little") if size else b''
+
+
+def make_wad_dir(wad_dirpath):
+    # make files of many sizes that compress to different degrees
+    file_datas = {}
+    for i in range(FILE_COUNT):
+        filename = "DIR%d\\FILE%d.%s" % (i % 3, i, ("PS2", "ROM", "VBK", "WAD")[i % 4])
+        size = random.choice((0, 100, 0x800, 0x801, 50000, 2000000))
+        file_datas[filename] = randbytes(size // 2) + bytes(size - size // 2)
+
+        write_file(wad_dirpath, filename, file_datas[filename])
+
+    return file_datas
+
+
+def write_file(wad_dirpath, filename, data):
+    filepath = os.path.join(wad_dirpath, *filename.split("\\"))
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(filepath, "wb") as f:
+        f.write(data)
+
+
+def check_wad(wad_filepath, file_datas):
+    with WadFS(wad_filepath) as wad_fs:
+        for dirpath, dirnames, filenames in wad_fs.walk():
+            for filename in filenames:
+                filepath = "%s\\%s" % (dirpath, filename) if dirpath else filename
+                if filepath != "INTERNAL\\FILES.NAMES":
+                    assert wad_fs.read(filepath) == file_datas[filepath], filepath
+
+        assert all(wad_fs.exists(filename) for filename in file_datas)
+
+
+class PatchInterrupted(Exception):
+    pass
+
+
+def patch_interrupted(compiler):
+    # patches the wad, stopping right before the header table is written
+    def interrupt(*args, **kwargs):
+        raise PatchInterrupted()
+
+    write_file_headers, header_struct = util.write_file_headers, util.INDEX_HEADER_STRUCT
+    util.write_file_headers = interrupt
+    util.INDEX_HEADER_STRUCT = type("InterruptingStruct", (), dict(
+        pack=interrupt, unpack=header_struct.unpack, size=header_struct.size
+        ))()
+    try:
+        compiler.patch()
+        raise AssertionError("Patch was not interrupted.")
+    except PatchInterrupted:
+        pass
+    finally:
+        util.write_file_headers, util.INDEX_HEADER_STRUCT = write_file_headers, header_struct
+
+
+def compile_wad(wad_dirpath, wad_filepath, **kwargs):
+    compiler = Ps2WadCompiler(
+        wad_dirpath=wad_dirpath, wad_filepath=wad_filepath, overwrite=True,
+        compression_level=zlib.Z_BEST_COMPRESSION, **kwargs
+        )
+    start = time.time()
+    compiler.compile()
+    elapsed = time.time() - start
+
+    with open(wad_filepath, "rb") as f:
+        return f.read(), elapsed
+
+
+# the batched hasher must match hashing one at a time, and the known hashes
+filepaths = sorted(c.RETAIL_NAMES) + ["", "a"*12, "b/"*12, "\u00e9"*13, "\u0100"*5]
+path_hashes = util.hash_filepaths(filepaths)
+assert path_hashes == [util.hash_filepath(filepath) for filepath in filepaths]
+assert util.hash_filepath(c.INTERNAL_NAMES_FILEPATH) == c.INTERNAL_NAMES_FILEPATH_HASH
+assert util.hash_filepath(c.COMPRESS_NAMES_FILEPATH) == c.COMPRESS_NAMES_FILEPATH_HASH
+assert not util.find_path_hash_collisions(filepaths, path_hashes)
+assert util.find_path_hash_collisions(["a", "b", "A", "c"], [1, 1, 2, 3]) == {1: ["A", "B"]}
+
+random.seed(0)
+with tempfile.TemporaryDirectory() as temp_dir:
+    wad_dirpath = os.path.join(temp_dir, "data")
+    file_datas = make_wad_dir(wad_dirpath)
+
+    serial_wad, serial_time = compile_wad(
+        wad_dirpath, os.path.join(temp_dir, "serial.bin"),
+        parallel_processing=False
+        )
+    # queue little enough that files must wait to be written
+    threaded_wad, threaded_time = compile_wad(
+        wad_dirpath, os.path.join(temp_dir, "threaded.bin"),
+        parallel_processing=True, use_threads=True, max_queued_size=1000000
+        )
+
+    # files are written in the same order, so the wads must be identical
+    assert threaded_wad == serial_wad
+
+    compiler = Ps2WadCompiler(
+        wad_dirpath=wad_dirpath, wad_filepath=os.path.join(temp_dir, "threaded.bin")
+        )
+    # every file must be extracted, with the same data
+    unextracted_datas = dict(file_datas)
+    for filename, data in compiler.extract_files().items():
+        if filename in unextracted_datas:
+            assert data == unextracted_datas.pop(filename), filename
+
+    assert not unextracted_datas, sorted(unextracted_datas)
+
+    # extracting to disk streams the files, so memory use stays bounded
+    extract_dirpath = os.path.join(temp_dir, "extracted")
+    compiler = Ps2WadCompiler(
+        wad_dirpath=extract_dirpath, wad_filepath=os.path.join(temp_dir, "serial.bin"),
+        parallel_processing=False
+        )
+    tracemalloc.start()
+    start = time.time()
+    compiler.extract_files_to_disk()
+    extract_time = time.time() - start
+    extract_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert extract_peak < 4*EXTRACT_CHUNK_SIZE, extract_peak
+
+    for filename, data in file_datas.items():
+        with open(os.path.join(extract_dirpath, filename), "rb") as f:
+            assert f.read() == data, filename
+
+    print("extracted in %6.3f sec  peak memory: %d bytes" % (extract_time, extract_peak))
+
+    # reading from the wad directly must give the same data
+    with WadFS(os.path.join(temp_dir, "serial.bin")) as wad_fs:
+        start = time.time()
+        for filename, data in file_datas.items():
+            assert wad_fs.read(filename.lower().replace("\\", "/")) == data, filename
+            assert wad_fs.stat(filename)["uncomp_size"] == len(data)
+
+            # seek around in the file
+            with wad_fs.open(filename) as f:
+                for pos in (len(data)//2, 7, max(0, len(data) - 3), len(data) + 5):
+                    f.seek(pos)
+                    assert f.read(4000) == data[pos: pos + 4000], (filename, pos)
+
+        wad_fs_time = time.time() - start
+
+        walked_files = set()
+        for dirpath, dirnames, filenames in wad_fs.walk():
+            assert wad_fs.listdir(dirpath) == sorted(dirnames + filenames)
+            walked_files.update(
+                "%s\\%s" % (dirpath, filename) if dirpath else filename
+                for filename in filenames
+                )
+
+        assert walked_files == set(file_datas) | {"INTERNAL\\FILES.NAMES"}
+        assert not wad_fs.exists("DIR0\\MISSING.PS2")
+        assert wad_fs.isdir("dir0")
+
+    print("%d byte wad  serial: %6.3f sec  threaded: %6.3f sec  WadFS reads: %6.3f sec" % (
+        len(serial_wad), serial_time, threaded_time, wad_fs_time
+        ))
+
+    # patching should only rewrite what changed, and give the same files
+    patch_filepath = os.path.join(temp_dir, "patched.bin")
+    shutil.copyfile(os.path.join(temp_dir, "serial.bin"), patch_filepath)
+    compiler = Ps2WadCompiler(
+        wad_dirpath=wad_dirpath, wad_filepath=patch_filepath,
+        compression_level=zlib.Z_BEST_COMPRESSION
+        )
+    compiler.patch()
+    with open(patch_filepath, "rb") as f:
+        assert f.read() == serial_wad
+
+    filenames = sorted(file_datas)
+    old_file_datas = dict(file_datas)
+    file_datas[filenames[0]] = file_datas[filenames[0]][:10]  # shrink
+    file_datas[filenames[1]] = randbytes(3000000)      # grow
+    file_datas[filenames[2]] = file_datas[filenames[2]]       # touch
+    file_datas["NEW\\FILE.PS2"] = randbytes(5000)
+    for filename in filenames[:3] + ["NEW\\FILE.PS2"]:
+        write_file(wad_dirpath, filename, file_datas[filename])
+
+    os.remove(os.path.join(wad_dirpath, *filenames[3].split("\\")))
+    del file_datas[filenames[3]]
+
+    # until the headers are written, the wad must still hold the old files
+    patch_interrupted(compiler)
+    check_wad(patch_filepath, old_file_datas)
+
+    start = time.time()
+    compiler.patch()
+    patch_time = time.time() - start
+    check_wad(patch_filepath, file_datas)
+
+    # add enough files that the header table grows over some file data
+    for i in range(200):
+        file_datas["MORE\\FILE%d.PS2" % i] = randbytes(i)
+        write_file(wad_dirpath, "MORE\\FILE%d.PS2" % i, file_datas["MORE\\FILE%d.PS2" % i])
+
+    # including the files that must be moved for the header table to grow
+    patch_interrupted(compiler)
+    check_wad(patch_filepath, {
+        filename: data for filename, data in file_datas.items()
+        if not filename.startswith("MORE\\")
+        })
+
+    compiler.patch()
+    check_wad(patch_filepath, file_datas)
+
+    # compacting rebuilds the wad from scratch
+    compiler.patch(compact=True)
+    check_wad(patch_filepath, file_datas)
+    compile_wad(wad_dirpath, os.path.join(temp_dir, "serial.bin"), parallel_processing=False)
+    with open(patch_filepath, "rb") as f, open(os.path.join(temp_dir, "serial.bin"), "rb") as f2:
+        assert f.read() == f2.read()
+
+    print("patched %d byte wad in %6.3f sec" % (os.path.getsize(patch_filepath), patch_time))
+
+    # the header table growing over a small file and into a large one after
+    # it must move both without writing either over the other's old data
+    grow_dirpath = os.path.join(temp_dir, "grow")
+    grow_datas = {"A\\A.PS2": randbytes(40960), "A\\B.PS2": randbytes(100)}
+    for filename, data in grow_datas.items():
+        write_file(grow_dirpath, filename, data)
+
+    compiler = Ps2WadCompiler(
+        wad_dirpath=grow_dirpath, wad_filepath=os.path.join(temp_dir, "grow.bin"),
+        overwrite=True, parallel_processing=False, optimize_layout=True,
+        load_groups={"SMALL": ["A\\B.PS2"], "LARGE": ["A\\A.PS2"]}
+        )
+    compiler.compile()
+    with open(compiler.wad_filepath, "rb") as f:
+        assert [(h["data_pointer"], h["uncomp_size"]) for h in util.read_file_headers(f)][:2] == [
+            (c.PS2_WAD_FILE_CHUNK_SIZE, 100), (2*c.PS2_WAD_FILE_CHUNK_SIZE, 40960)
+            ]
+
+    old_grow_datas = dict(grow_datas)
+    for i in range(600):
+        grow_datas["MORE\\FILE%d.PS2" % i] = randbytes(i % 50)
+        write_file(grow_dirpath, "MORE\\FILE%d.PS2" % i, grow_datas["MORE\\FILE%d.PS2" % i])
+
+    patch_interrupted(compiler)
+    check_wad(compiler.wad_filepath, old_grow_datas)
+    compiler.patch()
+    check_wad(compiler.wad_filepath, grow_datas)
+
+    # laying out by load group should put each level's files together
+    layout_dirpath = os.path.join(temp_dir, "layout")
+    layout_datas = {}
+    for level in ("LEVELA1", "LEVELA2", "LEVELB1"):
+        for dirname in ("LEVELS", "MAPS", "ITEMS", "MONSTERS", "AUDIO"):
+            for filename in ("ANIM.PS2", "OBJECTS.PS2"):
+                layout_datas["%s\\%s\\%s" % (dirname, level, filename)] = randbytes(3000)
+    for filename in ("ITEMS\\LEVELA\\ANIM.PS2", "ITEMS\\LEVELB\\ANIM.PS2", "TEXT\\TEXT.ROM"):
+        layout_datas[filename] = randbytes(3000)
+    for filename, data in layout_datas.items():
+        write_file(layout_dirpath, filename, data)
+
+    load_groups = layout.infer_load_groups(layout_datas)
+    assert load_groups["LEVELA2"] == [
+        "LEVELS\\LEVELA2\\*", "MAPS\\LEVELA2\\*", "ITEMS\\LEVELA2\\*", "ITEMS\\LEVELA\\*"
+        ]
+    assert layout.read_load_groups(
+        "# comment\n[levela1]\nLEVELS\\LEVELA1\n monsters/levela1/*.PS2 \n[EMPTY]\n"
+        ) == {"LEVELA1": ["LEVELS\\LEVELA1", "monsters/levela1/*.PS2"], "EMPTY": []}
+
+    for load_groups in (None, {
+            level: ["LEVELS\\" + level, "MONSTERS\\%s\\*.PS2" % level]
+            for level in ("LEVELA1", "LEVELA2", "LEVELB1")
+            }):
+        compiler = Ps2WadCompiler(
+            wad_dirpath=layout_dirpath, wad_filepath=os.path.join(temp_dir, "layout.bin"),
+            overwrite=True, optimize_layout=True, load_groups=load_groups,
+            parallel_processing=False
+            )
+        compiler.compile()
+        check_wad(compiler.wad_filepath, layout_datas)
+
+        # files shared with the next level are laid out between the two,
+        # so every level's files should be readable with one seek
+        report = compiler.layout_report
+        assert set(report) == {"LEVELA1", "LEVELA2", "LEVELB1"}
+        for name, group_report in report.items():
+            assert group_report["seeks_after"] == 1, (name, group_report)
@@ -0,0 +1,193 @@
+import random
+import time
+
+import setup_tests
+
+from gdl.compilation.g3d.serialization.stripify import Stripifier,\
+     START_ORDERS, count_cache_misses
+from gdl.compilation.g3d.serialization.model import G3DModel
+
+
+GRID_SIZE = 200
+
+
+def make_grid_tris(size, shuffle):
+    tris = []
+    for y in range(size):
+        for x in range(size):
+            v0 = y*(size + 1) + x
+            v1, v2, v3 = v0 + 1, v0 + size + 1, v0 + size + 2
+            tris.append(((v0, v0 % 7), (v2, v2 % 7), (v1, v1 % 7)))
+            tris.append(((v1, v1 % 7), (v2, v2 % 7), (v3, v3 % 7)))
+
+    if shuffle:
+        random.shuffle(tris)
+
+    return tris
+
+
+def get_strip_tris(stripifier, tex_index):
+    # turn the strips back into triangles, skipping degenerates
+    vert_data = stripifier.vert_data
+    strip_tris = []
+    for strip, face_dir in zip(stripifier.all_strips[tex_index],
+                               stripifier.all_face_dirs[tex_index]):
+        for i in range(len(strip) - 2):
+            tri = [vert_data[v_i][:2] for v_i in strip[i: i + 3]]
+            if (i % 2) != face_dir:
+                tri[0], tri[1] = tri[1], tri[0]
+
+            if len(set(tri)) == 3:
+                strip_tris.append(tri)
+
+    return strip_tris
+
+
+def normalize_tri(tri):
+    # rotate the triangle so its lowest vert is first, keeping the winding
+    i = tri.index(min(tri))
+    return tuple(tri[i:]) + tuple(tri[:i])
+
+
+random.seed(0)
+for shuffle in (False, True):
+    for max_strip_len in (Stripifier.max_strip_len, 32):
+        for start_order in START_ORDERS:
+            tris = make_grid_tris(GRID_SIZE, shuffle)
+
+            stripifier = Stripifier()
+            stripifier.degen_link = False
+            stripifier.max_strip_len = max_strip_len
+            stripifier.start_order = start_order
+
+            start = time.time()
+            stripifier.load_mesh({"TEX": tris})
+            stripifier.make_strips()
+            elapsed = time.time() - start
+
+            # every triangle must be in exactly one strip, facing the same way
+            strip_tris = get_strip_tris(stripifier, "TEX")
+            assert sorted(map(normalize_tri, strip_tris)) == sorted(map(normalize_tri, tris))
+
+            print("shuffled: %-5s max len: %-10s order: %-7s %6d tris in %5d strips in %6.3f sec" % (
+                shuffle, max_strip_len, start_order, len(tris),
+                len(stripifier.all_strips["TEX"]), elapsed
+                ))
+
+
+
+def make_fixed_tris():
+    # a shuffled 3x3 grid, a fan sharing a vert, and a lone triangle
+    rand = random.Random(11)
+    tris = []
+    for y in range(3):
+        for x in range(3):
+            v0 = y*4 + x
+            tris.append(((v0, 0), (v0 + 4, 0), (v0 + 1, 0)))
+            tris.append(((v0 + 1, 0), (v0 + 4, 0), (v0 + 5, 0)))
+
+    rand.shuffle(tris)
+    return tris + [
+        ((15, 1), (16, 1), (17, 1)), ((15, 1), (17, 1), (18, 1)),
+        ((15, 1), (18, 1), (19, 1)), ((20, 2), (21, 2), (22, 2)),
+        ]
+
+
+# the strips must be exactly what the original stripifier made. these
+# were generated with it, and are (strips, face_dirs, degens) before and
+# after linking, for each degen_link and max_strip_len
+UNLINKED_STRIPS = (
+    [[3, 0, 1, 2, 10, 11, 14, 15], [13, 8, 9, 5, 6, 4, 7, 12],
+     [7, 3, 6, 1, 9, 10, 13, 14], [17, 18, 16, 19, 20], [21, 22, 23]],
+    [True, True, True, False, False],
+    [[], [], [], [], []],
+    )
+SHORT_STRIPS = (
+    [[12, 4, 7], [10, 13, 14], [1, 9, 10], [21, 22, 23], [3, 0, 1, 2, 10],
+     [4, 5, 6, 9, 1], [1, 3, 6, 7, 4], [5, 8, 9, 13, 10], [2, 10, 11, 14, 15],
+     [17, 18, 16, 19, 20]],
+    [False, False, False, False, True, False, False, False, False, False],
+    [[], [], [], [], [], [], [], [], [], []],
+    )
+EXPECTED_STRIPS = {
+    (False, Stripifier.max_strip_len): (UNLINKED_STRIPS, (
+        [[21, 22, 23, 23, 17, 18, 16, 19, 20, 3, 0, 1, 2, 10, 11, 14, 15, 13,
+          8, 9, 5, 6, 4, 7, 12, 7, 3, 6, 1, 9, 10, 13, 14]],
+        [False],
+        [[3, 4, 5, 9, 10, 17, 18, 25, 26]],
+        )),
+    (True, Stripifier.max_strip_len): (UNLINKED_STRIPS, (
+        [[21, 22, 23, 23, 23, 17, 17, 18, 16, 19, 20, 20, 3, 3, 0, 1, 2, 10,
+          11, 14, 15, 15, 13, 13, 8, 9, 5, 6, 4, 7, 12, 12, 7, 7, 3, 6, 1, 9,
+          10, 13, 14]],
+        [False],
+        [[3, 4, 5, 6, 7, 11, 12, 13, 14, 21, 22, 23, 24, 31, 32, 33, 34]],
+        )),
+    (False, 5): ((
+        [[3, 0, 1, 2, 10], [4, 5, 6, 9, 1], [1, 3, 6, 7, 4], [5, 8, 9, 13, 10],
+         [2, 10, 11, 14, 15], [12, 4, 7], [10, 13, 14], [1, 9, 10],
+         [17, 18, 16, 19, 20], [21, 22, 23]],
+        [True, False, False, False, False, False, False, False, False, False],
+        [[], [], [], [], [], [], [], [], [], []],
+        ), SHORT_STRIPS),
+    }
+EXPECTED_STRIPS[(True, 5)] = EXPECTED_STRIPS[(False, 5)]
+
+for (degen_link, max_strip_len), expected in EXPECTED_STRIPS.items():
+    stripifier = Stripifier()
+    stripifier.degen_link = degen_link
+    stripifier.max_strip_len = max_strip_len
+    stripifier.load_mesh({"TEX": make_fixed_tris()})
+    for linked, (strips, face_dirs, degens) in zip((False, True), expected):
+        if linked:
+            stripifier.link_strips()
+        else:
+            stripifier.make_strips()
+
+        assert stripifier.all_strips["TEX"] == strips, (degen_link, max_strip_len, linked)
+        assert stripifier.all_face_dirs["TEX"] == face_dirs, (degen_link, max_strip_len, linked)
+        assert stripifier.all_degens["TEX"] == degens, (degen_link, max_strip_len, linked)
+
+# a vert only misses the cache if it isn't one of the last ones added
+assert count_cache_misses([[0, 1, 2, 3], [2, 3, 4, 0]], 5) == 5
+assert count_cache_misses([[0, 1, 2, 3], [2, 3, 4, 0]], 4) == 6
+
+
+# each subobject must keep the strips that compile smallest
+for target in ("target_ps2", "target_xbox"):
+    g3d_model = G3DModel(**{target: True})
+    g3d_model.verts = [(x, 0.0, y) for y in range(41) for x in range(41)]
+    g3d_model.uvs   = [(0.0, 0.0)]
+    g3d_model.tri_lists = {
+        ("TEX", ""): [
+            tuple((v, 0, 0) for v, _ in tri) for tri in make_grid_tris(40, True)
+            ],
+        ("TEX", "LM"): [
+            tuple((v, 0, 0) for v, _ in tri) for tri in make_fixed_tris()
+            ],
+        }
+
+    # the stats of every subobject using each start order
+    order_stats = {}
+    for start_order in START_ORDERS:
+        g3d_model.stripifier.start_order = start_order
+        g3d_model.make_strips()
+        order_stats[start_order] = g3d_model.get_strip_stats()
+
+    g3d_model.stripifier.start_order = START_ORDERS[0]
+    report = g3d_model.choose_strip_start_orders()
+    assert g3d_model.stripifier.start_order == START_ORDERS[0]
+    assert set(report) == set(g3d_model.tri_lists)
+
+    stats = g3d_model.get_strip_stats()
+    for idx_key, subobj_report in report.items():
+        assert subobj_report["before"] == order_stats[START_ORDERS[0]][idx_key]
+        assert subobj_report["after"] == stats[idx_key]
+        assert subobj_report["after"] == order_stats[subobj_report["start_order"]][idx_key]
+        assert subobj_report["after"]["qword_count"] == min(
+            s[idx_key]["qword_count"] for s in order_stats.values()
+            )
+        print("%-11s %-8s %s qwords before, %s after using %s order" % (
+            target, "/".join(idx_key), subobj_report["before"]["qword_count"],
+            subobj_report["after"]["qword_count"], subobj_report["start_order"]
+            ))
@@ -0,0 +1,82 @@
+import csv
+import json
+import os
+import tempfile
+
+import setup_tests
+
+from gdl import telemetry, util
+from job_functions import build_job
+
+
+all_job_args = [dict(name="asset_%s" % i, size=i*10) for i in range(6)]
+
+# nothing is recorded unless collecting
+assert not telemetry.is_collecting()
+util.process_jobs(build_job, all_job_args, process_count=1)
+with telemetry.measure("read") as record:
+    pass
+assert record["wall_time"] == 0.0
+
+for process_count in (1, 2):
+    # records measured in worker processes are sent back to this one
+    with telemetry.collect() as records:
+        util.process_jobs(build_job, all_job_args, process_count=process_count)
+        telemetry.record_skipped("asset_skipped", "test")
+
+    assert not telemetry.is_collecting()
+    assert len(records) == len(all_job_args)*2 + 1, (process_count, len(records))
+    for job_args in all_job_args:
+        decode, = [
+            r for r in records if r["asset"] == job_args["name"] and r["phase"] == "decode"
+            ]
+        assert decode["asset_type"] == "test"
+        assert decode["input_size"] == job_args["size"]
+        assert decode["output_size"] == job_args["size"]*2
+        assert not decode["skipped"]
+
+    assets, phases = telemetry.summarize(records)
+    assert len(assets) == len(all_job_args) + 1
+    assert [a["asset"] for a in assets if a["skipped"]] == ["asset_skipped"]
+    assert phases["decode"]["count"] == len(all_job_args)
+    assert phases["write"]["output_size"] == sum(a["size"]*2 for a in all_job_args)
+
+    # what was measured before a job failed is still recorded
+    with telemetry.collect() as records:
+        util.process_jobs(
+            build_job, [dict(name="asset_failed", size=10, fail=True)],
+            process_count=process_count, raise_errors=False
+            )
+
+    assert [r["phase"] for r in records] == ["decode", "write"], (process_count, records)
+
+with tempfile.TemporaryDirectory() as tempdir:
+    json_filepath = os.path.join(tempdir, "reports", "build.json")
+    csv_filepath = os.path.join(tempdir, "build.csv")
+
+    # nested collections add to the outer one, and each writes its own report
+    with telemetry.report(json_filepath) as outer_records:
+        telemetry.record_skipped("asset_skipped", "test")
+        with telemetry.collect(csv_filepath) as inner_records:
+            util.process_jobs(build_job, all_job_args[:2], process_count=1)
+
+        # no path, so this collects into the outer report without writing
+        with telemetry.report("") as records:
+            assert records is outer_records
+            util.process_jobs(build_job, all_job_args[2:], process_count=1)
+
+    assert inner_records is outer_records
+    with open(json_filepath) as f:
+        report = json.load(f)
+
+    assert len(report["records"]) == len(all_job_args)*2 + 1
+    assert len(report["assets"]) == len(all_job_args) + 1
+    assert report["skipped_count"] == 1
+    assert set(report["phases"]) == {"build", "decode", "write"}
+
+    with open(csv_filepath, newline="") as f:
+        rows = list(csv.DictReader(f))
+
+    assert len(rows) == 4
+    assert set(rows[0]) == set(telemetry.RECORD_FIELDS)
+    assert {row["asset"] for row in rows} == {"asset_0", "asset_1"}
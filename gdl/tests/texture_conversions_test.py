@@ -0,0 +1,87 @@
+import os
+import random
+import time
+
+import setup_tests
+
+from array import array
+from gdl.compilation.g3d.serialization import texture_conversions as tex_conv
+from gdl.compilation.g3d.serialization import ncc
+
+
+WIDTH, HEIGHT = 256, 256
+random.seed(0)
+
+ncc_table = ncc.NccTable(
+    y=range(0, 256, 16),
+    a=[random.randint(-256, 255) for i in range(12)],
+    b=[random.randint(-256, 255) for i in range(12)],
+    )
+# calculate_from_pixels isn't written yet, so set the ranges by hand
+ncc_table.y_min, ncc_table.y_max = 16, 235
+ncc_table.i_min, ncc_table.i_max = -2, 2
+ncc_table.q_min, ncc_table.q_max = -2, 2
+
+pixels_8888 = bytearray(os.urandom(WIDTH*HEIGHT*4))
+# make some of the alpha fully opaque to test both 3555 encodings
+for i in range(0, len(pixels_8888), 8):
+    pixels_8888[i] = 255
+
+pixels_16 = bytearray(os.urandom(WIDTH*HEIGHT*2))
+pixels_8  = bytearray(os.urandom(WIDTH*HEIGHT))
+
+
+def run_swap(pixels):
+    pixels = bytearray(pixels)
+    tex_conv.channel_swap_bgra_rgba_array([pixels], 2)
+    return pixels
+
+
+tests = (
+    ("argb_8888_to_3555",       lambda: tex_conv.argb_8888_to_3555(pixels_8888)),
+    ("xrgb_8888_to_3555",       lambda: tex_conv.argb_8888_to_3555(pixels_8888, True)),
+    ("argb_3555_to_8888",       lambda: tex_conv.argb_3555_to_8888(pixels_16)),
+    ("argb_8888_to_ayiq_8422",  lambda: tex_conv.argb_8888_to_ayiq_8422(pixels_8888, ncc_table)),
+    ("xrgb_8888_to_yiq_422",    lambda: tex_conv.xrgb_8888_to_yiq_422(pixels_8888, ncc_table)),
+    ("ayiq_8422_to_argb_8888",  lambda: tex_conv.ayiq_8422_to_argb_8888(pixels_16, ncc_table)),
+    ("yiq_422_to_xrgb_8888",    lambda: tex_conv.yiq_422_to_xrgb_8888(pixels_8, ncc_table)),
+    ("channel_swap_bgra_rgba",  lambda: run_swap(pixels_16)),
+    )
+
+numpy_module = tex_conv.numpy
+megapixels = WIDTH*HEIGHT / 1000000
+for name, test in tests:
+    results = {}
+    for impl in ("python", "numpy"):
+        tex_conv.numpy = numpy_module if impl == "numpy" else None
+        if impl == "numpy" and numpy_module is None:
+            continue
+
+        start = time.time()
+        results[impl] = test()
+        results[impl + "_mps"] = megapixels / max(time.time() - start, 1e-9)
+
+    tex_conv.numpy = numpy_module
+
+    if "numpy" in results:
+        assert bytes(results["python"]) == bytes(results["numpy"]), name
+        assert type(results["python"]) is type(results["numpy"]), name
+
+    print("%-24s python: %9.2f MP/s    numpy: %9.2f MP/s" % (
+        name, results["python_mps"], results.get("numpy_mps", 0)
+        ))
+
+# the lookup tables must build the same with and without numpy
+for name, builder in sorted(tex_conv._TABLE_BUILDERS.items()):
+    tables = []
+    for impl in ("python", "numpy"):
+        tex_conv.numpy = numpy_module if impl == "numpy" else None
+        if impl == "numpy" and numpy_module is None:
+            continue
+
+        start = time.time()
+        tables.append(builder())
+        print("%-28s %s build: %7.2f ms" % (name, impl, (time.time() - start)*1000))
+
+    tex_conv.numpy = numpy_module
+    assert all(table == tables[0] for table in tables), name
@@ -0,0 +1,92 @@
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+
+import setup_tests
+
+from gdl.compilation.g3d.serialization import constants as c
+from gdl.compilation.g3d.serialization.texture import G3DTexture
+
+
+WIDTH, HEIGHT = 256, 256
+TEXTURE_COUNT = 64
+FORMATS = (
+    c.PIX_FMT_ABGR_8888, c.PIX_FMT_ABGR_1555,
+    c.PIX_FMT_ABGR_8888_IDX_8, c.PIX_FMT_ABGR_1555_IDX_4,
+    c.PIX_FMT_ABGR_3555_IDX_8_NGC, c.PIX_FMT_I_8_IDX_8,
+    )
+TARGETS = ("target_ps2", "target_ngc", "target_xbox")
+
+
+def make_texture(format_name):
+    bpp = c.PIXEL_SIZES[format_name]
+    palette_stride = c.PALETTE_SIZES.get(format_name, 0)
+
+    g3d_texture = G3DTexture()
+    g3d_texture.width, g3d_texture.height = WIDTH, HEIGHT
+    g3d_texture.format_name = format_name
+    if palette_stride:
+        g3d_texture.palette = bytearray(os.urandom((2**bpp)*palette_stride))
+
+    g3d_texture.textures = []
+    width, height = WIDTH, HEIGHT
+    while width >= 8 and height >= 8:
+        pixels = bytearray(os.urandom((width*height*max(8, bpp))//8))
+        if bpp < 8:
+            # 4bpp textures are stored padded to 8bpp
+            pixels = bytearray(pixels.translate(bytes(range(16))*16))
+
+        g3d_texture.textures.append(pixels)
+        width, height = width//2, height//2
+
+    return g3d_texture
+
+
+g3d_textures = [make_texture(FORMATS[i % len(FORMATS)]) for i in range(TEXTURE_COUNT)]
+originals = [
+    (bytes(t.palette or b''), [bytes(tex) for tex in t.textures])
+    for t in g3d_textures
+    ]
+total_size = sum(sum(map(len, t.textures)) for t in g3d_textures)
+
+for target in TARGETS:
+    target_kwargs = {target: True} if target != "target_xbox" else {}
+
+    # exporting then importing should give back the exact same texture
+    for g3d_texture in g3d_textures[: len(FORMATS)]:
+        buffer = io.BytesIO()
+        g3d_texture.export_gtx(buffer, headerless=True, **target_kwargs)
+        buffer.seek(0)
+
+        reimported = G3DTexture()
+        reimported.import_gtx(
+            buffer, headerless=True, width=WIDTH, height=HEIGHT,
+            mipmaps=len(g3d_texture.textures) - 1,
+            format_name=g3d_texture.format_name,
+            is_ngc=(target == "target_ngc"),
+            )
+        assert reimported.palette == g3d_texture.palette, (target, g3d_texture.format_name)
+        assert reimported.textures == g3d_texture.textures, (target, g3d_texture.format_name)
+
+    # serialize every texture into one buffer, like a textures.ps2
+    output_buffer = tempfile.TemporaryFile()
+    tracemalloc.start()
+    start = time.time()
+    for g3d_texture in g3d_textures:
+        g3d_texture.export_gtx(output_buffer, headerless=True, **target_kwargs)
+
+    elapsed = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    output_buffer.close()
+
+    print("%-12s %6.2f MB exported in %6.3f sec    peak memory: %6.2f MB" % (
+        target, total_size/1000000, elapsed, peak/1000000
+        ))
+
+# exporting must never modify the source palette or mips
+for g3d_texture, (palette, textures) in zip(g3d_textures, originals):
+    assert bytes(g3d_texture.palette or b'') == palette
+    assert [bytes(tex) for tex in g3d_texture.textures] == textures
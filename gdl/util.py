@@ -2,27 +2,285 @@ import concurrent.futures
 import os
 import traceback
 
+from multiprocessing import shared_memory
+from . import telemetry
 from .supyr_struct_ext import FixedBytearrayBuffer,\
      BytearrayBuffer, BytesBuffer
 
-_processing_pool = None
+# data shared by every job being run, and files opened by them. each
+# worker process is sent the shared data once, rather than every job
+_shared_job_data = {}
+_shared_job_files = {}
 
-def process_jobs(job_function, all_job_args=(), process_count=None):
-    results = []
-    if process_count is None or process_count > 1:
-        global _processing_pool
-        if _processing_pool is None:
-            _processing_pool = concurrent.futures.ProcessPoolExecutor(process_count)
 
-        results.extend(_processing_pool.map(job_function, all_job_args))
-    else:
-        for job_args in all_job_args:
-            try:
-                results.append(job_function(job_args))
-            except Exception:
-                print(traceback.format_exc())
+def _set_shared_job_data(shared_job_data):
+    _clear_shared_job_data()
+    _shared_job_data.update(shared_job_data or {})
 
-    return results
+
+def _clear_shared_job_data():
+    for payload in _shared_job_data.values():
+        if isinstance(payload, SharedPayload) and not payload.is_owner:
+            payload.detach()
+
+    for f in _shared_job_files.values():
+        f.close()
+
+    _shared_job_data.clear()
+    _shared_job_files.clear()
+
+
+def get_shared_job_data(key, default=None):
+    '''Returns the value of the data shared by all the jobs being run.'''
+    return _shared_job_data.get(key, default)
+
+
+def get_shared_job_file(filepath):
+    '''
+    Returns the file opened for reading. It's only opened the first time
+    a job in this process asks for it, and is closed when the jobs end.
+    '''
+    f = _shared_job_files.get(filepath)
+    if f is None:
+        f = _shared_job_files[filepath] = open(filepath, "rb")
+    return f
+
+
+class SharedPayload:
+    '''
+    Byte strings concatenated into one block, which jobs read slices of
+    by offset and size. When use_shared_memory is True the block is put
+    in shared memory, so pickling the payload only sends its name, and
+    worker processes read it without it being copied to each of them.
+    The creator must close the payload once the jobs are done.
+    '''
+    def __init__(self, datas=(), use_shared_memory=True):
+        self.spans = []
+        offset = 0
+        for data in datas:
+            self.spans.append((offset, len(data)))
+            offset += len(data)
+
+        self.name = None
+        self.is_owner = True
+        self._shm = None
+        self._data = bytearray(offset)
+        if use_shared_memory and offset:
+            self._shm = shared_memory.SharedMemory(create=True, size=offset)
+            self.name = self._shm.name
+            self._data = self._shm.buf
+
+        for (offset, size), data in zip(self.spans, datas):
+            self._data[offset: offset + size] = data
+
+    def __getstate__(self):
+        # only send the name of the shared memory to other processes
+        return dict(
+            spans=(), name=self.name, is_owner=False, _shm=None,
+            _data=None if self.name else self._data
+            )
+
+    def read(self, offset, size):
+        if self._data is None:
+            # attach to the shared memory the first time it's read
+            self._shm = shared_memory.SharedMemory(name=self.name)
+            self._data = self._shm.buf
+
+        return bytes(self._data[offset: offset + size])
+
+    def detach(self):
+        if self._shm is not None:
+            self._data = None
+            self._shm.close()
+            self._shm = None
+
+    def close(self):
+        # frees the shared memory. only the creator should call this
+        shm = self._shm
+        self.detach()
+        if shm is not None and self.name:
+            shm.unlink()
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _run_job_collecting_telemetry(job_function, job_args):
+    # runs the job in a worker process, and returns the telemetry
+    # records it collected with its result, so they can be combined
+    with telemetry.collect_separately() as records:
+        try:
+            result = job_function(job_args)
+        except Exception as e:
+            # failed jobs are the ones most worth seeing in the report,
+            # so send their records back with the exception
+            e.telemetry_records = records
+            raise
+    return result, records
+
+
+class JobScheduler:
+    '''
+    Runs jobs on a pool of processes. Jobs can be given costs(such as the
+    size of the file they process), and the most costly are started first,
+    so a large job isn't left running alone after the rest are done.
+    Results are passed to a callback as each job finishes. The pool is
+    shut down when the scheduler is closed, or used as a context manager.
+    shared_job_data is a dict of data all the jobs use, which is sent to
+    each worker process once(see get_shared_job_data), rather than being
+    copied into every job's args.
+    '''
+    process_count = None  # None means use ProcessPoolExecutor's default
+
+    def __init__(self, process_count=None, shared_job_data=None):
+        self.process_count = process_count
+        self.shared_job_data = shared_job_data
+        self._executor = None
+        self._futures = ()
+        self._cancelled = False
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        '''
+        Stops any jobs that haven't started from being run. Jobs already
+        running are left to finish. Can be called from another thread,
+        or from a callback.
+        '''
+        self._cancelled = True
+        for future in tuple(self._futures):
+            future.cancel()
+
+    def run_jobs(self, job_function, all_job_args=(), costs=None,
+                 callback=None, raise_errors=True):
+        '''
+        Runs the job function on each job's args, and returns the results
+        of the jobs that succeeded, in the order the jobs were given.
+        costs can be a list of each job's cost, or a function returning
+        the cost of a job's args. callback is called in this thread with
+        each job's args and result as it finishes. If a job raises an
+        exception, the jobs that haven't started are cancelled and it's
+        re-raised. If raise_errors is False, it's printed and the job is
+        skipped instead.
+        '''
+        all_job_args = list(all_job_args)
+        if callable(costs):
+            costs = [costs(job_args) for job_args in all_job_args]
+
+        order = range(len(all_job_args))
+        if costs is not None:
+            # largest first, keeping the given order for equal costs
+            order = sorted(order, key=lambda i: -costs[i])
+
+        self._cancelled = False
+        results = {}
+        if self.process_count is not None and self.process_count <= 1:
+            _set_shared_job_data(self.shared_job_data)
+            for i in order:
+                if self._cancelled:
+                    break
+
+                try:
+                    results[i] = job_function(all_job_args[i])
+                except Exception:
+                    if raise_errors:
+                        raise
+                    print(traceback.format_exc())
+                    continue
+
+                if callback:
+                    callback(all_job_args[i], results[i])
+
+            return [results[i] for i in sorted(results)]
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                self.process_count, initializer=_set_shared_job_data,
+                initargs=(self.shared_job_data, )
+                )
+
+        # the pool starts jobs in the order they're submitted
+        futures = {}
+        collect_telemetry = telemetry.is_collecting()
+        for i in order:
+            if collect_telemetry:
+                future = self._executor.submit(
+                    _run_job_collecting_telemetry, job_function, all_job_args[i]
+                    )
+            else:
+                future = self._executor.submit(job_function, all_job_args[i])
+            futures[future] = i
+
+        self._futures = futures
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                if future.cancelled():
+                    continue
+
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                    if collect_telemetry:
+                        results[i], records = results[i]
+                        telemetry.add_records(records)
+                except Exception as e:
+                    telemetry.add_records(getattr(e, "telemetry_records", ()))
+                    if raise_errors:
+                        raise
+                    print(traceback.format_exc())
+                    continue
+
+                if callback:
+                    callback(all_job_args[i], results[i])
+        except BaseException:
+            # don't leave the rest of the jobs running after an
+            # interrupt, or after a job failed and raise_errors is set
+            self.cancel()
+            raise
+        finally:
+            self._futures = ()
+
+        return [results[i] for i in sorted(results)]
+
+    def close(self):
+        self.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+        # jobs run in this process may have opened shared files
+        _clear_shared_job_data()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def process_jobs(job_function, all_job_args=(), process_count=None,
+                 costs=None, callback=None, shared_job_data=None,
+                 raise_errors=True):
+    # the pool is only kept for this call, so no worker processes are
+    # left running between builds, and process_count always applies
+    with JobScheduler(process_count, shared_job_data) as scheduler:
+        return scheduler.run_jobs(
+            job_function, all_job_args, costs, callback, raise_errors
+            )
+
+
+def get_file_cost(filepath):
+    # cost of a job that processes the file, for scheduling jobs
+    try:
+        return os.path.getsize(filepath)
+    except (OSError, TypeError):
+        return 0
 
 
 def get_is_arcade_wad(filepath):